@@ -2,16 +2,15 @@
 
 
 import json
+import os
 import re
 import socket
-import xml.etree.ElementTree as ET
 from importlib import import_module
 from os import environ
 from pathlib import Path
 from shutil import copyfile
 from urllib.error import URLError
 from urllib.parse import urljoin
-from urllib.request import urlopen
 from uuid import uuid4
 
 
@@ -55,8 +54,26 @@ ANNOUNCEMENT_FILENAME = "announcement.txt"
 
 FAILED_ITEMS_LIMIT = 10
 
+RASTER_WORKERS = 1
+PG_WORKERS = 1
+STEP_WORKERS = 1
+
+VSIZIP_CACHE_SIZE = 256
+
+S3_WORKERS = 4
+
+WORKER_POOL_SIZE = 0
+WORKER_POOL_RECYCLE = 10
+
 JOB_TIME_LIMIT_HOURS = 24
 
+# Estimated memory of a job is the base plus the delivery size multiplied by the factor of the product type.
+JOB_BASE_MEMORY = 1024 ** 3
+JOB_MEMORY_FACTORS = {"raster": 4, "vector": 3}
+
+# Jobs of products running historically shorter than this number of seconds are counted as using one cpu.
+JOB_SHORT_RUNTIME = 600
+
 UNKNOWN_REFERENCE_YEAR_LABEL = "ury"
 
 UPDATE_JOB_STATUSES_INTERVAL = 30000
@@ -260,6 +277,42 @@ def is_system_check(check_ident):
         is_system = False
     return is_system
 
+def get_product_type(product_definition):
+    """Returns "raster" if the product has any raster check, "vector" otherwise."""
+    for step_def in product_definition["steps"]:
+        if step_def["check_ident"].startswith("qc_tool.raster."):
+            return "raster"
+    return "vector"
+
+def get_job_cpus():
+    """
+    Returns number of cpus used by one job on this worker by the product type.
+
+    The parallelism is configured on the worker only, so the worker sends it to the frontend when pulling a job.
+    """
+    return {"raster": max(CONFIG["raster_workers"], CONFIG["step_workers"]),
+            "vector": max(CONFIG["pg_workers"], CONFIG["step_workers"])}
+
+def estimate_job_cost(product_type, size_bytes, avg_runtime=None, job_cpus=None):
+    """
+    Estimates resources needed by the job.
+
+    :param product_type: "raster" or "vector".
+    :param size_bytes: size of the delivery.
+    :param avg_runtime: average runtime in seconds of previous jobs of the product, None if unknown.
+    :param job_cpus: number of cpus used by one job on the worker by the product type, see get_job_cpus(),
+                     None if the worker has not sent it.
+    :return: dictionary with memory in bytes and number of cpus.
+    """
+    memory = JOB_BASE_MEMORY + size_bytes * JOB_MEMORY_FACTORS[product_type]
+    if job_cpus is None:
+        job_cpus = get_job_cpus()
+    if avg_runtime is not None and avg_runtime < JOB_SHORT_RUNTIME:
+        cpus = 1
+    else:
+        cpus = job_cpus[product_type]
+    return {"memory": memory, "cpus": cpus}
+
 def prepare_job_blueprint(product_definition):
     job_report = {"job_uuid": None,
                   "status": None,
@@ -332,6 +385,9 @@ def load_job_status(job_uuid):
 
 
 def check_running_job(job_uuid, worker_url, timeout):
+    # urllib.request takes long to import and it is used by the frontend only.
+    from urllib.request import urlopen
+
     job_status = None
     worker_info = None
     url = urljoin(worker_url, "/jobs/{:s}.json".format(job_uuid))
@@ -395,6 +451,18 @@ def setup_config():
     * LEAVE_SCHEMA;
     * LEAVE_JOBDIR;
     * SHOW_LOGO;
+    * RASTER_WORKERS;
+    * PG_WORKERS;
+    * STEP_WORKERS;
+    * STEP_CACHE_DIR;
+    * PG_CACHE_MAX_SIZE;
+    * S3_WORKERS;
+    * S3_DOWNLOAD_DIR;
+    * VSIZIP_CACHE_SIZE;
+    * WORKER_MAX_MEMORY;
+    * WORKER_MAX_CPUS;
+    * WORKER_POOL_SIZE;
+    * WORKER_POOL_RECYCLE;
     """
     config = {}
 
@@ -431,6 +499,38 @@ def setup_config():
     config["pg_user"] = environ.get("PG_USER", "qc_job")
     config["pg_database"] = environ.get("PG_DATABASE", "qc_tool_db")
 
+    ## Number of worker processes used by tiled raster checks.
+    config["raster_workers"] = int(environ.get("RASTER_WORKERS", RASTER_WORKERS))
+
+    ## Number of parallel database connections used by partitioned vector checks.
+    config["pg_workers"] = int(environ.get("PG_WORKERS", PG_WORKERS))
+
+    ## Number of worker processes running independent job steps concurrently.
+    config["step_workers"] = int(environ.get("STEP_WORKERS", STEP_WORKERS))
+
+    ## Directory of cached step results, re-submitted delivery reuses results of unchanged steps.
+    config["step_cache_dir"] = environ.get("STEP_CACHE_DIR", "")
+    if config["step_cache_dir"] == "":
+        config["step_cache_dir"] = None
+    else:
+        config["step_cache_dir"] = Path(config["step_cache_dir"])
+
+    ## Maximum size of postgis layer cache in bytes, 0 means no cache.
+    config["pg_cache_max_size"] = int(environ.get("PG_CACHE_MAX_SIZE", 0)) * 1024 ** 2
+
+    ## Number of threads downloading parts of the delivery from S3 storage.
+    config["s3_workers"] = int(environ.get("S3_WORKERS", S3_WORKERS))
+
+    ## Directory of partial S3 downloads, interrupted download is resumed after worker restart.
+    config["s3_download_dir"] = environ.get("S3_DOWNLOAD_DIR", "")
+    if config["s3_download_dir"] == "":
+        config["s3_download_dir"] = None
+    else:
+        config["s3_download_dir"] = Path(config["s3_download_dir"])
+
+    ## Size of GDAL cache in bytes for rasters read directly from the delivery zip file.
+    config["vsizip_cache_size"] = int(environ.get("VSIZIP_CACHE_SIZE", VSIZIP_CACHE_SIZE)) * 1024 ** 2
+
     ## Debugging parameters.
     config["leave_schema"] = environ.get("LEAVE_SCHEMA", "no") == "yes"
     config["leave_jobdir"] = environ.get("LEAVE_JOBDIR", "no") == "yes"
@@ -472,6 +572,19 @@ def setup_config():
     config["worker_port"] = int(environ.get("WORKER_PORT", WORKER_PORT))
     config["worker_addr"] = environ.get("WORKER_ADDR", WORKER_ADDR)
 
+    ## Memory in bytes and cpus available to the jobs of the worker, by default the whole machine.
+    config["worker_max_memory"] = int(environ.get("WORKER_MAX_MEMORY", 0)) * 1024 ** 2
+    if config["worker_max_memory"] == 0:
+        config["worker_max_memory"] = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    config["worker_max_cpus"] = int(environ.get("WORKER_MAX_CPUS", 0))
+    if config["worker_max_cpus"] == 0:
+        config["worker_max_cpus"] = os.cpu_count()
+
+    ## Number of warm job executors kept ready by the worker, 0 (default) means every job is launched as new process,
+    ## and the number of jobs the executor runs before it is replaced.
+    config["worker_pool_size"] = int(environ.get("WORKER_POOL_SIZE", WORKER_POOL_SIZE))
+    config["worker_pool_recycle"] = max(1, int(environ.get("WORKER_POOL_RECYCLE", WORKER_POOL_RECYCLE)))
+
     return config
 
 CONFIG = setup_config()
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.25 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0018_alter_delivery_size_bytes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='hash',
+            field=models.CharField(blank=True, default=None, max_length=128, null=True),
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='hash_mtime_ns',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0020_job_priority'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['job_status', 'product_ident', '-priority', 'date_created'], name='job_status_product_prio_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0021_job_status_product_prio_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='job',
+            name='job_status_product_prio_idx',
+        ),
+    ]
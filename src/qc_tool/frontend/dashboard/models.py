@@ -2,9 +2,16 @@
 
 
 from pathlib import Path
+from threading import Condition
 from uuid import uuid4
 
 import django.db.models as models
+from django.db import connection
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Window
+from django.db.models.functions import RowNumber
+from django.db import transaction
 from django.utils import timezone
 from django.contrib.auth.models import User
 
@@ -12,34 +19,191 @@ from django.contrib.auth.models import User
 from qc_tool.common import JOB_OK
 from qc_tool.common import JOB_RUNNING
 from qc_tool.common import JOB_WAITING
+from qc_tool.common import QCException
+from qc_tool.common import estimate_job_cost
+from qc_tool.common import get_product_type
+from qc_tool.common import load_product_definition
 from qc_tool.frontend.dashboard.helpers import find_product_description
 
 
-def pull_job(worker_url):
+# Number of the first waiting jobs of every user and product considered when looking for the next job.
+PULL_JOB_GROUP_CANDIDATES = 5
+
+# Number of recent jobs of the product the average runtime is computed from.
+JOB_RUNTIME_HISTORY = 20
+
+# Notified when a new job is waiting, so the pull_job requests waiting in this process wake up immediately.
+job_waiting_condition = Condition()
+
+
+def notify_job_waiting():
+    with job_waiting_condition:
+        job_waiting_condition.notify_all()
+
+
+def wait_job_waiting(timeout):
+    """Waits until a new job is created in this process or until timeout."""
+    with job_waiting_condition:
+        job_waiting_condition.wait(timeout)
+
+
+def get_waiting_marker():
+    """
+    Returns creation date of the newest waiting job, None if there is no waiting job.
+
+    The waiting pull_job request compares the marker instead of ranking all the waiting jobs again,
+    a job becomes waiting only when it is created, so a new job always changes the marker.
+    The query is served by the index on job status and creation date.
+    """
+    return (Job.objects.filter(job_status=JOB_WAITING)
+                       .order_by("-date_created")
+                       .values_list("date_created", flat=True)
+                       .first())
+
+
+def get_avg_runtime(product_ident):
+    """Returns average runtime in seconds of recent finished jobs of the product, None if there is no such job."""
+    runtimes = [(date_finished - date_started).total_seconds()
+                for date_started, date_finished in (Job.objects.filter(product_ident=product_ident,
+                                                                       job_status=JOB_OK,
+                                                                       date_started__isnull=False,
+                                                                       date_finished__isnull=False)
+                                                               .order_by("-date_finished")
+                                                               .values_list("date_started", "date_finished")
+                                                               [:JOB_RUNTIME_HISTORY])]
+    if len(runtimes) == 0:
+        return None
+    return sum(runtimes) / len(runtimes)
+
+
+def estimate_cost(job, product_types, avg_runtimes, job_cpus=None):
     """
-    UPDATE deliveries SET last_job_uuid=%s WHERE last_job_uuid IS NULL LIMIT 1
-    :return:
+    Estimates resources needed by the job.
+
+    :param product_types: cache of product types by product ident.
+    :param avg_runtimes: cache of average runtimes by product ident.
+    :param job_cpus: number of cpus used by one job on the worker by the product type.
+    """
+    if job.product_ident not in product_types:
+        try:
+            product_types[job.product_ident] = get_product_type(load_product_definition(job.product_ident))
+        except QCException:
+            product_types[job.product_ident] = "vector"
+    if job.product_ident not in avg_runtimes:
+        avg_runtimes[job.product_ident] = get_avg_runtime(job.product_ident)
+    return estimate_job_cost(product_types[job.product_ident],
+                             job.delivery.size_bytes,
+                             avg_runtimes[job.product_ident],
+                             job_cpus)
+
+
+def get_candidate_jobs():
     """
+    Returns the waiting jobs the next job is chosen from.
+
+    Only the first jobs of every user and product are considered,
+    so hundreds of jobs submitted by one user do not push the jobs of other users out of the candidates.
+    The jobs are numbered within their group by a window function, so all the groups are read by single query.
+    The group is keyed by the user of the delivery, so no index serves the window,
+    the query reads and sorts all the waiting jobs joined with their deliveries.
+    The cost grows with the number of waiting jobs, the waiting pull_job request therefore ranks the jobs
+    only when a new job has come, see get_waiting_marker().
+    """
+    group_nr = Window(expression=RowNumber(),
+                      partition_by=[F("delivery__user_id"), F("product_ident")],
+                      order_by=[F("priority").desc(), F("date_created").asc()])
+    candidate_jobs = (Job.objects.filter(job_status=JOB_WAITING)
+                                 .select_related("delivery")
+                                 .annotate(group_nr=group_nr)
+                                 .filter(group_nr__lte=PULL_JOB_GROUP_CANDIDATES))
+    return list(candidate_jobs)
+
 
-    # [:1] tells Django to add a " LIMIT 1" clause to the database query.
-    jobs = Job.objects.filter(job_status=JOB_WAITING).order_by("date_created")[:1]
+def get_running_counts(field):
+    """Returns the number of running jobs by the value of the field."""
+    return dict(Job.objects.filter(job_status=JOB_RUNNING)
+                           .order_by()
+                           .values_list(field)
+                           .annotate(count=Count("job_uuid")))
 
-    if len(jobs) == 1:
-        job = jobs.get()
 
-        # Safeguard against race condition. only return a non-null result if a row was updated in the database.
-        affected_rowcount = (Job.objects.filter(job_status=JOB_WAITING, job_uuid=job.job_uuid)
-                                        .update(job_status=JOB_RUNNING, date_started=timezone.now(), worker_url=worker_url))
+def rank_candidate_jobs(candidate_jobs, job_cpus=None, avg_runtimes=None):
+    """
+    Orders the candidate jobs by the order they should run.
+
+    The jobs are ordered by
+    * priority, the higher first;
+    * fair share, the jobs of the user and of the product with fewer running jobs first;
+    * expected runtime, the jobs of the products finishing sooner first, the smaller delivery first;
+    * date of creation, the older first.
+
+    :param job_cpus: number of cpus used by one job on the worker by the product type.
+    :param avg_runtimes: cache of average runtimes by product ident,
+                         it is kept by the caller while the pull request waits, so the runtimes are not queried again.
+    :return: list of tuples (job, estimated cost).
+    """
+    product_types = {}
+    if avg_runtimes is None:
+        avg_runtimes = {}
+    running_by_user = get_running_counts("delivery__user_id")
+    running_by_product = get_running_counts("product_ident")
+    ranked_jobs = []
+    for job in candidate_jobs:
+        cost = estimate_cost(job, product_types, avg_runtimes, job_cpus)
+        # The product with unknown runtime is run early, so its runtime is learned.
+        avg_runtime = avg_runtimes[job.product_ident] or 0
+        rank = (-job.priority,
+                running_by_user.get(job.delivery.user_id, 0),
+                running_by_product.get(job.product_ident, 0),
+                avg_runtime,
+                job.delivery.size_bytes,
+                job.date_created)
+        ranked_jobs.append((rank, job, cost))
+    ranked_jobs.sort(key=lambda item: item[0])
+    return [(job, cost) for rank, job, cost in ranked_jobs]
+
+
+def pull_job(worker_url, free_memory=None, free_cpus=None, job_cpus=None, avg_runtimes=None):
+    """
+    Claims the next waiting job for the worker.
+
+    The next job is chosen by rank_candidate_jobs().
+    If the free budget of the worker is given, the first job is claimed only if it fits into the budget.
+    The job not fitting is not bypassed by lower ranked jobs, otherwise a large job would wait forever
+    behind the stream of small jobs on busy workers. The worker then takes the job when its jobs finish.
+    The cpus of the job are estimated by job_cpus sent by the worker, see qc_tool.common.get_job_cpus().
+    The average runtimes of the products are cached in avg_runtimes, if it is given.
+    On PostgreSQL, the job row is locked by SELECT ... FOR UPDATE SKIP LOCKED,
+    so the job being claimed by concurrent worker is skipped instead of waiting for its lock.
+    Other databases (SQLite) fall back to conditional UPDATE.
+    :return: the claimed job with estimated cost in job.cost attribute
+             or None if there is no waiting job fitting into the budget.
+    """
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    for job, cost in rank_candidate_jobs(get_candidate_jobs(), job_cpus, avg_runtimes):
+        if free_memory is not None and cost["memory"] > free_memory:
+            return None
+        if free_cpus is not None and cost["cpus"] > free_cpus:
+            return None
+
+        with transaction.atomic():
+            claimable_jobs = Job.objects.filter(job_status=JOB_WAITING, job_uuid=job.job_uuid)
+            if skip_locked and len(claimable_jobs.select_for_update(skip_locked=True)) == 0:
+                # The job is being claimed by another worker.
+                continue
+            # Safeguard against race condition. only claim the job if a row was updated in the database.
+            # With the row locked, the update always succeeds.
+            affected_rowcount = claimable_jobs.update(job_status=JOB_RUNNING,
+                                                      date_started=timezone.now(),
+                                                      worker_url=worker_url)
 
         if affected_rowcount == 1:
             # The job is available.
             job = Job.objects.get(job_uuid=job.job_uuid)
+            job.cost = cost
             return job
-        else:
-            # The job has already been taken by another worker.
-            return None
-    else:
-        return None
+        # The job has already been taken by another worker.
+    return None
 
 
 class ApiUser(models.Model):
@@ -70,16 +234,18 @@ class Delivery(models.Model):
     def __str__(self):
         return "User: {:s} | File: {:s}".format(self.user.username, self.filename)
 
-    def create_job(self, product_ident, skip_steps):
+    def create_job(self, product_ident, skip_steps, priority=0):
 
         job = Job()
         job.date_created = timezone.now()
         job.job_status = JOB_WAITING
+        job.priority = priority
         job.product_ident = product_ident
         job.product_description = find_product_description(product_ident)
         job.skip_steps = skip_steps
         job.delivery = self
         job.save()
+        transaction.on_commit(notify_job_waiting)
 
         # Also update delivery-level default product ident and product description.
         self.product_ident = job.product_ident
@@ -106,6 +272,8 @@ class Delivery(models.Model):
     user = models.ForeignKey("auth.User", null=True, on_delete=models.CASCADE)
     filename = models.CharField(max_length=500)
     size_bytes = models.BigIntegerField()
+    hash = models.CharField(max_length=128, default=None, blank=True, null=True)
+    hash_mtime_ns = models.BigIntegerField(default=None, blank=True, null=True)
     date_uploaded = models.DateTimeField(default=timezone.now)
     date_submitted = models.DateTimeField(blank=True, null=True)
     product_ident = models.CharField(max_length=64, default=None, blank=True, null=True)
@@ -117,6 +285,7 @@ class Delivery(models.Model):
 class Job(models.Model):
     class Meta:
         app_label = "dashboard"
+        indexes = [models.Index(fields=["job_status", "date_created"], name="job_status_date_created_idx")]
 
     def __str__(self):
         return "{0} | {1} | {2}".format(str(self.job_uuid), self.delivery.filename, self.job_status)
@@ -133,6 +302,8 @@ class Job(models.Model):
     date_started = models.DateTimeField(blank=True, null=True)
     date_finished = models.DateTimeField(blank=True, null=True)
     job_status = models.CharField(max_length=64, default=JOB_WAITING)
+    # Jobs with higher priority run first.
+    priority = models.IntegerField(default=0)
     product_ident = models.CharField(max_length=64)
     product_description = models.CharField(max_length=500)
     skip_steps = models.CharField(max_length=100, default=None, blank=True, null=True)
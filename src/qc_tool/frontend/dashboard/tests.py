@@ -1,6 +1,164 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.utils import timezone
+
+import qc_tool.frontend.dashboard.models as models
+import qc_tool.frontend.dashboard.views as views
+from qc_tool.common import JOB_OK
+from qc_tool.common import JOB_RUNNING
+from qc_tool.common import JOB_WAITING
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("user_a")
+        self.delivery = models.Delivery.objects.create(user=self.user, filename="delivery.zip", size_bytes=1000)
+        self.now = timezone.now()
+
+    def create_job(self, delivery=None, product_ident="product_a", priority=0, age=0):
+        """Creates waiting job, the job created age seconds ago."""
+        return models.Job.objects.create(delivery=self.delivery if delivery is None else delivery,
+                                         date_created=self.now - timedelta(seconds=age),
+                                         job_status=JOB_WAITING,
+                                         priority=priority,
+                                         product_ident=product_ident,
+                                         product_description="")
+
+
+class Test_pull_job(JobQueueTestCase):
+    def test_claim(self):
+        job_1 = self.create_job(age=20)
+        job_2 = self.create_job(age=10)
+
+        job = models.pull_job("http://worker/")
+        self.assertEqual(job_1.job_uuid, job.job_uuid)
+        self.assertEqual(JOB_RUNNING, job.job_status)
+        self.assertEqual("http://worker/", job.worker_url)
+        self.assertIsNotNone(job.date_started)
+        self.assertIn("memory", job.cost)
+
+        self.assertEqual(job_2.job_uuid, models.pull_job("http://worker/").job_uuid)
+        self.assertIsNone(models.pull_job("http://worker/"))
+
+    def test_budget(self):
+        from qc_tool.common import JOB_BASE_MEMORY
+        small_job = self.create_job(age=20)
+        large_delivery = models.Delivery.objects.create(user=self.user, filename="large.zip", size_bytes=10 ** 9)
+        large_job = self.create_job(delivery=large_delivery, priority=1, age=10)
+
+        # The large job outranks the small one, so the busy worker without enough memory does not bypass it.
+        self.assertIsNone(models.pull_job("http://worker/", free_memory=JOB_BASE_MEMORY * 2, free_cpus=8))
+        self.assertIsNone(models.pull_job("http://worker/", free_memory=JOB_BASE_MEMORY * 100, free_cpus=0))
+        self.assertEqual(large_job.job_uuid,
+                         models.pull_job("http://worker/", free_memory=JOB_BASE_MEMORY * 100, free_cpus=8).job_uuid)
+        self.assertEqual(small_job.job_uuid,
+                         models.pull_job("http://worker/", free_memory=JOB_BASE_MEMORY * 2, free_cpus=8).job_uuid)
+
+    def test_budget_idle(self):
+        large_delivery = models.Delivery.objects.create(user=self.user, filename="large.zip", size_bytes=10 ** 12)
+        large_job = self.create_job(delivery=large_delivery)
+        # Idle worker sends no budget and takes even the job larger than its whole capacity.
+        self.assertEqual(large_job.job_uuid, models.pull_job("http://worker/").job_uuid)
+
+    def test_waiting_marker(self):
+        self.assertIsNone(models.get_waiting_marker())
+        self.create_job(age=20)
+        job = self.create_job(age=10)
+        self.assertEqual(job.date_created, models.get_waiting_marker())
+
+
+class Test_rank_candidate_jobs(JobQueueTestCase):
+    def rank(self):
+        return [job.job_uuid for job, cost in models.rank_candidate_jobs(models.get_candidate_jobs())]
+
+    def test_priority(self):
+        old_job = self.create_job(age=20)
+        priority_job = self.create_job(priority=1, age=10)
+        self.assertListEqual([priority_job.job_uuid, old_job.job_uuid], self.rank())
+
+    def test_fair_share(self):
+        running_job = self.create_job(age=30)
+        models.Job.objects.filter(job_uuid=running_job.job_uuid).update(job_status=JOB_RUNNING)
+        job_a = self.create_job(product_ident="product_b", age=20)
+        delivery_b = models.Delivery.objects.create(user=User.objects.create_user("user_b"),
+                                                    filename="delivery.zip",
+                                                    size_bytes=1000)
+        job_b = self.create_job(delivery=delivery_b, product_ident="product_b", age=10)
+        # User b has no running job, so its newer job goes first.
+        self.assertListEqual([job_b.job_uuid, job_a.job_uuid], self.rank())
+
+    def test_runtime(self):
+        for product_ident, runtime in (("product_fast", 100), ("product_slow", 1000)):
+            finished_job = self.create_job(product_ident=product_ident, age=5000)
+            models.Job.objects.filter(job_uuid=finished_job.job_uuid).update(
+                job_status=JOB_OK,
+                date_started=self.now - timedelta(seconds=runtime),
+                date_finished=self.now)
+        slow_job = self.create_job(product_ident="product_slow", age=20)
+        fast_job = self.create_job(product_ident="product_fast", age=10)
+        # The product with unknown runtime goes first, so its runtime is learned.
+        new_job = self.create_job(product_ident="product_new", age=5)
+        self.assertListEqual([new_job.job_uuid, fast_job.job_uuid, slow_job.job_uuid], self.rank())
+
+    def test_size(self):
+        large_delivery = models.Delivery.objects.create(user=self.user, filename="large.zip", size_bytes=10 ** 6)
+        large_job = self.create_job(delivery=large_delivery, age=20)
+        small_job = self.create_job(age=10)
+        self.assertListEqual([small_job.job_uuid, large_job.job_uuid], self.rank())
+
+    def test_group_candidates(self):
+        for age in range(10, 10 + models.PULL_JOB_GROUP_CANDIDATES + 2):
+            self.create_job(age=age)
+        delivery_b = models.Delivery.objects.create(user=User.objects.create_user("user_b"),
+                                                    filename="delivery.zip",
+                                                    size_bytes=1000)
+        job_b = self.create_job(delivery=delivery_b)
+        candidate_jobs = models.get_candidate_jobs()
+        self.assertEqual(models.PULL_JOB_GROUP_CANDIDATES + 1, len(candidate_jobs))
+        self.assertIn(job_b.job_uuid, [job.job_uuid for job in candidate_jobs])
+        # The oldest jobs of the group are the candidates.
+        self.assertEqual(self.now - timedelta(seconds=10 + models.PULL_JOB_GROUP_CANDIDATES + 1),
+                         min(job.date_created for job in candidate_jobs))
+
+
+class Test_api_create_job(JobQueueTestCase):
+    def test_priority_bool(self):
+        import json
+        self.user.is_staff = True
+        self.user.save()
+        models.ApiUser.objects.create(user=self.user, api_key="api_key")
+        body = {"delivery_id": self.delivery.id, "product_ident": "clc2018", "priority": True}
+        response = self.client.post("/api/create-job?apikey=api_key", json.dumps(body), content_type="application/json")
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("priority must be an integer", response.json()["message"])
+        self.assertEqual(0, models.Job.objects.count())
+
+
+@patch.object(views, "auth_worker", lambda token: True)
+@patch.object(views, "PULL_JOB_RECHECK_INTERVAL", 0.05)
+class Test_pull_job_view(JobQueueTestCase):
+    def test_no_job(self):
+        with patch.object(models, "pull_job", wraps=models.pull_job) as pull_job_mock:
+            response = self.client.get("/pull_job", {"token": "token", "wait": 0.3})
+        self.assertIsNone(response.json())
+        # Nothing has changed while waiting, so the jobs are not ranked again.
+        self.assertEqual(1, pull_job_mock.call_count)
+
+    def test_new_job(self):
+        created_jobs = []
+
+        def create_job_while_waiting(timeout):
+            if len(created_jobs) == 0:
+                created_jobs.append(self.create_job())
 
-# Create your tests here.
+        with patch.object(models, "wait_job_waiting", create_job_while_waiting), \
+             patch.object(models, "pull_job", wraps=models.pull_job) as pull_job_mock:
+            response = self.client.get("/pull_job", {"token": "token", "wait": 5})
+        self.assertEqual(str(created_jobs[0].job_uuid), response.json()["job_uuid"])
+        self.assertEqual(2, pull_job_mock.call_count)
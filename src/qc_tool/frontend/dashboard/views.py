@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 
+import hashlib
 import io
 import logging
 import os
@@ -8,6 +9,7 @@ import sys
 import shutil
 import time
 import traceback
+from functools import partial
 from pathlib import Path
 import uuid
 from zipfile import ZipFile
@@ -41,6 +43,8 @@ import qc_tool.frontend.dashboard.models as models
 from qc_tool.common import QCException, auth_worker, get_product_definitions, validate_skip_steps
 from qc_tool.common import check_running_job
 from qc_tool.common import CONFIG
+from qc_tool.common import HASH_ALGORITHM
+from qc_tool.common import HASH_BUFFER_SIZE
 from qc_tool.common import JOB_RUNNING
 from qc_tool.common import JOB_WAITING
 from qc_tool.common import compose_attachment_filepath
@@ -67,6 +71,12 @@ CHECK_RUNNING_JOB_DELAY = 10
 
 UPLOADED_CHUNK_PROCESSING_DELAY = 1
 
+# Maximum time in seconds the pull_job request waits for a job.
+PULL_JOB_MAX_WAIT = 60
+
+# Interval in seconds of checking the jobs created by other frontend processes while pull_job request waits.
+PULL_JOB_RECHECK_INTERVAL = 2
+
 def check_api_key(request):
     api_key = request.GET.get("apikey")
     user = None
@@ -350,7 +360,16 @@ def api_create_job(request):
             delivery_id, user.username)}
         return JsonResponse(result, status=401)
 
-    job_uuid = d.create_job(product_ident, skip_steps)
+    # Only staff users may prioritise their jobs.
+    priority = body_json.get("priority", 0)
+    if priority != 0:
+        if not user.is_staff:
+            return JsonResponse({"status": "error", "message": "only staff users may set priority"}, status=403)
+        # JSON true is decoded to bool, which is a subclass of int.
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            return JsonResponse({"status": "error", "message": "priority must be an integer"}, status=400)
+
+    job_uuid = d.create_job(product_ident, skip_steps, priority)
 
     response_data = {"job_uuid": str(job_uuid)}
     result = {"status": "OK", "message": "QC job successfully created", "data": response_data}
@@ -1444,15 +1463,45 @@ def create_job(request):
     return JsonResponse(result)
 
 def pull_job(request):
+    """
+    Hands the oldest waiting job to the worker.
+
+    If the wait parameter is set, the request is held for up to that many seconds until a job is available,
+    so the workers need not poll repeatedly.
+    """
     try:
         token = request.GET.get("token")
         if not auth_worker(token):
             return HttpResponse(status=401)
+        wait = min(float(request.GET.get("wait", 0)), PULL_JOB_MAX_WAIT)
+        free_memory = request.GET.get("free_memory")
+        free_memory = None if free_memory is None else int(free_memory)
+        free_cpus = request.GET.get("free_cpus")
+        free_cpus = None if free_cpus is None else int(free_cpus)
+        # Workers of older versions do not send their per job parallelism.
+        job_cpus = None
+        if "raster_cpus" in request.GET and "vector_cpus" in request.GET:
+            job_cpus = {"raster": int(request.GET["raster_cpus"]),
+                        "vector": int(request.GET["vector_cpus"])}
     except:
         return HttpResponse(status=400)
     worker_port = CONFIG.get("worker_port", WORKER_PORT)
     worker_url = "http://{:s}:{:d}/".format(request.META["REMOTE_ADDR"], worker_port)
-    job = models.pull_job(worker_url)
+    wait_until = time.monotonic() + wait
+    # The average runtimes of the products are queried once for the whole wait.
+    avg_runtimes = {}
+    waiting_marker = models.get_waiting_marker()
+    job = models.pull_job(worker_url, free_memory, free_cpus, job_cpus, avg_runtimes)
+    while job is None and time.monotonic() < wait_until:
+        # Jobs created by this process wake the request up immediately,
+        # jobs created by other processes are found by the periodic recheck.
+        models.wait_job_waiting(min(PULL_JOB_RECHECK_INTERVAL, wait_until - time.monotonic()))
+        # The waiting jobs are ranked again only if a new job has come, the recheck itself is a cheap indexed query.
+        new_waiting_marker = models.get_waiting_marker()
+        if new_waiting_marker == waiting_marker:
+            continue
+        waiting_marker = new_waiting_marker
+        job = models.pull_job(worker_url, free_memory, free_cpus, job_cpus, avg_runtimes)
     if job is None:
         response = None
     else:
@@ -1460,7 +1509,14 @@ def pull_job(request):
                     "product_ident": job.product_ident,
                     "username": job.delivery.user.username,
                     "filename": job.delivery.filename,
-                    "skip_steps": job.skip_steps}
+                    "skip_steps": job.skip_steps,
+                    "cost": job.cost}
+        if job.delivery.hash is not None:
+            response.update({
+                 "delivery_hash": job.delivery.hash,
+                 "delivery_size": job.delivery.size_bytes,
+                 "delivery_mtime_ns": job.delivery.hash_mtime_ns
+            })
         if job.delivery.s3:
             response.update({
                  "s3_host": job.delivery.s3.host,
@@ -1476,14 +1532,27 @@ def get_chunk_name(uploaded_filename, chunk_number):
     return uploaded_filename + "_part_{:03d}".format(chunk_number)
 
 def merge_uploaded_chunks(chunk_paths, target_filepath):
+    """
+    Merges the uploaded chunks into the target file.
+
+    The hash of the file is computed while the chunks are copied,
+    so the worker need not read the whole delivery again.
+    :return: hash of the merged file.
+    """
+    h = hashlib.new(HASH_ALGORITHM)
     with open(str(target_filepath), "ab+") as target_file:
+        # Hash the content already present in the target file.
+        target_file.seek(0)
+        for buf in iter(partial(target_file.read, HASH_BUFFER_SIZE), b""):
+            h.update(buf)
         for stored_chunk_filepath in chunk_paths:
-            stored_chunk_file = open(str(stored_chunk_filepath), "rb")
-            target_file.write(stored_chunk_file.read())
-            stored_chunk_file.close()
+            with open(str(stored_chunk_filepath), "rb") as stored_chunk_file:
+                for buf in iter(partial(stored_chunk_file.read, HASH_BUFFER_SIZE), b""):
+                    h.update(buf)
+                    target_file.write(buf)
             stored_chunk_filepath.unlink()
-    target_file.close()
     logger.debug("Uploaded file saved to: " + str(target_filepath))
+    return h.hexdigest()
 
 
 def remove_old_chunks(chunks_dir):
@@ -1603,7 +1672,7 @@ def resumable_upload(request):
                 logger.info("Creating a directory for user-incoming files: {:s}.".format(str(user_incoming_path)))
                 user_incoming_path.mkdir(parents=True, exist_ok=True)
             target_filepath = user_incoming_path.joinpath(resumableFilename)
-            merge_uploaded_chunks(chunk_paths, target_filepath)
+            delivery_hash = merge_uploaded_chunks(chunk_paths, target_filepath)
 
             # Assign product description based on product ident.
             # Typically, the product ident is used as the zip filename prefix.
@@ -1615,7 +1684,10 @@ def resumable_upload(request):
             d = models.Delivery()
             d.filename = target_filepath.name
             d.filepath = user_incoming_path
-            d.size_bytes = target_filepath.stat().st_size
+            target_stat = target_filepath.stat()
+            d.size_bytes = target_stat.st_size
+            d.hash = delivery_hash
+            d.hash_mtime_ns = target_stat.st_mtime_ns
             d.product_ident = product_ident
             d.product_description = product_description
             d.date_uploaded = timezone.now()
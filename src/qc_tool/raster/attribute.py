@@ -29,10 +29,17 @@ def read_gtiff_attributes(gtiff_filepath):
 
 def run_check(params, status):
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import extract_local_files
+    from qc_tool.raster.helper import get_gdal_config
+    from qc_tool.raster.helper import get_gdal_path
+    from qc_tool.translate import config_options
 
     for layer_def in do_raster_layers(params):
-        attr_names = read_gtiff_attributes(layer_def["src_filepath"])
+        with config_options(get_gdal_config(params)):
+            attr_names = read_gtiff_attributes(get_gdal_path(layer_def["src_filepath"], params))
         if attr_names is None:
+            # The .vat.dbf file is read as a local file.
+            extract_local_files(params, [layer_def["src_filepath"]])
             # check for .vat.dbf file existence
             dbf_filename = "{:s}.vat.dbf".format(layer_def["src_filepath"].name)
             dbf_filepath = layer_def["src_filepath"].with_name(dbf_filename)
@@ -11,12 +11,13 @@ def run_check(params, status):
     import re
 
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import get_gdal_path
 
     for layer_def in do_raster_layers(params):
 
         status.info("Using GDAL COG validator.")
         qc_tool_raster_dir = os.path.dirname(__file__)
-        cmd = ["python3", os.path.join(qc_tool_raster_dir, "validate_cloud_optimized_geotiff.py"), "--full-check=yes", str(layer_def["src_filepath"])]
+        cmd = ["python3", os.path.join(qc_tool_raster_dir, "validate_cloud_optimized_geotiff.py"), "--full-check=yes", get_gdal_path(layer_def["src_filepath"], params)]
         try:
             cog_validation_output = str(subprocess.check_output(cmd, stderr=subprocess.STDOUT))
         except subprocess.CalledProcessError as e:
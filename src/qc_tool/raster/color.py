@@ -49,12 +49,17 @@ def parse_gtif_file(gtif_filepath):
 def run_check(params, status):
     import osgeo.gdal as gdal
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import extract_local_files
+    from qc_tool.raster.helper import get_gdal_config
+    from qc_tool.raster.helper import get_gdal_path
+    from qc_tool.raster.helper import open_raster
+    from qc_tool.translate import config_options
 
     for layer_def in do_raster_layers(params):
 
         geotiff_name = layer_def["src_filepath"].name
 
-        ds = gdal.Open(str(layer_def["src_filepath"]))
+        ds = open_raster(layer_def["src_filepath"], params)
         band = ds.GetRasterBand(1)
         bit_depth = str(gdal.GetDataTypeName(band.DataType)).lower()
 
@@ -109,8 +114,11 @@ def run_check(params, status):
             continue
 
         # Try to get internal GTIFF color table
-        actual_colors = parse_gtif_file(layer_def["src_filepath"])
+        with config_options(get_gdal_config(params)):
+            actual_colors = parse_gtif_file(get_gdal_path(layer_def["src_filepath"], params))
         if actual_colors is None:
+            # The .clr file is read as a local file.
+            extract_local_files(params, [layer_def["src_filepath"]])
 
             # Check existence of a .tif.clr or .clr file.
             clr_name1 = str(layer_def["src_filepath"]).replace(".tif", ".clr")
@@ -8,16 +8,27 @@ IS_SYSTEM = False
 
 def run_check(params, status):
     import osgeo.gdal as gdal
-    from qc_tool.raster.helper import do_raster_layers
 
-    # enable gdal to use exceptions
+    # enable gdal to use exceptions, the previous mode is restored at the end,
+    # the other checks expect gdal.Open() returning None.
+    use_exceptions = gdal.GetUseExceptions()
     gdal.UseExceptions()
+    try:
+        check_compression(params, status)
+    finally:
+        if not use_exceptions:
+            gdal.DontUseExceptions()
+
+
+def check_compression(params, status):
+    from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import open_raster
 
     # set compression type names to lowercase
     allowed_compression_types = [c.lower() for c in params["compression"]]
 
     for layer_def in do_raster_layers(params):
-        ds = gdal.Open(str(layer_def["src_filepath"]))
+        ds = open_raster(layer_def["src_filepath"], params)
 
         # get raster metadata
         meta = ds.GetMetadata("IMAGE_STRUCTURE")
@@ -4,16 +4,17 @@
 
 DESCRIPTION = "Raster uses specific EPSG code."
 IS_SYSTEM = False
+PROVIDES = ("detected_epsg",)
 
 
 def run_check(params, status):
-    import osgeo.gdal as gdal
     import osgeo.osr as osr
 
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import open_raster
 
     for layer_def in do_raster_layers(params):
-        ds = gdal.Open(str(layer_def["src_filepath"]))
+        ds = open_raster(layer_def["src_filepath"], params)
 
         srs = osr.SpatialReference(ds.GetProjection())
         if srs is None or srs.IsProjected() == 0:
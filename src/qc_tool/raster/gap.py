@@ -7,18 +7,93 @@ IS_SYSTEM = False
 
 MASK_ALIGN_GRID = 1000
 
-def run_check(params, status):
-    import subprocess
+# Per-process context of the tile worker, filled by _init_tile_worker().
+_tile_ctx = {}
+
+
+def _init_tile_worker(src_filepath, gdal_config, mask_filepath, gap_value_ds, gap_ds_filepath_tpl):
+    import osgeo.gdal as gdal
+
+    from qc_tool.translate import config_options
+
+    with config_options(gdal_config):
+        _tile_ctx["ds"] = gdal.Open(str(src_filepath))
+    _tile_ctx["mask_ds"] = gdal.Open(str(mask_filepath))
+    _tile_ctx["gap_value_ds"] = gap_value_ds
+    _tile_ctx["gap_ds_filepath_tpl"] = gap_ds_filepath_tpl
+
+
+def _check_tile(tile_no, tile):
+    """
+    Compares one tile of the mask with the checked raster.
+    :return: tuple (gap_count, gap_ds_filepath), gap_count is None if the tile is outside of the mask.
+    """
     import numpy
     import osgeo.gdal as gdal
     import osgeo.osr as osr
 
+    from qc_tool.raster.helper import read_tile
+
+    ds = _tile_ctx["ds"]
+    mask_ds = _tile_ctx["mask_ds"]
+    gap_value_ds = _tile_ctx["gap_value_ds"]
+    mask_band = mask_ds.GetRasterBand(1)
+    nodata_value_mask = mask_band.GetNoDataValue()
+    mask_gt = mask_ds.GetGeoTransform()
+    mask_xres = mask_gt[1]
+    mask_yres = mask_gt[5]
+
+    # reading the mask data into Numpy array
+    arr_mask = mask_band.ReadAsArray(tile.x_offset, tile.y_offset, tile.ncols, tile.nrows)
+
+    # If mask has all values unmapped then mask / raster comparison can be skipped.
+    if numpy.max(arr_mask) == 0 or numpy.min(arr_mask) == nodata_value_mask:
+        return (None, None)
+
+    if tile.position == "outside":
+        # Current tile is completely outside the bounds of the checked raster.
+        arr_gaps = (arr_mask == 1)
+    else:
+        # Current tile is completely or partially inside the bounds of the checked raster.
+        arr_ds = read_tile(ds, tile, gap_value_ds)
+        arr_gaps = ((arr_mask == 1) * (arr_ds == gap_value_ds))
+
+    # find unmapped pixels inside mask
+    gap_count = int(numpy.sum(arr_gaps))
+    if gap_count == 0:
+        return (0, None)
+
+    # For each mask tile with gaps, create a new warning raster dataset.
+    # These datasets can be merged or polygonized at the end of the run.
+    gap_ds_filepath = _tile_ctx["gap_ds_filepath_tpl"].format(tile_no)
+    driver = gdal.GetDriverByName('GTiff')
+    gap_ds = driver.Create(gap_ds_filepath, tile.ncols, tile.nrows, 1, gdal.GDT_Byte, ['COMPRESS=LZW'])
+    gap_ds.SetGeoTransform([tile.xmin, mask_xres, 0, tile.ymax, 0, mask_yres])
+    gap_sr = osr.SpatialReference()
+    gap_sr.ImportFromWkt(ds.GetProjectionRef())
+    gap_ds.SetProjection(gap_sr.ExportToWkt())
+    gap_band = gap_ds.GetRasterBand(1)
+    gap_band.SetNoDataValue(0)
+    gap_band.WriteArray(arr_gaps.astype("byte"), 0, 0)
+    gap_ds.FlushCache()
+    gap_ds = None
+    return (gap_count, gap_ds_filepath)
+
+
+def run_check(params, status):
+    import osgeo.gdal as gdal
+
     from qc_tool.raster.helper import do_raster_layers
     from qc_tool.raster.helper import find_tiles
+    from qc_tool.raster.helper import get_gdal_config
+    from qc_tool.raster.helper import get_gdal_path
+    from qc_tool.raster.helper import map_tiles
     from qc_tool.raster.helper import rasterize_mask
-    from qc_tool.raster.helper import read_tile
     from qc_tool.raster.helper import write_progress
     from qc_tool.raster.helper import write_percent
+    from qc_tool.translate import build_vrt
+    from qc_tool.translate import config_options
+    from qc_tool.translate import translate
 
 
     aoi_code = params["aoi_code"].lower()
@@ -26,6 +101,10 @@ def run_check(params, status):
     du_column_name = params.get("du_column_name", None)
     mask_align_grid = params.get("mask_align_grid", MASK_ALIGN_GRID)
 
+    # Number of worker processes comparing the tiles.
+    # The product definition may set the number explicitly, otherwise the worker configuration applies.
+    workers = params.get("workers", params.get("raster_workers", 1))
+
     # Find the external boundary raster mask layer.
     raster_boundary_dir = params["boundary_dir"].joinpath("raster")
     vector_boundary_dir = params["boundary_dir"].joinpath("vector")
@@ -44,7 +123,10 @@ def run_check(params, status):
         percent_filepath = params["output_dir"].joinpath(percent_filename)
 
         # get raster corners and resolution
-        ds = gdal.Open(str(layer_def["src_filepath"]))
+        src_path = get_gdal_path(layer_def["src_filepath"], params)
+        gdal_config = get_gdal_config(params)
+        with config_options(gdal_config):
+            ds = gdal.Open(src_path)
         ds_gt = ds.GetGeoTransform()
         ds_ulx = ds_gt[0]
         ds_xres = ds_gt[1]
@@ -73,8 +155,6 @@ def run_check(params, status):
         if mask_ds is None:
             status.failed("Check cancelled due to boundary mask file {:s} not available.".format(mask_file.name))
             return
-        mask_band = mask_ds.GetRasterBand(1)
-        nodata_value_mask = mask_band.GetNoDataValue()
 
         # get aoi mask corners and resolution
         mask_gt = mask_ds.GetGeoTransform()
@@ -143,56 +223,24 @@ def run_check(params, status):
         gap_count_total = 0
         num_tiles = len(tiles)
         gap_filepaths = []
-        for tile_no, tile in enumerate(tiles):
-
-            write_progress(progress_filepath, "Processing tile {}/{} ({}).".format(tile_no + 1, len(tiles), tile.position))
+        src_stem = layer_def["src_filepath"].stem
+        gap_ds_filename_tpl = "s{:02d}_{:s}_gap_warning_{{:d}}.tif".format(params["step_nr"], src_stem)
+        gap_ds_filepath_tpl = str(params["tmp_dir"].joinpath(gap_ds_filename_tpl))
+        if report_progress:
+            write_progress(progress_filepath, "Number of workers: {:d}".format(workers))
 
-            # reading the mask data into Numpy array
-            mask_xoff = tile.x_offset
-            mask_yoff = tile.y_offset
-            blocksize_x = tile.ncols
-            blocksize_y = tile.nrows
-            arr_mask = mask_band.ReadAsArray(mask_xoff, mask_yoff, blocksize_x, blocksize_y)
+        # The tiles are processed in parallel, the results are merged in the order of the tiles.
+        tile_results = map_tiles(_check_tile, tiles, workers,
+                                 initializer=_init_tile_worker,
+                                 initargs=(src_path, gdal_config, mask_file, gap_value_ds, gap_ds_filepath_tpl))
+        for tile_no, (tile, (gap_count, gap_ds_filepath)) in enumerate(zip(tiles, tile_results)):
 
-            # If mask has all values unmapped then mask / raster comparison can be skipped.
-            if numpy.max(arr_mask) == 0 or numpy.min(arr_mask) == nodata_value_mask:
+            if gap_count is None:
                 write_progress(progress_filepath, "Tile {} has all values outside of mask, skipping.".format(tile_no + 1))
                 continue
 
-            if tile.position == "outside":
-                # Current tile is completely outside the bounds of the checked raster.
-                write_progress(progress_filepath, "tile_position: outside.")
-                arr_gaps = (arr_mask == 1)
-            elif tile.position == "inside":
-                # Current tile is completely inside the bounds of the checked raster.
-                arr_ds = read_tile(ds, tile, gap_value_ds)
-                arr_gaps = ((arr_mask == 1) * (arr_ds == gap_value_ds))
-            else:
-                # Current tile is partially inside and partially outside the bounds of the checked raster.
-                arr_ds = read_tile(ds, tile, gap_value_ds)
-                arr_gaps = ((arr_mask == 1) * (arr_ds == gap_value_ds))
-
-            # find unmapped pixels inside mask
-            gap_count = int(numpy.sum(arr_gaps))
             if gap_count > 0:
-
-                # For each mask tile with gaps, create a new warning raster dataset.
-                # These datasets can be merged or polygonized at the end of the run.
-                src_stem = layer_def["src_filepath"].stem
-                gap_ds_filename = "s{:02d}_{:s}_gap_warning_{:d}.tif".format(params["step_nr"], src_stem, tile_no)
-                gap_ds_filepath = params["tmp_dir"].joinpath(gap_ds_filename)
-                driver = gdal.GetDriverByName('GTiff')
-                gap_ds = driver.Create(str(gap_ds_filepath), blocksize_x, blocksize_y, 1, gdal.GDT_Byte, ['COMPRESS=LZW'])
-                gap_ds.SetGeoTransform([tile.xmin, mask_xres, 0, tile.ymax, 0, mask_yres])
-                gap_sr = osr.SpatialReference()
-                gap_sr.ImportFromWkt(ds.GetProjectionRef())
-                gap_ds.SetProjection(gap_sr.ExportToWkt())
-                gap_band = gap_ds.GetRasterBand(1)
-                gap_band.SetNoDataValue(0)
-                gap_band.WriteArray(arr_gaps.astype("byte"), 0, 0)
-                gap_ds.FlushCache()
-                gap_ds = None
-                gap_filepaths.append(str(gap_ds_filepath))
+                gap_filepaths.append(gap_ds_filepath)
                 gap_count_total += gap_count
 
             if report_progress:
@@ -200,7 +248,7 @@ def run_check(params, status):
                 write_progress(progress_filepath, msg)
                 progress_percent = int(100 * (tile_no / num_tiles))
                 write_percent(percent_filepath, progress_percent)
-
+        _tile_ctx.clear()
 
         # Free memory for checked raster and for mask.
         ds = None
@@ -214,10 +262,9 @@ def run_check(params, status):
             warning_vrt_filepath = params["tmp_dir"].joinpath(warning_vrt_filename)
 
             if len(gap_filepaths) > 0:
-                cmd = ["gdalbuildvrt", str(warning_vrt_filepath)]
-                cmd = cmd + gap_filepaths
-                write_progress(progress_filepath, " ".join(cmd))
-                subprocess.run(cmd)
+                write_progress(progress_filepath, "Building {:s} from {:d} tile gap rasters."
+                               .format(warning_vrt_filepath.name, len(gap_filepaths)))
+                build_vrt(str(warning_vrt_filepath), gap_filepaths)
                 status.failed("Layer {:s} has {:d} gap pixels in the mapped area."
                             .format(layer_def["src_layer_name"], gap_count_total))
 
@@ -225,12 +272,9 @@ def run_check(params, status):
             if warning_vrt_filepath.is_file():
                 warning_tif_filename = "s{:02d}_{:s}_gap_warning.tif".format(params["step_nr"], src_stem)
                 warning_tif_filepath = params["output_dir"].joinpath(warning_tif_filename)
-                cmd = ["gdal_translate",
-                       "-of", "GTiff",
-                       "-ot", "Byte",
-                       "-co", "TILED=YES",
-                       "-co", "COMPRESS=LZW",
-                       str(warning_vrt_filepath),
-                       str(warning_tif_filepath)]
-                subprocess.run(cmd)
+                options = ["-of", "GTiff",
+                           "-ot", "Byte",
+                           "-co", "TILED=YES",
+                           "-co", "COMPRESS=LZW"]
+                translate(str(warning_tif_filepath), str(warning_vrt_filepath), options)
                 status.add_attachment(warning_tif_filepath.name)
@@ -4,14 +4,14 @@ import sys
 from collections import namedtuple
 from math import floor
 from math import ceil
-from subprocess import run
-import numpy
 
 BLOCKSIZE = 2048
 
 
 Tile = namedtuple("Tile", ["xmin", "ymin", "xmax", "ymax", "position", "x_offset", "y_offset", "ncols", "nrows"])
 
+RasterStats = namedtuple("RasterStats", ["histogram", "min", "max", "nodata_value", "nodata_count", "valid_count"])
+
 
 def do_raster_layers(params):
     if "layers" in params:
@@ -20,6 +20,91 @@ def do_raster_layers(params):
         return params["raster_layer_defs"].values()
 
 
+def get_gdal_path(src_filepath, params):
+    """
+    Returns the path the raster is opened by GDAL.
+
+    If the delivery has not been extracted (raster.unzip with vsizip parameter),
+    the /vsizip/ path into the delivery zip file is returned, unless the file has been extracted meanwhile.
+    The path should be opened with the config options of get_gdal_config(), see open_raster().
+    """
+    zip_filepath = params.get("vsizip_filepath")
+    if zip_filepath is None or src_filepath.exists():
+        return str(src_filepath)
+    try:
+        member_path = src_filepath.relative_to(params["unzip_dir"])
+    except ValueError:
+        return str(src_filepath)
+    return "/vsizip/{:s}/{:s}".format(str(zip_filepath), member_path.as_posix())
+
+
+def get_gdal_config(params):
+    """
+    Returns GDAL config options for opening the paths returned by get_gdal_path().
+
+    The options are read by GDAL when the file is opened, so they are set only around the open
+    by qc_tool.translate.config_options() and do not leak into other opens of the process.
+    """
+    if params.get("vsizip_filepath") is None:
+        return {}
+    # Blocks read from the zip file are cached, so the checks reading the raster by tiles
+    # do not seek in the compressed stream again and again.
+    config = {"VSI_CACHE": "TRUE"}
+    if "vsizip_cache_size" in params:
+        config["VSI_CACHE_SIZE"] = str(params["vsizip_cache_size"])
+    return config
+
+
+def open_raster(src_filepath, params):
+    """Opens the raster by GDAL at get_gdal_path() with get_gdal_config() options."""
+    import osgeo.gdal as gdal
+    from qc_tool.translate import config_options
+
+    with config_options(get_gdal_config(params)):
+        return gdal.Open(get_gdal_path(src_filepath, params))
+
+
+def extract_local_files(params, src_filepaths=None, with_supplementary=True):
+    """
+    Extracts the members of the delivery zip file needed by the check as local files.
+
+    It is needed only if the delivery has not been extracted by raster.unzip (vsizip parameter).
+    :param src_filepaths: the files to be extracted, if None, all members are extracted.
+    :param with_supplementary: if True, supplementary files of src_filepaths are extracted too,
+        eg. .tif.vat.dbf or .clr.
+    """
+    import os
+    import shutil
+    from pathlib import PurePosixPath
+    from zipfile import ZipFile
+
+    zip_filepath = params.get("vsizip_filepath")
+    if zip_filepath is None:
+        return
+    unzip_dir = params["unzip_dir"]
+    with ZipFile(str(zip_filepath)) as zip_file:
+        for member in zip_file.infolist():
+            if member.is_dir():
+                continue
+            dst_filepath = unzip_dir.joinpath(*PurePosixPath(member.filename.replace("\\", "/")).parts)
+            if src_filepaths is not None:
+                if not any(dst_filepath.parent == src_filepath.parent
+                           and (dst_filepath.name == src_filepath.name
+                                or with_supplementary
+                                and dst_filepath.name.startswith("{:s}.".format(src_filepath.stem)))
+                           for src_filepath in src_filepaths):
+                    continue
+            if dst_filepath.exists():
+                continue
+            # The member is written into a temporary file which is then renamed,
+            # so the checks running concurrently never see incomplete file.
+            dst_filepath.parent.mkdir(parents=True, exist_ok=True)
+            partial_filepath = dst_filepath.with_name("{:s}.{:d}.part".format(dst_filepath.name, os.getpid()))
+            with zip_file.open(member) as src_file, open(str(partial_filepath), "wb") as dst_file:
+                shutil.copyfileobj(src_file, dst_file, 1024 ** 2)
+            partial_filepath.replace(dst_filepath)
+
+
 def write_percent(percent_filepath, percent):
     percent_filepath.write_text(str(percent))
 
@@ -29,6 +114,159 @@ def write_progress(progress_filepath, message):
         f.write(message + "\n")
 
 
+def map_tiles(tile_func, tiles, workers=1, initializer=None, initargs=()):
+    """
+    Applies tile_func(tile_no, tile) to every tile and yields the results in the order of the tiles.
+    :param tile_func: module level function, it must be picklable if workers > 1.
+    :param tiles: list of Tile tuples.
+    :param workers: number of worker processes, value <= 1 processes the tiles in the current process.
+    :param initializer: function called once per process before the first tile, e.g. for opening datasets.
+    :param initargs: arguments passed to initializer.
+    """
+    if workers <= 1 or len(tiles) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for tile_no, tile in enumerate(tiles):
+            yield tile_func(tile_no, tile)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # GDAL datasets can not be shared among processes,
+        # so every worker opens its own datasets in the initializer.
+        # The executor.map() returns results in the order of submission,
+        # so the merged results do not depend on the scheduling of the workers.
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            for result in executor.map(tile_func, range(len(tiles)), tiles):
+                yield result
+
+
+def compute_raster_stats(src_filepath):
+    """
+    Computes statistics of the first band of a raster in one pass over blocks of the raster.
+    :param src_filepath: path to the raster file.
+    :return: RasterStats tuple, the histogram is a dict {value: pixel count} of valid pixels,
+             it is None for floating point rasters. NaN pixels of floating point rasters are left out of min and max.
+             Min and max are None if there is no valid pixel.
+    """
+    import numpy
+    import osgeo.gdal as gdal
+
+    ds = gdal.Open(str(src_filepath))
+    band = ds.GetRasterBand(1)
+    nodata_value = band.GetNoDataValue()
+
+    histogram = None
+    min_value = None
+    max_value = None
+    nodata_count = 0
+    valid_count = 0
+    for yoff in range(0, ds.RasterYSize, BLOCKSIZE):
+        nrows = min(BLOCKSIZE, ds.RasterYSize - yoff)
+        for xoff in range(0, ds.RasterXSize, BLOCKSIZE):
+            ncols = min(BLOCKSIZE, ds.RasterXSize - xoff)
+            arr = band.ReadAsArray(xoff, yoff, ncols, nrows).ravel()
+            if histogram is None and numpy.issubdtype(arr.dtype, numpy.integer):
+                histogram = {}
+
+            # Exclude nodata pixels.
+            if nodata_value is None:
+                is_nodata = None
+            elif numpy.isnan(nodata_value):
+                is_nodata = numpy.isnan(arr)
+            else:
+                is_nodata = arr == nodata_value
+            if is_nodata is not None:
+                nodata_count += int(numpy.count_nonzero(is_nodata))
+                arr = arr[~is_nodata]
+            if len(arr) == 0:
+                continue
+            valid_count += len(arr)
+
+            if histogram is None and numpy.isnan(arr).all():
+                # NaN pixels of raster with other nodata value have no min and max.
+                continue
+            arr_min = numpy.nanmin(arr).item()
+            arr_max = numpy.nanmax(arr).item()
+            min_value = arr_min if min_value is None else min(min_value, arr_min)
+            max_value = arr_max if max_value is None else max(max_value, arr_max)
+
+            if histogram is not None:
+                if arr_min >= 0 and arr.dtype.itemsize <= 2:
+                    counts = numpy.bincount(arr)
+                    values = numpy.flatnonzero(counts)
+                    counts = counts[values]
+                else:
+                    values, counts = numpy.unique(arr, return_counts=True)
+                for value, count in zip(values.tolist(), counts.tolist()):
+                    histogram[value] = histogram.get(value, 0) + count
+    ds = None
+    return RasterStats(histogram, min_value, max_value, nodata_value, nodata_count, valid_count)
+
+
+def get_raster_stats(src_filepath, tmp_dir=None):
+    """
+    Gets statistics of the first band of a raster.
+
+    The statistics are computed the first time they are needed by any check of the job.
+    They are stored in the job tmp_dir and later checks read them from there instead of reading the raster again.
+    The stored statistics are keyed by raster path, size and modification time.
+    :param src_filepath: path to the raster file.
+    :param tmp_dir: job tmp directory, if None the statistics are always computed.
+    :return: RasterStats tuple, see compute_raster_stats().
+    """
+    import hashlib
+    import json
+    import os
+    from pathlib import Path
+
+    if tmp_dir is None:
+        return compute_raster_stats(src_filepath)
+
+    if str(src_filepath).startswith("/vsi"):
+        # The raster is read directly from the delivery zip file, see get_gdal_path().
+        import osgeo.gdal as gdal
+        src_stat = gdal.VSIStatL(str(src_filepath))
+        cache_key = "{:s}:{:d}:{:d}".format(str(src_filepath), src_stat.size, src_stat.mtime)
+    else:
+        src_filepath = Path(src_filepath).resolve()
+        src_stat = src_filepath.stat()
+        cache_key = "{:s}:{:d}:{:d}".format(str(src_filepath), src_stat.st_size, src_stat.st_mtime_ns)
+    cache_filepath = Path(tmp_dir).joinpath("raster_stats_{:s}.json"
+                                            .format(hashlib.md5(cache_key.encode()).hexdigest()))
+    if cache_filepath.is_file():
+        stats = json.loads(cache_filepath.read_text())
+        if stats["histogram"] is not None:
+            stats["histogram"] = {int(value): count for value, count in stats["histogram"].items()}
+        return RasterStats(**stats)
+
+    stats = compute_raster_stats(src_filepath)
+    # Write to a temporary file first, so a concurrent reader never sees an incomplete file.
+    partial_filepath = cache_filepath.with_name("{:s}.{:d}".format(cache_filepath.name, os.getpid()))
+    partial_filepath.write_text(json.dumps(stats._asdict()))
+    partial_filepath.replace(cache_filepath)
+    return stats
+
+
+def get_code_histogram(src_filepath, tmp_dir=None):
+    """
+    Gets pixel counts of the codes of the first band of a raster.
+
+    The histogram of integer rasters is taken from get_raster_stats().
+    Floating point rasters have no such histogram, their values are counted by GDAL
+    in unit buckets of codes 0 to 255, the values out of the range are not counted.
+    :return: dict {code: pixel count}.
+    """
+    histogram = get_raster_stats(src_filepath, tmp_dir).histogram
+    if histogram is None:
+        import osgeo.gdal as gdal
+
+        ds = gdal.Open(str(src_filepath))
+        counts = ds.GetRasterBand(1).GetHistogram(approx_ok=False)
+        ds = None
+        histogram = {code: count for code, count in enumerate(counts) if count != 0}
+    return histogram
+
+
 class Rectangle:
     def __init__(self, x1, y1, x2, y2):
         if x1 > x2 or y1 > y2:
@@ -138,6 +376,7 @@ def read_tile(src_ds, tile, gap_value):
     :param nodata_value:
     :return: A 2D array with the data. Pixels out of src_ds bounds have their values set to gap_value.
     """
+    import numpy
 
     # Extract bounds of the dataset in absolute coordinates.
     ds_gt = src_ds.GetGeoTransform()
@@ -199,14 +438,15 @@ def find_bbox(vector_filepath, attr_name, attr_value):
 
 
 def rasterize_mask(vector_filepath, pixel_size, du_column_name, aoi_code, mask_align_grid, src_ulx, src_uly, work_dir):
+    from qc_tool.translate import rasterize
+    from qc_tool.translate import vector_translate
 
     # Create a new filtered GeoPackage that only contains polygons belonging to the delivery unit.
     filtered_vector_filepath = work_dir.joinpath("{}_filtered.gpkg".format(vector_filepath.stem))
-    args = ["ogr2ogr",
-            "-where", '\"{:s}\" = \"{:s}\"'.format(du_column_name, aoi_code),
-            "-f", "GPKG", str(filtered_vector_filepath),
-            vector_filepath, vector_filepath.stem]
-    run(args)
+    options = ["-where", '\"{:s}\" = \"{:s}\"'.format(du_column_name, aoi_code),
+               "-f", "GPKG",
+               vector_filepath.stem]
+    vector_translate(str(filtered_vector_filepath), str(vector_filepath), options)
 
     # Rasterize the filtered GeoPackage. The option -tap ensures that the resulting mask is aligned to target pixel size.
     raster_filepath = work_dir.joinpath("{}_{}.tif".format(filtered_vector_filepath.stem, aoi_code))
@@ -214,16 +454,13 @@ def rasterize_mask(vector_filepath, pixel_size, du_column_name, aoi_code, mask_a
     if mask_align_grid >= pixel_size:
         # If align_grid is greater or equal to pixel_size then use the -tap option to ensure that the raster origin
         # coordinates can be divided by the pixel_size with no remainder.
-        args = ["gdal_rasterize",
-                "-burn", "1",
-                "-tr", str(pixel_size), str(pixel_size),
-                "-tap",
-                "-ot", "Byte",
-                "-of", "GTiff",
-                "-co", "COMPRESS=LZW",
-                str(filtered_vector_filepath),
-                str(raster_filepath)]
-        run(args)
+        options = ["-burn", "1",
+                   "-tr", str(pixel_size), str(pixel_size),
+                   "-tap",
+                   "-ot", "Byte",
+                   "-of", "GTiff",
+                   "-co", "COMPRESS=LZW"]
+        rasterize(str(raster_filepath), str(filtered_vector_filepath), options)
     else:
         # Find the bounding box of the mask.
         mask_ulx, mask_lrx, mask_lry, mask_uly = find_bbox(vector_filepath, du_column_name, aoi_code)
@@ -244,14 +481,11 @@ def rasterize_mask(vector_filepath, pixel_size, du_column_name, aoi_code, mask_a
         print("src_uly: {}".format(src_uly))
         print("mask_uly: {}".format(mask_uly))
 
-        args = ["gdal_rasterize",
-                "-burn", "1",
-                "-tr", str(pixel_size), str(pixel_size),
-                "-te", str(mask_ulx), str(mask_lry), str(mask_lrx), str(mask_uly),
-                "-ot", "Byte",
-                "-of", "GTiff",
-                "-co", "COMPRESS=LZW",
-                str(filtered_vector_filepath),
-                str(raster_filepath)]
-        run(args)
+        options = ["-burn", "1",
+                   "-tr", str(pixel_size), str(pixel_size),
+                   "-te", str(mask_ulx), str(mask_lry), str(mask_lrx), str(mask_uly),
+                   "-ot", "Byte",
+                   "-of", "GTiff",
+                   "-co", "COMPRESS=LZW"]
+        rasterize(str(raster_filepath), str(filtered_vector_filepath), options)
     return raster_filepath
@@ -20,12 +20,19 @@ def locate_xml_file(metadata_folder_path, layer_filepath):
 def run_check(params, status):
     from qc_tool.vector.helper import do_inspire_check
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import extract_local_files
     from qc_tool.common import CONFIG
 
     use_lightweight_validator = CONFIG.get("use_lightweight_validator", False)
     if use_lightweight_validator:
         status.info("Using built-in geonetwork-based lightweight validator instead of INSPIRE validator service.")
 
+    # Only the metadata files are extracted if the delivery has been read directly from zip file.
+    if "vsizip_filepath" in params:
+        extract_local_files(params,
+                            [path for path in params["unzip_filepaths"] if path.suffix.lower() == ".xml"],
+                            with_supplementary=False)
+
     for layer_def in do_raster_layers(params):
 
         # Locate a 'metadata' subdirectory inside the delivery.
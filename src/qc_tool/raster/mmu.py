@@ -1,12 +1,20 @@
 import math
 import os
 import subprocess
+from collections import namedtuple
 
 DESCRIPTION = "Minimum mapping unit."
 IS_SYSTEM = False
 
 MAX_REPORTED_REGION_COUNT = 1000000
 
+# Number of features written to geopackage in one transaction.
+EXPORT_BATCH_SIZE = 10000
+
+
+Patches = namedtuple("Patches", ["label", "area", "value", "row", "col",
+                                 "touches_tile_edge", "touches_neighbour", "touches_raster_edge"])
+
 
 def write_percent(percent_filepath, percent):
     percent_filepath.write_text(str(percent))
@@ -48,108 +56,317 @@ def reclassify_values(arr, groups):
                 arr_copy[arr == value] = new_value
     return arr_copy
 
-def patch_touches_cell_with_value(coordinates, tile, neighbour_values):
-    """
-    Takes a list of [row, column] cell coordinates and inspects if at least one of the coordinates
-    has a neighbour cell having value in [values].
-    This function can be used for detecting patches touching cloud or patches touching ocean.
-    :param coordinates: The patch of same-value raster cells.
-    :param tile: The numpy array raster tile to take values from.
-    :param neighbour_values: A 1d array of integer values to comapare the neighbour cells with.
-    :return: True if at least one neighbouring cell has one of neighbour_values, false othervise
+def classify_patches(labels, tile, mmu, neighbour_values, x_offset, y_offset, raster_nrows, raster_ncols):
     """
-    for coor in coordinates:
-        c_down = coor[0] + 1
-        c_up = coor[0] - 1
-        c_right = coor[1] + 1
-        c_left = coor[1] - 1
-
-        # top neighbour
-        if c_up >= 0:
-            if tile[c_up, coor[1]] in neighbour_values:
-                return True
-        # bottom neighbour
-        if c_down < tile.shape[0]:
-            if tile[c_down, coor[1]] in neighbour_values:
-                return True
-        # left neighbour
-        if c_left >= 0:
-            if tile[coor[0], c_left] in neighbour_values:
-                return True
-        # right neighbour
-        if c_right < tile.shape[1]:
-            if tile[coor[0], c_right] in neighbour_values:
-                return True
-    return False
-
-def patch_touches_raster_edge(coordinates, raster_nrows, raster_ncols):
-    """
-    Takes a list of [row, column] cell coordinates and inspects if at least one of the coordinates
-    is located exactly at the specified edge of the tile.
-    This function can be used for detecting patches touching the raster bounding box.
-    :param coordinates: The patch of same-value raster cells.
+    Finds patches with area < MMU or touching the tile edge in a labelled tile and classifies them.
+    The properties of all patches are computed at once by array operations instead of iterating patch cells.
+    :param labels: 2D numpy array of patch labels, background has label 0.
+    :param tile: The numpy array raster tile the labels were computed from.
+    :param mmu: Minimum mapping unit in pixels.
+    :param neighbour_values: Patches touching a cell having one of these values are marked by touches_neighbour.
+    :param x_offset: Column of the upper left tile cell in the whole source raster.
+    :param y_offset: Row of the upper left tile cell in the whole source raster.
     :param raster_nrows: Number of rows in the whole source raster.
     :param raster_ncols: Number of columns in the whole source raster.
-    :return: True if at least one cell in the patch is located at source raster edge.
+    :return: Patches tuple of 1d arrays with one item per patch with area < MMU or touching the tile edge,
+             row and col locate the first cell of the patch inside the tile.
+             Patches with area >= MMU are located by any of their cells at the tile edge.
     """
-    for coor in coordinates:
-        if coor[0] == 0 or coor[1] == 0 or coor[0] == raster_ncols - 1 or coor[1] == raster_nrows - 1:
-            return True
-    return False
-
-
-def export(regions, raster_ds, gpkg_filepath, max_regions_count):
+    import numpy
+    import scipy.ndimage as ndimage
+
+    nrows, ncols = labels.shape
+    flat_labels = labels.ravel()
+    areas = numpy.bincount(flat_labels)
+    is_small = (areas > 0) & (areas < mmu)
+    is_small[0] = False
+
+    # Patches touching the tile edge.
+    tile_edge_cells = numpy.unique(numpy.concatenate((numpy.arange(ncols),
+                                                      numpy.arange(ncols) + (nrows - 1) * ncols,
+                                                      numpy.arange(nrows) * ncols,
+                                                      numpy.arange(nrows) * ncols + ncols - 1)))
+    tile_edge_labels = flat_labels[tile_edge_cells]
+    touches_tile_edge = numpy.zeros(len(areas), dtype=bool)
+    touches_tile_edge[tile_edge_labels] = True
+    touches_tile_edge[0] = False
+
+    # Locate the first cell of every patch.
+    # Only the cells of small patches are sorted, so the cost does not depend on big patches.
+    # Big patches are never reported, so any cell at the tile edge is good enough for them.
+    first_cells = numpy.zeros(len(areas), dtype=numpy.int64)
+    edge_labels, edge_positions = numpy.unique(tile_edge_labels, return_index=True)
+    first_cells[edge_labels] = tile_edge_cells[edge_positions]
+    small_cells = numpy.flatnonzero(is_small[flat_labels])
+    small_labels, small_positions = numpy.unique(flat_labels[small_cells], return_index=True)
+    first_cells[small_labels] = small_cells[small_positions]
+    selected_labels = numpy.flatnonzero(is_small | touches_tile_edge)
+
+    # Patches touching the edge of the whole source raster.
+    raster_edge_labels = [numpy.empty(0, dtype=labels.dtype)]
+    if y_offset == 0:
+        raster_edge_labels.append(labels[0, :])
+    if y_offset + labels.shape[0] == raster_nrows:
+        raster_edge_labels.append(labels[-1, :])
+    if x_offset == 0:
+        raster_edge_labels.append(labels[:, 0])
+    if x_offset + labels.shape[1] == raster_ncols:
+        raster_edge_labels.append(labels[:, -1])
+    touches_raster_edge = numpy.zeros(len(areas), dtype=bool)
+    touches_raster_edge[numpy.concatenate(raster_edge_labels)] = True
+
+    # Patches touching a cell with neighbour value.
+    # The cross structure without centre marks cells having such value in their 4-neighbourhood.
+    touches_neighbour = numpy.zeros(len(areas), dtype=bool)
+    if len(neighbour_values) > 0:
+        neighbour_cells = numpy.isin(tile, neighbour_values)
+        structure = numpy.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype=bool)
+        touching_cells = ndimage.binary_dilation(neighbour_cells, structure=structure)
+        touches_neighbour[labels[touching_cells]] = True
+
+    first_cells = first_cells[selected_labels]
+    rows, cols = numpy.divmod(first_cells, ncols)
+    return Patches(label=selected_labels,
+                   area=areas[selected_labels],
+                   value=tile.ravel()[first_cells],
+                   row=rows,
+                   col=cols,
+                   touches_tile_edge=touches_tile_edge[selected_labels],
+                   touches_neighbour=touches_neighbour[selected_labels],
+                   touches_raster_edge=touches_raster_edge[selected_labels])
+
+
+def merge_seam(union_find, ids_a, values_a, ids_b, values_b, neighbour_values):
     """
-    Exports a list of lessMMU region dictionaries to geopackage.
-    :param regions: list of dicts with {"coords", "area", "value"}
-    :param raster_ds: original raster dataset
-    :param gpkg_filepath: filepath the vector datasource is to be exported to
-    :param max_regions_count: maximum number of regions to be exported.
+    Merges patches along a seam, i.e. along the shared border of two adjacent tiles.
+    :param union_find: SeamUnionFind holding the patches.
+    :param ids_a: 1d array of patch ids of the border cells at one side of the seam, -1 for background.
+    :param values_a: 1d array of raster values of the border cells at one side of the seam.
+    :param ids_b: 1d array of patch ids of the opposite border cells.
+    :param values_b: 1d array of raster values of the opposite border cells.
+    :param neighbour_values: Patches touching a cell having one of these values across the seam are marked.
     """
-    import osgeo.ogr as ogr
-    import osgeo.osr as osr
-
-    if len(regions) > 0:
+    import numpy
 
-        (upper_left_x, x_size, x_rotation, upper_left_y, y_rotation, y_size) = raster_ds.GetGeoTransform()
+    # Adjacent cells with the same value belong to the same patch.
+    is_same = (ids_a >= 0) & (ids_b >= 0) & (values_a == values_b)
+    if numpy.any(is_same):
+        id_pairs = numpy.unique(numpy.stack((ids_a[is_same], ids_b[is_same]), axis=1), axis=0)
+        for id_a, id_b in id_pairs:
+            union_find.union(id_a, id_b)
+
+    # The neighbour cell across the seam may have exception value.
+    if len(neighbour_values) > 0:
+        union_find.touches_neighbour[ids_a[(ids_a >= 0) & numpy.isin(values_b, neighbour_values)]] = True
+        union_find.touches_neighbour[ids_b[(ids_b >= 0) & numpy.isin(values_a, neighbour_values)]] = True
+
+
+class SeamUnionFind():
+    """Union-find of patches touching tile edges.
+
+    Every tile is labelled separately.
+    The patches touching the tile edge are registered here and they are merged with the patches
+    of adjacent tiles by merge_seam().
+    After every tile row, release() aggregates properties of merged patches and drops all complete patches,
+    so the memory holds only patches reaching the part of the raster not yet processed."""
+    property_names = ("parent", "area", "cell", "value", "touches_neighbour", "touches_raster_edge")
+
+    def __init__(self, raster_ncols):
+        import numpy
+
+        self.raster_ncols = raster_ncols
+        self.size = 0
+        self.parent = numpy.zeros(0, dtype=numpy.int64)
+        self.area = numpy.zeros(0, dtype=numpy.int64)
+        # Position of the first cell of the patch, row * raster_ncols + col.
+        self.cell = numpy.zeros(0, dtype=numpy.int64)
+        self.value = numpy.zeros(0, dtype=numpy.int64)
+        self.touches_neighbour = numpy.zeros(0, dtype=bool)
+        self.touches_raster_edge = numpy.zeros(0, dtype=bool)
+
+    def _reserve(self, count):
+        import numpy
+
+        capacity = len(self.parent)
+        if self.size + count <= capacity:
+            return
+        capacity = max(2 * capacity, self.size + count)
+        for name in self.property_names:
+            old_array = getattr(self, name)
+            new_array = numpy.zeros(capacity, dtype=old_array.dtype)
+            new_array[:self.size] = old_array[:self.size]
+            setattr(self, name, new_array)
+
+    def add(self, patches, x_offset, y_offset):
+        """Registers patches of a tile and returns their ids."""
+        import numpy
+
+        count = len(patches.label)
+        self._reserve(count)
+        ids = numpy.arange(self.size, self.size + count)
+        self.parent[ids] = ids
+        self.area[ids] = patches.area
+        self.cell[ids] = (patches.row + y_offset) * self.raster_ncols + patches.col + x_offset
+        self.value[ids] = patches.value
+        self.touches_neighbour[ids] = patches.touches_neighbour
+        self.touches_raster_edge[ids] = patches.touches_raster_edge
+        self.size += count
+        return ids
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression.
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        root_i = self.find(i)
+        root_j = self.find(j)
+        if root_i < root_j:
+            self.parent[root_j] = root_i
+        elif root_j < root_i:
+            self.parent[root_i] = root_j
+
+    def release(self, frontier_ids):
+        """
+        Aggregates merged patches and releases the complete ones.
+        :param frontier_ids: 1d array of patch ids of the last processed raster row, -1 for background.
+        :return: tuple (patches, frontier_ids), where patches are the complete patches in Patches tuple
+                 with row and col relative to the whole raster, and frontier_ids are remapped to the kept patches.
+        """
+        import numpy
+
+        size = self.size
+        ids = numpy.arange(size)
+        roots = self.parent[:size].copy()
+        while True:
+            parent_roots = self.parent[roots]
+            if numpy.array_equal(parent_roots, roots):
+                break
+            roots = parent_roots
+
+        # Aggregate properties of merged patches into the root.
+        area = numpy.bincount(roots, weights=self.area[:size], minlength=size).astype(numpy.int64)
+        cell = numpy.full(size, numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        numpy.minimum.at(cell, roots, self.cell[:size])
+        touches_neighbour = numpy.bincount(roots, weights=self.touches_neighbour[:size], minlength=size) > 0
+        touches_raster_edge = numpy.bincount(roots, weights=self.touches_raster_edge[:size], minlength=size) > 0
+
+        # The patch is complete if it does not reach the frontier.
+        is_kept = numpy.zeros(size, dtype=bool)
+        is_kept[roots[frontier_ids[frontier_ids >= 0]]] = True
+        complete_ids = numpy.flatnonzero((roots == ids) & ~is_kept)
+        kept_ids = numpy.flatnonzero(is_kept)
+
+        rows, cols = numpy.divmod(cell[complete_ids], self.raster_ncols)
+        complete_patches = Patches(label=complete_ids,
+                                   area=area[complete_ids],
+                                   value=self.value[complete_ids],
+                                   row=rows,
+                                   col=cols,
+                                   touches_tile_edge=numpy.zeros(len(complete_ids), dtype=bool),
+                                   touches_neighbour=touches_neighbour[complete_ids],
+                                   touches_raster_edge=touches_raster_edge[complete_ids])
+
+        # Keep only roots of the patches reaching the frontier.
+        kept_count = len(kept_ids)
+        remap = numpy.full(size, -1, dtype=numpy.int64)
+        remap[kept_ids] = numpy.arange(kept_count)
+        frontier_ids = frontier_ids.copy()
+        is_frontier_patch = frontier_ids >= 0
+        frontier_ids[is_frontier_patch] = remap[roots[frontier_ids[is_frontier_patch]]]
+        self.parent = numpy.arange(kept_count, dtype=numpy.int64)
+        self.area = area[kept_ids]
+        self.cell = cell[kept_ids]
+        self.value = self.value[kept_ids]
+        self.touches_neighbour = touches_neighbour[kept_ids]
+        self.touches_raster_edge = touches_raster_edge[kept_ids]
+        self.size = kept_count
+        return complete_patches, frontier_ids
+
+
+class RegionExport():
+    """Streams lessMMU regions into a geopackage as they are found.
+
+    Every region is written as one point at its representative cell.
+    Features are written in batched transactions and no region is kept in memory,
+    so the memory used does not depend on the number of reported regions.
+    The geopackage is created by the first written region."""
+
+    def __init__(self, raster_ds, gpkg_filepath, max_regions_count):
+        """
+        :param raster_ds: original raster dataset
+        :param gpkg_filepath: filepath the vector datasource is to be exported to
+        :param max_regions_count: maximum number of regions to be exported.
+        """
+        self.raster_ds = raster_ds
+        self.gpkg_filepath = gpkg_filepath
+        self.max_regions_count = max_regions_count
+        self.count = 0
+        self.datasource = None
+        self.layer = None
+        self.batch_count = 0
+
+    def _create(self):
+        import osgeo.ogr as ogr
+        import osgeo.osr as osr
 
         srs = osr.SpatialReference()
-        srs.ImportFromWkt(raster_ds.GetProjection())
+        srs.ImportFromWkt(self.raster_ds.GetProjection())
 
         driver = ogr.GetDriverByName("GPKG")
-        shapeData = driver.CreateDataSource(str(gpkg_filepath))
-
-        layer = shapeData.CreateLayer('ogr_pts', srs, ogr.wkbPoint)
-        areaField = ogr.FieldDefn("area_px", ogr.OFTInteger)
-        layer.CreateField(areaField)
-        valueField = ogr.FieldDefn("value", ogr.OFTInteger)
-        layer.CreateField(valueField)
-
-        layerDefinition = layer.GetLayerDefn()
+        self.datasource = driver.CreateDataSource(str(self.gpkg_filepath))
+        self.layer = self.datasource.CreateLayer('ogr_pts', srs, ogr.wkbPoint)
+        self.layer.CreateField(ogr.FieldDefn("area_px", ogr.OFTInteger))
+        self.layer.CreateField(ogr.FieldDefn("value", ogr.OFTInteger))
+        self.geotransform = self.raster_ds.GetGeoTransform()
+        self.layer.StartTransaction()
+
+    def write(self, col, row, area, value):
+        """
+        Writes one region.
+        :param col: column of the representative cell in the source raster.
+        :param row: row of the representative cell in the source raster.
+        :param area: area of the region in pixels.
+        :param value: raster value of the region.
+        """
+        import osgeo.ogr as ogr
+
+        self.count += 1
+        if self.count > self.max_regions_count:
+            return
+        if self.datasource is None:
+            self._create()
 
-        i = 0
-        for rInfo in regions:
+        (upper_left_x, x_size, x_rotation, upper_left_y, y_rotation, y_size) = self.geotransform
+        x_proj = col * x_size + upper_left_x + (x_size / 2)  # add half the cell size
+        y_proj = row * y_size + upper_left_y + (y_size / 2)  # to centre the point
 
-            if i > max_regions_count:
-                break
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.SetPoint(0, x_proj, y_proj)
 
-            x_proj = rInfo["coords"][0][0] * x_size + upper_left_x + (x_size / 2)  # add half the cell size
-            y_proj = rInfo["coords"][0][1] * y_size + upper_left_y + (y_size / 2)  # to centre the point
-            area = rInfo["area"]
+        feature = ogr.Feature(self.layer.GetLayerDefn())
+        feature.SetGeometry(point)
+        feature.SetFID(self.count - 1)
+        feature.SetField("area_px", int(area))
+        feature.SetField("value", int(value))
+        self.layer.CreateFeature(feature)
 
-            point = ogr.Geometry(ogr.wkbPoint)
-            point.SetPoint(0, x_proj, y_proj)
+        self.batch_count += 1
+        if self.batch_count >= EXPORT_BATCH_SIZE:
+            self.layer.CommitTransaction()
+            self.layer.StartTransaction()
+            self.batch_count = 0
 
-            feature = ogr.Feature(layerDefinition)
-            feature.SetGeometry(point)
-            feature.SetFID(i)
-            feature.SetField("area_px", int(area))
-            feature.SetField("value", int(rInfo["value"]))
+    def close(self):
+        if self.datasource is not None:
+            self.layer.CommitTransaction()
+            self.layer = None
+            self.datasource = None
 
-            layer.CreateFeature(feature)
-
-            i += 1
-        shapeData.Destroy()
 
 def get_neighbouring_tiles(boundary_source, aoi_code):
     """
@@ -222,6 +439,7 @@ def raster_extend_shifted(raster_file_path, mmu):
 
 
 def run_check(params, status):
+    import numpy
     import osgeo.gdal as gdal
     import osgeo.ogr as ogr
     import skimage.measure as measure
@@ -229,7 +447,9 @@ def run_check(params, status):
     from copy import deepcopy
 
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import extract_local_files
     from qc_tool.vector.helper import do_s3_download
+    from qc_tool.vector.helper import get_s3_partial_dir
 
     # set this to true for reporting partial progress to a _progress.txt file.
     report_progress = True
@@ -272,6 +492,9 @@ def run_check(params, status):
     # Get layer definitions dictionary for further MMU-check processing...
     layer_defs = deepcopy(do_raster_layers(params))
 
+    # The rasters are mosaicked with neighbouring tiles next to the original file, so they must be local files.
+    extract_local_files(params, [layer_def["src_filepath"] for layer_def in layer_defs])
+
     # The optional 'check_neighbours' parameter indicates whether to check MMU rules also on raster borders using neighbouring tiles.
     # If 'check_neighbours' parameter is True, then also 'boundary_source' optional parameter has to be set.
     check_neighbours = params.get("check_neighbours", False)
@@ -321,7 +544,9 @@ def run_check(params, status):
                            params["s3"]["bucketname"],
                            key_prefix,
                            s3_local_dir,
-                           status)
+                           status,
+                           get_s3_partial_dir(params),
+                           workers=params.get("s3_workers", 1))
         s3_local_filepaths += [os.path.join(s3_local_dir, s3_local_filename) for s3_local_filename in os.listdir(s3_local_dir)]
         # create VRT mosaic
         mosaic_path_vrt = raster_path_orig.replace('.tif', '.vrt')
@@ -353,32 +578,46 @@ def run_check(params, status):
         nRasterCols = ds.RasterXSize
         nRasterRows = ds.RasterYSize
 
-        # tile buffer width. Must be bigger then number of pixels in MMU.
-        buffer_width = MMU + 1
-
-        # special handling of very small rasters - no need to split in multiple tiles
-        if buffer_width >= nRasterCols:
-            buffer_width = 0
-        if nRasterCols <= BLOCKSIZE or nRasterRows <= BLOCKSIZE:
-            buffer_width = 0
-
-        blocksize_with_buffer = BLOCKSIZE + 2 * buffer_width
-
-        # Detected patches with area<MMU will be stored in this list.
-        regions_lessMMU = []
+        # Detected patches with area<MMU are written to the error geopackage as they are found.
+        error_filename = "s{:02d}_{:s}_lessmmu_error.gpkg".format(params["step_nr"], layer_def["src_filepath"].stem)
+        error_export = RegionExport(ds, params["output_dir"].joinpath(error_filename), MAX_REPORTED_REGION_COUNT)
 
         # Exception patches with area<MMU and belonging to exclude class.
-        regions_lessMMU_except = []
+        exception_filename = "s{:02d}_{:s}_lessmmu_exception.gpkg".format(params["step_nr"], layer_def["src_filepath"].stem)
+        exception_export = RegionExport(ds, params["output_dir"].joinpath(exception_filename), MAX_REPORTED_REGION_COUNT)
+
+        def add_regions(patches, x_offset, y_offset):
+            # lessMMU patches belonging to one of exclude_values classes or touching neighbour exclude values
+            # or touching the raster edge are reported as exceptions.
+            is_exception = (numpy.isin(patches.value, exclude_values)
+                            | patches.touches_neighbour
+                            | patches.touches_raster_edge)
+            for k in numpy.flatnonzero(patches.area < MMU):
+                # convert relative coords to absolute.
+                if is_exception[k]:
+                    if report_exceptions:
+                        exception_export.write(patches.col[k] + x_offset, patches.row[k] + y_offset,
+                                               patches.area[k], patches.value[k])
+                else:
+                    error_export.write(patches.col[k] + x_offset, patches.row[k] + y_offset,
+                                       patches.area[k], patches.value[k])
 
         nTileCols = int(math.ceil(nRasterCols / BLOCKSIZE))
         nTileRows = int(math.ceil(nRasterRows / BLOCKSIZE))
-        last_col = nTileCols - 1
-        last_row = nTileRows - 1
 
         if report_progress:
             msg = "processing {:d} tiles: {:d} rows, {:d} columns".format(nTileRows * nTileCols, nTileRows, nTileCols)
             write_progress(progress_filepath, msg)
 
+        # Patches touching the tile edge are not complete within one tile.
+        # They are merged with the patches of adjacent tiles along the seams instead of re-reading the tile
+        # with a buffer, so every raster cell is read and labelled exactly once.
+        union_find = SeamUnionFind(nRasterCols)
+
+        # Patch ids and values of the bottom raster row of the previous tile row.
+        above_ids = numpy.full(nRasterCols, -1, dtype=numpy.int64)
+        above_values = None
+
         # TILES: ITERATE ROWS
         for tileRow in range(nTileRows):
 
@@ -386,237 +625,114 @@ def run_check(params, status):
                 progress_percent = int(100 *((tileRow + 1) / nTileRows))
                 write_percent(percent_filepath, progress_percent)
 
-            if tileRow == 0:
-                # First row
-                yOff = 0
-                yOffInner = 0
-                yOffRelative = 0
-                block_height = BLOCKSIZE + buffer_width
-                block_height_inner = BLOCKSIZE
-            else:
-                # Middle row
-                yOff = tileRow * BLOCKSIZE
-                yOffInner = yOff + buffer_width
-                yOffRelative = buffer_width
-                block_height = blocksize_with_buffer
-                block_height_inner = BLOCKSIZE
-
-            if tileRow == last_row:
-                # Last row is a special case - block width must be adjusted.
-                block_height = nRasterRows - yOff
-                block_height_inner = block_height - buffer_width
-
-            # if row tile only contains buffer zone and no inner zone, skip..
-            if block_height <= buffer_width:
-                continue
-
             # if we reached the maximum number of patches < MMU, then report message and exit.
-            if len(regions_lessMMU) > MAX_REPORTED_REGION_COUNT:
+            if error_export.count > MAX_REPORTED_REGION_COUNT:
                 break
 
+            yOff = tileRow * BLOCKSIZE
+            block_height = min(BLOCKSIZE, nRasterRows - yOff)
+            bottom_ids = numpy.full(nRasterCols, -1, dtype=numpy.int64)
+            bottom_values = None
+            left_ids = None
+            left_values = None
+
             # TILES: ITERATE COLUMNS
             for tileCol in range(nTileCols):
-                if tileCol == 0:
-                    # First column
-                    xOff = 0
-                    xOffInner = 0
-                    xOffRelative = 0
-                    block_width = BLOCKSIZE + buffer_width
-                    block_width_inner = BLOCKSIZE
-                else:
-                    # Middle column
-                    xOff = tileCol * BLOCKSIZE
-                    xOffInner = xOff + buffer_width
-                    xOffRelative = buffer_width
-                    block_width = blocksize_with_buffer
-                    block_width_inner = BLOCKSIZE
-
-                if tileCol == last_col:
-                    # Last column is a special case - block width must be adjusted.
-                    block_width = nRasterCols - xOff
-                    block_width_inner = block_width - buffer_width
-
-                # if column tile only contains buffer zone and no inner zone, skip..
-                if block_width <= buffer_width:
-                    continue
-
-                # if we reached the maximum number of patches < MMU, then report message and exit.
-                if len(regions_lessMMU) > MAX_REPORTED_REGION_COUNT:
-                    break
-
-                # read whole array (with buffers)
-                tile_buffered = ds.ReadAsArray(xOff, yOff, block_width, block_height)
-
-                # special case: if the tile has all values equal then skip MMU checks.
-                if tile_buffered.min() == tile_buffered.max():
-                    if report_progress:
-                        msg_tile = "tileRow: {tr}/{ntr} tileCol: {tc} width: {w} height: {h} all values same."
-                        msg_tile = msg_tile.format(tr=tileRow, ntr=nTileRows, tc=tileCol, w=block_width_inner,
-                                                   h=block_height_inner)
-                        write_progress(progress_filepath, msg_tile)
-                    continue
+                xOff = tileCol * BLOCKSIZE
+                block_width = min(BLOCKSIZE, nRasterCols - xOff)
 
-                # reclassify inner tile array if some patches should be grouped together
-                if use_reclassify:
-                    # tile_inner = reclassify_values(tile_inner, params["groupcodes"])
-                    tile_buffered = reclassify_values(tile_buffered, params["groupcodes"])
-
-                # inner tile is subset of buffered tile
-                tile_inner = tile_buffered[yOffRelative: yOffRelative + block_height_inner, xOffRelative: xOffRelative + block_width_inner]
-
-                # read inner array (without buffer)
+                tile = ds.ReadAsArray(xOff, yOff, block_width, block_height)
 
-                # label the inner array and find patches < MMU
-                labels_inner = measure.label(tile_inner, background=NODATA, connectivity=1)
-                regions_inner = measure.regionprops(labels_inner)
-                regions_inner_lessMMU = [r for r in regions_inner if r.area < MMU]
-
-                regions_lessMMU_edge = [r for r in regions_inner_lessMMU
-                                        if r.bbox[0] == 0
-                                        or r.bbox[1] == 0
-                                        or r.bbox[3] == block_width_inner
-                                        or r.bbox[2] == block_height_inner]
-
-                labels_lessMMU_edge = [r.label for r in regions_lessMMU_edge]
+                # reclassify tile array if some patches should be grouped together
+                if use_reclassify:
+                    tile = reclassify_values(tile, params["groupcodes"])
+                if bottom_values is None:
+                    bottom_values = numpy.zeros(nRasterCols, dtype=tile.dtype)
 
-                regions_lessMMU_inside = [r for r in regions_inner_lessMMU if r.label not in labels_lessMMU_edge]
+                # special case: if the tile has all values equal then skip labelling.
+                if tile.min() == tile.max():
+                    labels = numpy.full(tile.shape, 0 if tile[0, 0] == NODATA else 1, dtype=numpy.int64)
+                    if report_progress:
+                        msg_tile = "tileRow: {tr}/{ntr} tileCol: {tc} width: {w} height: {h} all values same."
+                        msg_tile = msg_tile.format(tr=tileRow, ntr=nTileRows, tc=tileCol, w=block_width,
+                                                   h=block_height)
+                        write_progress(progress_filepath, msg_tile)
+                else:
+                    labels = measure.label(tile, background=NODATA, connectivity=1)
+                patches = classify_patches(labels, tile, MMU, neighbour_exclude_values,
+                                           xOff, yOff, nRasterRows, nRasterCols)
 
+                # Patches not touching the tile edge are complete, they are reported at once.
+                inside = ~patches.touches_tile_edge
+                add_regions(Patches(*(field[inside] for field in patches)), xOff, yOff)
 
                 # progress reporting..
                 if report_progress:
                     msg = "tileRow: {tr}/{ntr} tileCol: {tc} width: {w} height: {h}"
-                    msg = msg.format(tr=tileRow, ntr=nTileRows, tc=tileCol, w=block_width_inner, h=block_height_inner)
-                    if len(regions_lessMMU_inside) > 0:
-                        msg += " found {:d} areas < MMU".format(len(regions_lessMMU_inside), tileRow, tileCol)
-                    write_progress(progress_filepath, msg)
-
-                # inspect inner patches
-                for r in regions_lessMMU_inside:
-                    first_coord_x = r.coords[0][0]
-                    first_coord_y = r.coords[0][1]
-                    lessMMU_value = tile_inner[first_coord_x, first_coord_y]
-
-                    # convert relative coords to absolute. coords are stored as [row, column].
-                    absolute_coords = [[c[1] + xOffInner, c[0] + yOffInner] for c in r.coords]
-
-                    lessMMU_info = {"tileRow": tileRow, "tileCol": tileCol,
-                                    "area": r.area, "value": lessMMU_value,
-                                    "coords": absolute_coords}
-                    if lessMMU_value in exclude_values:
-                        if report_exceptions:
-                            regions_lessMMU_except.append(lessMMU_info)
-                    elif patch_touches_cell_with_value(r.coords, tile_inner, neighbour_exclude_values):
-                        if report_exceptions:
-                            regions_lessMMU_except.append(lessMMU_info)
-                    elif patch_touches_raster_edge(absolute_coords, nRasterRows, nRasterCols):
-                        if report_exceptions:
-                            regions_lessMMU_except.append(lessMMU_info)
-                    else:
-                        regions_lessMMU.append(lessMMU_info)
-
-                # no need to read-in buffered tile if there are no suspect lessMMU patches at edge of inner tile
-                if len(regions_lessMMU_edge) == 0:
-                    continue
-                elif report_progress:
-                    msg = "tileRow: {tr}/{ntr} tileCol: {tc} width: {w} height: {h} INSPECTING EDGE PATCHES"
                     msg = msg.format(tr=tileRow, ntr=nTileRows, tc=tileCol, w=block_width, h=block_height)
+                    inside_count = numpy.count_nonzero(inside & (patches.area < MMU))
+                    if inside_count > 0:
+                        msg += " found {:d} areas < MMU".format(inside_count)
                     write_progress(progress_filepath, msg)
 
-                # processing the outer array expanded by buffer with width=number of pixels in MMU
-
-                # optimization: set pixels not within buffer zone (deep inside outer array) to background.
-                optimization = True
-                if optimization:
-                    inner_buf_startcol = xOffRelative + MMU
-                    inner_buf_startrow = yOffRelative + MMU
-                    inner_buf_endcol = xOffRelative + block_width_inner - MMU
-                    inner_buf_endrow = yOffRelative + block_height_inner - MMU
-                    if inner_buf_endcol > inner_buf_startcol and inner_buf_endrow > inner_buf_startrow:
-                        tile_buffered[inner_buf_startrow:inner_buf_endrow,
-                                      inner_buf_startcol:inner_buf_endcol] = NODATA
-
-                labels_buf = measure.label(tile_buffered, background=NODATA, connectivity=1)
-                buf_regions = measure.regionprops(labels_buf)
-                buf_regions_small = [r for r in buf_regions if r.area < MMU]
-                buf_labels_small = [r.label for r in buf_regions_small]
-
-                # edge_regions_small is used for reporting only.
-                edge_regions_small = []
-
-                for r in regions_lessMMU_edge:
-
-                    first_coord_row = r.coords[0][0]
-                    first_coord_col = r.coords[0][1]
-
-                    val = tile_inner[first_coord_row, first_coord_col]
-
-                    # get corresponding value of tile edge patch in buffered array..
-                    # if the inner tile edge patch has area < MMU also in the expanded tile, report it.
-                    coord_row_buf = first_coord_row + yOffRelative
-                    coord_col_buf = first_coord_col + xOffRelative
-
-                    #lbl_buf = labels_buf[coord_x_buf, coord_y_buf]
-                    lbl_buf = labels_buf[coord_row_buf, coord_col_buf]
-                    if lbl_buf in buf_labels_small:
-                        r_buf = buf_regions[lbl_buf - 1]
-                        edge_regions_small.append(r)
-
-                        # coordinates are specified as row, column..
-                        # convert [row in tile, column in tile] to [source raster column, source raster row]
-                        absolute_coords = [[c[1] + xOff, c[0] + yOff] for c in r_buf.coords]
-
-                        lessMMU_info = {"tileRow": tileRow, "tileCol": tileCol,
-                                        "area": r_buf.area, "value": val,
-                                        "coords": absolute_coords}
-
-                        # handling special cases (exception patches)
-                        if val in exclude_values:
-                            if report_exceptions:
-                                regions_lessMMU_except.append(lessMMU_info)
-                        elif patch_touches_cell_with_value(r_buf.coords, tile_buffered, neighbour_exclude_values):
-                            if report_exceptions:
-                                regions_lessMMU_except.append(lessMMU_info)
-                        elif patch_touches_raster_edge(absolute_coords, nRasterRows, nRasterCols):
-                            if report_exceptions:
-                                regions_lessMMU_except.append(lessMMU_info)
-                        else:
-                            regions_lessMMU.append(lessMMU_info)
-
-                if report_progress and len(edge_regions_small) > 0:
-                    # report actual edge regions < MMU after applying buffer
-                    msg = "xOff {:d} yOff {:d} xOffInner {:d} yOffInner {:d}".format(xOff, yOff, xOffInner, yOffInner)
-                    write_progress(progress_filepath, msg)
-                    msg = "BUFFER: tileRow: {tr}/{ntr} tileCol: {tc} width: {w} height: {h}"
-                    msg = msg.format(tr=tileRow, ntr=nTileRows, tc=tileCol, w=block_width, h=block_height)
-                    num_edge_patches = len(edge_regions_small)
-                    msg += " found {:d} edge areas < MMU in tile {:d}, {:d}".format(num_edge_patches, tileRow, tileCol)
-                    write_progress(progress_filepath, msg)
+                # Register edge patches and map labels at the tile edge to their ids.
+                edge = patches.touches_tile_edge
+                edge_ids = union_find.add(Patches(*(field[edge] for field in patches)), xOff, yOff)
+                label_ids = numpy.full(labels.max() + 1, -1, dtype=numpy.int64)
+                label_ids[patches.label[edge]] = edge_ids
+
+                # Merge along the seam with the tile above.
+                if tileRow > 0:
+                    merge_seam(union_find,
+                               label_ids[labels[0, :]], tile[0, :],
+                               above_ids[xOff:xOff + block_width], above_values[xOff:xOff + block_width],
+                               neighbour_exclude_values)
+
+                # Merge along the seam with the tile at the left.
+                if tileCol > 0:
+                    merge_seam(union_find,
+                               label_ids[labels[:, 0]], tile[:, 0],
+                               left_ids, left_values,
+                               neighbour_exclude_values)
+
+                left_ids = label_ids[labels[:, -1]]
+                left_values = tile[:, -1]
+                bottom_ids[xOff:xOff + block_width] = label_ids[labels[-1, :]]
+                bottom_values[xOff:xOff + block_width] = tile[-1, :]
+
+            # Report the patches which can not grow into the next tile row.
+            if tileRow == nTileRows - 1:
+                bottom_ids[:] = -1
+            complete_patches, above_ids = union_find.release(bottom_ids)
+            above_values = bottom_values
+            add_regions(complete_patches, 0, 0)
+
+            if report_progress:
+                msg = "tileRow: {tr}/{ntr} merged edge patches, {:d} patches continue in next tile row"
+                msg = msg.format(union_find.size, tr=tileRow, ntr=nTileRows)
+                write_progress(progress_filepath, msg)
+
+        error_export.close()
+        exception_export.close()
 
-        # Export errors and exceptions to geopackage.
-        # The geopackage contains one sample point from each lessMMU patch.
+        # The geopackages contain one sample point from each lessMMU patch.
 
         ## lessMMU patches belonging to one of exclude_values classes are reported as exceptions.
-        if report_exceptions and len(regions_lessMMU_except) > 0:
-            gpkg_filename = "s{:02d}_{:s}_lessmmu_exception.gpkg".format(params["step_nr"], layer_def["src_filepath"].stem)
-            gpkg_filepath = params["output_dir"].joinpath(gpkg_filename)
-            export(regions_lessMMU_except, ds, gpkg_filepath, MAX_REPORTED_REGION_COUNT)
-            status.add_attachment(gpkg_filename)
-            if len(regions_lessMMU_except) <= MAX_REPORTED_REGION_COUNT:
+        if exception_export.count > 0:
+            status.add_attachment(exception_filename)
+            if exception_export.count <= MAX_REPORTED_REGION_COUNT:
                 status.info("The data source has {:d} exceptional objects under MMU limit of {:d} pixels."
-                            .format(len(regions_lessMMU_except), params["area_pixels"]))
+                            .format(exception_export.count, params["area_pixels"]))
             else:
                 status.info("The data source has more than {:d} exceptional objects under MMU limit of {:d} pixels."
                             .format(MAX_REPORTED_REGION_COUNT, params["area_pixels"]))
 
         ## lessMMU patches not belonging to exclude_values are reported as errors.
-        if len(regions_lessMMU) > 0:
-            gpkg_filename = "s{:02d}_{:s}_lessmmu_error.gpkg".format(params["step_nr"], layer_def["src_filepath"].stem)
-            gpkg_filepath = params["output_dir"].joinpath(gpkg_filename)
-            export(regions_lessMMU, ds, gpkg_filepath, MAX_REPORTED_REGION_COUNT)
-            status.add_attachment(gpkg_filename)
-            if len(regions_lessMMU) <= MAX_REPORTED_REGION_COUNT:
+        if error_export.count > 0:
+            status.add_attachment(error_filename)
+            if error_export.count <= MAX_REPORTED_REGION_COUNT:
                 status.failed("The data source has {:d} error objects under MMU limit of {:d} pixels."
-                              .format(len(regions_lessMMU), params["area_pixels"]))
+                              .format(error_export.count, params["area_pixels"]))
             else:
                 status.failed("The data source has more than {:d} error objects under MMU limit of {:d} pixels."
-                              .format(MAX_REPORTED_REGION_COUNT, params["area_pixels"]))
\ No newline at end of file
+                              .format(MAX_REPORTED_REGION_COUNT, params["area_pixels"]))
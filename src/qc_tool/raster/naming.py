@@ -7,11 +7,13 @@ import re
 
 DESCRIPTION = "Naming is in accord with specification."
 IS_SYSTEM = False
+PROVIDES = ("raster_layer_defs", "aoi_code", "name_epsg")
 
 
 def run_check(params, status):
-    import osgeo.gdal as gdal
     from qc_tool.vector.helper import LayerDefsBuilder
+    from qc_tool.raster.helper import open_raster
+    from qc_tool.vector.helper import list_unzip_filepaths
     from qc_tool.vector.helper import extract_aoi_code
     from qc_tool.vector.helper import extract_epsg_code
 
@@ -20,8 +22,8 @@ def run_check(params, status):
         status.set_status_property("reference_year", params["reference_year"])
 
     # Find tif files.
-    tif_filepaths = [path for path in list(params["unzip_dir"].glob("**/*"))
-                     if path.name.lower().endswith(".tif") and path.is_file()]
+    unzip_filepaths = list_unzip_filepaths(params["unzip_dir"], params.get("unzip_filepaths"))
+    tif_filepaths = [path for path in unzip_filepaths if path.name.lower().endswith(".tif")]
 
     if len(tif_filepaths) == 0:
         status.aborted("No .tif files were found in the delivery.")
@@ -61,7 +63,7 @@ def run_check(params, status):
 
     # Check raster file format.
     for layer_alias, layer_def in builder.layer_defs.items():
-        ds = gdal.Open(str(layer_def["src_filepath"]))
+        ds = open_raster(layer_def["src_filepath"], params)
         if ds is None:
             status.aborted("The raster {:s} cannot be opened."
                            .format(layer_def["src_filepath"].name))
@@ -91,7 +93,7 @@ def run_check(params, status):
 
                 for ext2 in ext_options:
                     other_filepath = layer_def["src_filepath"].with_suffix(ext2)
-                    if other_filepath.exists():
+                    if other_filepath in unzip_filepaths:
                         found_files.append(other_filepath.name)
 
                 if len(found_files) == 0:
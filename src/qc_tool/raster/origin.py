@@ -7,13 +7,13 @@ IS_SYSTEM = False
 
 
 def run_check(params, status):
-    import osgeo.gdal as gdal
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import open_raster
 
     grid_size = params.get("grid_size", 1000)
 
     for layer_def in do_raster_layers(params):
-        ds = gdal.Open(str(layer_def["src_filepath"]))
+        ds = open_raster(layer_def["src_filepath"], params)
 
         # upper-left coordinate divided by pixel-size must leave no remainder
         gt = ds.GetGeoTransform()
@@ -7,12 +7,11 @@ IS_SYSTEM = False
 
 
 def run_check(params, status):
-    import osgeo.gdal as gdal
-
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import open_raster
 
     for layer_def in do_raster_layers(params):
-        ds = gdal.Open(str(layer_def["src_filepath"]))
+        ds = open_raster(layer_def["src_filepath"], params)
 
         # get raster pixel size
         gt = ds.GetGeoTransform()
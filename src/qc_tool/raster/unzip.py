@@ -4,9 +4,13 @@
 
 DESCRIPTION = "Delivery file can be unzipped."
 IS_SYSTEM = True
+PROVIDES = ("unzip_dir", "unzip_filepaths", "vsizip_filepath")
 
 
 def run_check(params, status):
     # Raster layers are unzipped to the temporary directory r_unzip.d.
     from qc_tool.vector.helper import do_unzip
-    do_unzip(params["filepath"], params["tmp_dir"].joinpath("r_unzip.d"), status)
+    # If vsizip is set, the rasters are read directly from the zip file,
+    # the members are extracted later only by the checks which need local files.
+    do_unzip(params["filepath"], params["tmp_dir"].joinpath("r_unzip.d"), status, params.get("extract_formats"),
+             extract=not params.get("vsizip", False))
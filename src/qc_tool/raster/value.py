@@ -7,8 +7,11 @@ IS_SYSTEM = False
 
 
 def run_check(params, status):
-    import osgeo.gdal as gdal
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import get_code_histogram
+    from qc_tool.raster.helper import get_gdal_config
+    from qc_tool.raster.helper import get_gdal_path
+    from qc_tool.translate import config_options
 
     # extract validcodes parameter. An item in validcodes can be a single number or a range.
     valid_codes = []
@@ -20,16 +23,12 @@ def run_check(params, status):
 
 
     for layer_def in do_raster_layers(params):
-        ds = gdal.Open(str(layer_def["src_filepath"]))
-
         # get dictionary of pixel 'codes-counts'
-        ds_band = ds.GetRasterBand(1)
-        counts = ds_band.GetHistogram(approx_ok=False)
-        codes = range(len(counts))
-        hist = dict(zip(codes, counts))
+        with config_options(get_gdal_config(params)):
+            hist = get_code_histogram(get_gdal_path(layer_def["src_filepath"], params), params.get("tmp_dir"))
 
         # get list of 'used' codes (with non-zero pixel count)
-        used_codes = [i for i in hist if hist[i] != 0]
+        used_codes = [i for i in sorted(hist) if hist[i] != 0]
 
         # check particular codes against given list of valid codes
         invalid_codes = list()
@@ -6,8 +6,11 @@ DESCRIPTION = "Pixels have values within a specified range."
 IS_SYSTEM = False
 
 def run_check(params, status):
-    import osgeo.gdal as gdal
     from qc_tool.raster.helper import do_raster_layers
+    from qc_tool.raster.helper import get_gdal_config
+    from qc_tool.raster.helper import get_gdal_path
+    from qc_tool.raster.helper import get_raster_stats
+    from qc_tool.translate import config_options
 
     
     # Pass the parameters as min_allowed and max_allowed.
@@ -15,12 +18,14 @@ def run_check(params, status):
     max_allowed = params.get("max_allowed")
 
     for layer_def in do_raster_layers(params):
-        ds = gdal.Open(str(layer_def["src_filepath"]))
-        ds_band = ds.GetRasterBand(1)
+        # Exact min/max values (ignoring NoData)
+        with config_options(get_gdal_config(params)):
+            stats = get_raster_stats(get_gdal_path(layer_def["src_filepath"], params), params.get("tmp_dir"))
+        if stats.min is None:
+            status.info("Layer {:s} has no pixels with data.".format(layer_def["src_layer_name"]))
+            continue
+        min_val, max_val = stats.min, stats.max
 
-        # Compute exact min/max values (ignoring NoData)
-        min_val, max_val = ds_band.ComputeRasterMinMax(False)
-        
         errors = []
 
         # Check against min_allowed if it is set
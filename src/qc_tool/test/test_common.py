@@ -114,3 +114,24 @@ class TestCommonWithConfig(TestCase):
         job_dir.mkdir(exist_ok=True)
         store_job_result({"job_uuid": job_uuid})
         self.assertDictEqual({"job_uuid": job_uuid}, load_job_result(job_uuid))
+
+    def test_estimate_job_cost(self):
+        from qc_tool.common import JOB_SHORT_RUNTIME
+        from qc_tool.common import estimate_job_cost
+        from qc_tool.common import get_job_cpus
+        job_cpus = {"raster": 6, "vector": 3}
+        self.assertEqual(6, estimate_job_cost("raster", 1000, None, job_cpus)["cpus"])
+        self.assertEqual(3, estimate_job_cost("vector", 1000, JOB_SHORT_RUNTIME * 2, job_cpus)["cpus"])
+        self.assertEqual(1, estimate_job_cost("raster", 1000, JOB_SHORT_RUNTIME / 2, job_cpus)["cpus"])
+        # Without the parallelism sent by the worker, the local configuration is used.
+        self.assertEqual(get_job_cpus()["vector"], estimate_job_cost("vector", 1000)["cpus"])
+
+    def test_worker_pool_opt_in(self):
+        from os import environ
+        from unittest.mock import patch
+        from qc_tool.common import setup_config
+        with patch.dict(environ):
+            environ.pop("WORKER_POOL_SIZE", None)
+            self.assertEqual(0, setup_config()["worker_pool_size"])
+            environ["WORKER_POOL_SIZE"] = "2"
+            self.assertEqual(2, setup_config()["worker_pool_size"])
@@ -32,9 +32,76 @@ class TestValidateSkipSteps(TestCase):
         self.assertRaisesRegex(QCException, "Required step 1 can not be skipped.", validate_skip_steps, [1], self.product_definition)
 
 
-class Test_dump_error_table(VectorCheckTestCase):
+class Test_verify_signature(TestCase):
     def test(self):
-        from qc_tool.worker.dispatch import dump_error_table
+        from pathlib import Path
+        from tempfile import TemporaryDirectory
+        from qc_tool.worker.dispatch import make_signature
+        from qc_tool.worker.dispatch import verify_signature
+        with TemporaryDirectory() as tmp_dir:
+            filepath = Path(tmp_dir).joinpath("delivery.zip")
+            filepath.write_bytes(b"delivery")
+            file_stat = filepath.stat()
+            signature = {"hash": "uploaded_hash", "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+            self.assertEqual("uploaded_hash", verify_signature(filepath, signature))
+            self.assertEqual(make_signature(filepath), verify_signature(filepath))
+
+            # Changed file is hashed again.
+            signature["mtime_ns"] -= 1
+            self.assertEqual(make_signature(filepath), verify_signature(filepath, signature))
+
+
+class Test_is_concurrent_check(TestCase):
+    def test(self):
+        from qc_tool.worker.dispatch import is_concurrent_check
+        import qc_tool.raster.color
+        import qc_tool.raster.naming
+        import qc_tool.raster.unzip
+        import qc_tool.vector.attribute
+        import qc_tool.vector.gap
+        self.assertTrue(is_concurrent_check(qc_tool.raster.color))
+        self.assertTrue(is_concurrent_check(qc_tool.vector.attribute))
+        self.assertFalse(is_concurrent_check(qc_tool.raster.unzip))
+        self.assertFalse(is_concurrent_check(qc_tool.raster.naming))
+        self.assertFalse(is_concurrent_check(qc_tool.vector.gap))
+
+
+class Test_dump_step_tables(VectorCheckTestCase):
+    def test(self):
+        from qc_tool.worker.dispatch import dump_step_tables
+        cursor = self.params["connection_manager"].get_connection().cursor()
+
+        # Create a source layer and error tables.
+        cursor.execute("CREATE TABLE pg_table (fid integer, attr1 char(1), geom geometry(Polygon, 3035));")
+        cursor.execute("INSERT INTO pg_table VALUES (1, 'a', ST_MakeEnvelope(0, 0, 1, 1, 3035)),"
+                                                  " (2, 'b', ST_MakeEnvelope(2, 0, 3, 1, 3035));")
+        cursor.execute("CREATE TABLE error_table (fid integer);")
+        cursor.execute("INSERT INTO error_table VALUES (1), (3);")
+        cursor.execute("CREATE TABLE warning_table (fid integer);")
+        cursor.execute("INSERT INTO warning_table VALUES (1), (2);")
+        output_dir = self.params["jobdir_manager"].output_dir
+
+        # Export into geopackage.
+        filename = dump_step_tables(self.params["connection_manager"],
+                                    3,
+                                    "qc_tool.vector.gap",
+                                    [("error_table", "pg_table", "fid"), ("warning_table", "pg_table", "fid")],
+                                    ["pg_table"],
+                                    output_dir,
+                                    "src")
+        filepath = output_dir.joinpath("src_s03_gap.gpkg")
+        self.assertEqual(filepath.name, filename)
+        self.assertTrue(filepath.is_file())
+
+        # Validate the exported geopackage.
+        dsrc = ogr.Open(str(filepath), GA_ReadOnly)
+        self.assertEqual(3, dsrc.GetLayerCount())
+        self.assertEqual(1, dsrc.GetLayerByName("error_table").GetFeatureCount())
+        self.assertEqual(2, dsrc.GetLayerByName("warning_table").GetFeatureCount())
+        self.assertEqual(2, dsrc.GetLayerByName("pg_table").GetFeatureCount())
+
+    def test_error_table(self):
+        from qc_tool.worker.dispatch import dump_step_tables
         cursor = self.params["connection_manager"].get_connection().cursor()
 
         # Create a source layer.
@@ -48,8 +115,13 @@ class Test_dump_error_table(VectorCheckTestCase):
         output_dir = self.params["jobdir_manager"].output_dir
 
         # Export into geopackage.
-        filename = dump_error_table(self.params["connection_manager"], "error_table", "pg_table", "fid", output_dir)
-        filepath = output_dir.joinpath("error_table.gpkg")
+        filename = dump_step_tables(self.params["connection_manager"],
+                                    1,
+                                    "qc_tool.vector.overlap",
+                                    [("error_table", "pg_table", "fid")],
+                                    [],
+                                    output_dir)
+        filepath = output_dir.joinpath("s01_overlap.gpkg")
         self.assertEqual(filepath.name, filename)
         self.assertTrue(filepath.is_file())
 
@@ -61,10 +133,8 @@ class Test_dump_error_table(VectorCheckTestCase):
         self.assertEqual("EPSG", dsrc.GetLayerByIndex(0).GetSpatialRef().GetAuthorityName(None))
         self.assertEqual("3035", dsrc.GetLayerByIndex(0).GetSpatialRef().GetAuthorityCode(None))
 
-
-class Test_dump_full_table(VectorCheckTestCase):
-    def test(self):
-        from qc_tool.worker.dispatch import dump_full_table
+    def test_full_table(self):
+        from qc_tool.worker.dispatch import dump_step_tables
         cursor = self.params["connection_manager"].get_connection().cursor()
 
         # Create a layer to be exported.
@@ -74,8 +144,8 @@ class Test_dump_full_table(VectorCheckTestCase):
         output_dir = self.params["jobdir_manager"].output_dir
 
         # Export into geopackage.
-        filename = dump_full_table(self.params["connection_manager"], "pg_table", output_dir)
-        filepath = output_dir.joinpath("pg_table.gpkg")
+        filename = dump_step_tables(self.params["connection_manager"], 1, "qc_tool.vector.gap", [], ["pg_table"], output_dir)
+        filepath = output_dir.joinpath("s01_gap.gpkg")
         self.assertEqual(filepath.name, filename)
         self.assertTrue(filepath.is_file())
 
@@ -86,3 +156,9 @@ class Test_dump_full_table(VectorCheckTestCase):
         self.assertEqual(2, dsrc.GetLayerByIndex(0).GetFeatureCount())
         self.assertEqual("EPSG", dsrc.GetLayerByIndex(0).GetSpatialRef().GetAuthorityName(None))
         self.assertEqual("3035", dsrc.GetLayerByIndex(0).GetSpatialRef().GetAuthorityCode(None))
+
+    def test_no_tables(self):
+        from qc_tool.worker.dispatch import dump_step_tables
+        output_dir = self.params["jobdir_manager"].output_dir
+        self.assertIsNone(dump_step_tables(self.params["connection_manager"], 1, "qc_tool.vector.gap", [], [], output_dir))
+        self.assertListEqual([], list(output_dir.iterdir()))
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+
+from unittest import TestCase
+
+
+class Test_importtime(TestCase):
+    def test_no_heavy_imports(self):
+        from qc_tool.tools.importtime import find_heavy_imports
+        from qc_tool.tools.importtime import list_default_modules
+        from qc_tool.tools.importtime import measure_import
+        for module_name in list_default_modules():
+            with self.subTest(module_name=module_name):
+                self.assertListEqual([], find_heavy_imports(measure_import(module_name)))
+
+    def test_find_heavy_imports(self):
+        from qc_tool.tools.importtime import find_heavy_imports
+        self.assertListEqual(["numpy", "osgeo"],
+                             find_heavy_imports({"qc_tool.raster.helper": 20., "numpy.core": 80., "osgeo.gdal": 50., "osgeo": 60.}))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+
+import json
+import multiprocessing
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+
+def gdal_job(args):
+    """Changes the GDAL state or writes it into the file, depending on args."""
+    import osgeo.gdal as gdal
+    if args[0] == "change":
+        gdal.UseExceptions()
+        gdal.SetConfigOption("VSI_CACHE", "TRUE")
+        gdal.SetConfigOption("VSI_CACHE_SIZE", "1000")
+    else:
+        Path(args[1]).write_text(json.dumps([gdal.GetUseExceptions(),
+                                             gdal.GetConfigOption("VSI_CACHE"),
+                                             gdal.GetConfigOption("VSI_CACHE_SIZE")]))
+
+
+class Test_JobExecutor(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_gdal_state(self):
+        from qc_tool.worker.pool import JobExecutor
+        stdout_filepath = self.tmp_path.joinpath("job.stdout")
+        report_filepath = self.tmp_path.joinpath("gdal_state.json")
+        executor = JobExecutor(multiprocessing.get_context("spawn"), gdal_job)
+        try:
+            self.assertEqual(0, executor.run(["report", str(report_filepath)], stdout_filepath))
+            initial_state = json.loads(report_filepath.read_text())
+            self.assertEqual(0, executor.run(["change"], stdout_filepath))
+            self.assertEqual(0, executor.run(["report", str(report_filepath)], stdout_filepath))
+            self.assertListEqual(initial_state, json.loads(report_filepath.read_text()))
+            self.assertEqual(3, executor.job_count)
+        finally:
+            executor.stop()
+
+    def test_crash(self):
+        from qc_tool.worker.pool import JobExecutor
+        executor = JobExecutor(multiprocessing.get_context("spawn"), exit_job)
+        try:
+            self.assertEqual(7, executor.run([], self.tmp_path.joinpath("job.stdout")))
+            self.assertFalse(executor.is_alive())
+        finally:
+            executor.stop()
+
+
+def exit_job(args):
+    import os
+    os._exit(7)
@@ -5,12 +5,70 @@ from unittest import skipIf
 from osgeo import gdal
 from osgeo import osr
 import numpy as np
+import skimage.measure as measure
 
 from qc_tool.common import CONFIG
 from qc_tool.common import TEST_DATA_DIR
 from qc_tool.test.helper import RasterCheckTestCase
 
 
+class Test_vsizip(RasterCheckTestCase):
+    def setUp(self):
+        super().setUp()
+        from qc_tool.raster.unzip import run_check as unzip_check
+        self.params.update({"tmp_dir": self.jobdir_manager.tmp_dir,
+                            "filepath": TEST_DATA_DIR.joinpath("raster", "fty_100m", "fty_2018_100m_eu_03035_v0_1.zip"),
+                            "vsizip": True})
+        status = self.status_class()
+        unzip_check(self.params, status)
+        self.params.update(status.params)
+
+    def test_unzip(self):
+        self.assertIn("vsizip_filepath", self.params)
+        self.assertListEqual([], list(self.params["unzip_dir"].iterdir()))
+        self.assertIn("fty_2018_100m_eu_03035_v0_1.tif", [path.name for path in self.params["unzip_filepaths"]])
+
+    def test_epsg(self):
+        from qc_tool.raster.epsg import run_check
+        from qc_tool.raster.naming import run_check as naming_check
+        self.params.update({"aoi_codes": ["eu"],
+                            "layer_names": {"layer_1": "^fty_2018_100m_(?P<aoi_code>.+)_[0-9]{5}.*.tif$"},
+                            "extensions": [".tfw"]})
+        status = self.status_class()
+        naming_check(self.params, status)
+        self.assertEqual("ok", status.status)
+        self.params.update(status.params)
+
+        self.params["epsg"] = 3035
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("ok", status.status)
+        self.assertListEqual([], list(self.params["unzip_dir"].iterdir()))
+
+    def test_extract_local_files(self):
+        from qc_tool.raster.helper import extract_local_files
+        from qc_tool.raster.helper import get_gdal_path
+        src_filepath = [path for path in self.params["unzip_filepaths"] if path.suffix == ".tif"][0]
+        self.assertTrue(get_gdal_path(src_filepath, self.params).startswith("/vsizip/"))
+        extract_local_files(self.params, [src_filepath])
+        self.assertTrue(src_filepath.is_file())
+        self.assertTrue(src_filepath.with_suffix(".clr").is_file())
+        self.assertTrue(src_filepath.with_name(src_filepath.name + ".vat.dbf").is_file())
+        self.assertEqual(str(src_filepath), get_gdal_path(src_filepath, self.params))
+
+    def test_open_raster(self):
+        from qc_tool.raster.helper import get_gdal_config
+        from qc_tool.raster.helper import open_raster
+        self.params["vsizip_cache_size"] = 10 ** 6
+        self.assertDictEqual({"VSI_CACHE": "TRUE", "VSI_CACHE_SIZE": "1000000"}, get_gdal_config(self.params))
+        src_filepath = [path for path in self.params["unzip_filepaths"] if path.suffix == ".tif"][0]
+        ds = open_raster(src_filepath, self.params)
+        self.assertIsNotNone(ds)
+        # The cache options are set only around the open, not for the whole process.
+        self.assertIsNone(gdal.GetConfigOption("VSI_CACHE"))
+        self.assertIsNone(gdal.GetConfigOption("VSI_CACHE_SIZE"))
+
+
 class Test_naming(RasterCheckTestCase):
     def test(self):
         from qc_tool.raster.naming import run_check
@@ -226,6 +284,74 @@ class Test_value(RasterCheckTestCase):
         self.assertEqual("failed", status.status)
         self.assertIn("Layer tmp_big_raster.tif has pixels with invalid values: 253.", status.messages)
 
+    def test_stats_reused(self):
+        from qc_tool.raster.helper import get_raster_stats
+        from qc_tool.raster.value import run_check
+        from qc_tool.raster.value_min_max import run_check as run_check_min_max
+
+        tmp_raster = self.jobdir_manager.tmp_dir.joinpath("test_raster.tif")
+        data = [[0, 1, 0, 255],
+                [0, 0, 9, 255],
+                [0, 0, 0, 255]]
+        RasterCheckTestCase.create_raster(tmp_raster, np.array(data), 10, nodata_value=255)
+        layer_defs = {"layer_1": {"src_filepath": tmp_raster, "src_layer_name": tmp_raster.name}}
+        self.params.update({"raster_layer_defs": layer_defs,
+                            "tmp_dir": self.jobdir_manager.tmp_dir,
+                            "validcodes": [0, 1],
+                            "min_allowed": 0,
+                            "max_allowed": 5})
+
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("failed", status.status)
+        self.assertIn("Layer test_raster.tif has pixels with invalid values: 9.", status.messages)
+        self.assertEqual(1, len(list(self.jobdir_manager.tmp_dir.glob("raster_stats_*.json"))))
+
+        status = self.status_class()
+        run_check_min_max(self.params, status)
+        self.assertEqual("failed", status.status)
+        self.assertIn("found max: 9.0000", status.messages[0])
+
+        stats = get_raster_stats(tmp_raster, self.jobdir_manager.tmp_dir)
+        self.assertDictEqual({0: 7, 1: 1, 9: 1}, stats.histogram)
+        self.assertEqual(3, stats.nodata_count)
+        self.assertEqual(9, stats.valid_count)
+        self.assertEqual(1, len(list(self.jobdir_manager.tmp_dir.glob("raster_stats_*.json"))))
+
+    def test_float_raster(self):
+        from qc_tool.raster.helper import get_raster_stats
+        from qc_tool.raster.value import run_check
+        from qc_tool.raster.value_min_max import run_check as run_check_min_max
+
+        tmp_raster = self.jobdir_manager.tmp_dir.joinpath("test_float_raster.tif")
+        data = np.array([[0., 1., np.nan, -9999.],
+                         [0., 1., 2., -9999.]])
+        ds = gdal.GetDriverByName("GTiff").Create(str(tmp_raster), 4, 2, 1, gdal.GDT_Float32)
+        ds.GetRasterBand(1).WriteArray(data)
+        ds.GetRasterBand(1).SetNoDataValue(-9999.)
+        ds = None
+        layer_defs = {"layer_1": {"src_filepath": tmp_raster, "src_layer_name": tmp_raster.name}}
+        self.params.update({"raster_layer_defs": layer_defs,
+                            "tmp_dir": self.jobdir_manager.tmp_dir,
+                            "validcodes": [0, 1],
+                            "min_allowed": 0,
+                            "max_allowed": 5})
+
+        stats = get_raster_stats(tmp_raster, self.jobdir_manager.tmp_dir)
+        self.assertIsNone(stats.histogram)
+        self.assertEqual(0., stats.min)
+        self.assertEqual(2., stats.max)
+
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("failed", status.status)
+        self.assertIn("Layer test_float_raster.tif has pixels with invalid values: 2.", status.messages)
+
+        status = self.status_class()
+        run_check_min_max(self.params, status)
+        self.assertEqual("ok", status.status)
+
+
 class Test_gap(RasterCheckTestCase):
 
     def setUp(self):
@@ -433,6 +559,23 @@ class Test_gap(RasterCheckTestCase):
         self.assertIn("s01_incomplete_raster_100m_testaoi_gap_warning.tif", status.attachment_filenames)
         self.assertTrue(self.params["output_dir"].joinpath(status.attachment_filenames[0]).exists())
 
+    def test_gaps_found_workers(self):
+        from qc_tool.raster.gap import run_check
+        self.params.update({"layers": ["layer_2"],
+                            "aoi_code": "testaoi",
+                            "outside_area_code": 255,
+                            "mask": "test",
+                            "workers": 2,
+                            "boundary_dir": TEST_DATA_DIR.joinpath("boundaries"),
+                            "tmp_dir": self.jobdir_manager.tmp_dir,
+                            "output_dir": self.jobdir_manager.output_dir,
+                            "step_nr": 1})
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertIn("has 1237 gap pixels", status.messages[0])
+        self.assertIn("s01_incomplete_raster_100m_testaoi_gap_warning.tif", status.attachment_filenames)
+        self.assertTrue(self.params["output_dir"].joinpath(status.attachment_filenames[0]).exists())
+
 
     def test_vector_aoi(self):
         layer_filepath1 = TEST_DATA_DIR.joinpath("raster", "checks", "gap", "raster_for_vector_aoi_ok.tif")
@@ -673,6 +816,102 @@ class Test_mmu(RasterCheckTestCase):
         self.assertEqual(1, len(status.messages))
         self.assertIn("5 exceptional objects under MMU limit", status.messages[0])
 
+    def test_export_batches(self):
+        from unittest.mock import patch
+        from osgeo import ogr
+        import qc_tool.raster.mmu as mmu
+
+        data = [[1, 0, 1, 1, 1, 0, 0],
+                [0, 0, 0, 0, 0, 0, 0],
+                [0, 1, 1, 1, 1, 0, 0],
+                [0, 1, 1, 1, 1, 0, 1],
+                [1, 0, 0, 0, 0, 1, 1],
+                [1, 1, 1, 1, 0, 1, 1]]
+        RasterCheckTestCase.create_raster(self.tmp_raster, np.array(data), 10)
+        self.params.update({"layers": ["layer1"],
+                            "area_pixels": 8,
+                            "nodata_value": 9,
+                            "groupcodes": [],
+                            "step_nr": 1})
+
+        def export_features(output_dir):
+            self.params["output_dir"] = output_dir
+            status = self.status_class()
+            mmu.run_check(self.params, status)
+            self.assertEqual("ok", status.status)
+            ds = ogr.Open(str(output_dir.joinpath("s01_test_raster1_lessmmu_exception.gpkg")))
+            return [(feature.GetFID(), feature.GetField("area_px"), feature.GetField("value"),
+                     feature.GetGeometryRef().GetX(), feature.GetGeometryRef().GetY())
+                    for feature in ds.GetLayer()]
+
+        # All the regions fit into one batch.
+        expected_features = export_features(self.jobdir_manager.output_dir)
+        self.assertEqual(5, len(expected_features))
+
+        # The regions are written in three batches.
+        batched_dir = self.jobdir_manager.output_dir.joinpath("batched")
+        batched_dir.mkdir()
+        with patch.object(mmu, "EXPORT_BATCH_SIZE", 2):
+            batched_features = export_features(batched_dir)
+        self.assertListEqual(expected_features, batched_features)
+
+        # The regions match the patches classified over the whole raster at once.
+        labels = measure.label(np.array(data), background=9, connectivity=1)
+        patches = mmu.classify_patches(labels, np.array(data), 8, [], 0, 0, 6, 7)
+        self.assertListEqual(sorted(zip(patches.area[patches.area < 8].tolist(),
+                                        patches.value[patches.area < 8].tolist())),
+                             sorted((area, value) for fid, area, value, x, y in batched_features))
+
+    def test_classify_patches(self):
+        from qc_tool.raster.mmu import classify_patches
+        data = np.array([[1, 0, 1, 1, 1, 0, 0],
+                         [0, 0, 0, 0, 0, 0, 0],
+                         [0, 1, 1, 0, 1, 0, 0],
+                         [0, 1, 2, 0, 1, 0, 1],
+                         [1, 0, 0, 0, 0, 1, 1]])
+        labels = measure.label(data, background=9, connectivity=1)
+        patches = classify_patches(labels, data, 4, [2], 10, 0, 20, 17)
+        self.assertListEqual([1, 21, 3, 3, 2, 1, 3, 1], patches.area.tolist())
+        self.assertListEqual([1, 0, 1, 1, 1, 2, 1, 1], patches.value.tolist())
+        self.assertListEqual([[0, 0], [0, 1], [0, 2], [2, 1], [2, 4], [3, 2], [3, 6], [4, 0]],
+                             [[r, c] for r, c in zip(patches.row.tolist(), patches.col.tolist())])
+        self.assertListEqual([True, True, True, False, False, False, True, True], patches.touches_tile_edge.tolist())
+        self.assertListEqual([False, True, False, True, False, False, False, False], patches.touches_neighbour.tolist())
+        self.assertListEqual([True, True, True, False, False, False, True, False], patches.touches_raster_edge.tolist())
+
+    def test_seam_union_find(self):
+        from qc_tool.raster.mmu import SeamUnionFind
+        from qc_tool.raster.mmu import classify_patches
+        from qc_tool.raster.mmu import merge_seam
+        data = np.array([[0, 1, 1, 0, 0, 0],
+                         [0, 0, 1, 1, 0, 2],
+                         [0, 0, 0, 0, 1, 0]])
+        union_find = SeamUnionFind(6)
+        left_labels = measure.label(data[:, :3], background=9, connectivity=1)
+        left_patches = classify_patches(left_labels, data[:, :3], 20, [2], 0, 0, 3, 6)
+        left_ids = union_find.add(left_patches, 0, 0)
+        right_labels = measure.label(data[:, 3:], background=9, connectivity=1)
+        right_patches = classify_patches(right_labels, data[:, 3:], 20, [2], 3, 0, 3, 6)
+        right_ids = union_find.add(right_patches, 3, 0)
+
+        left_label_ids = np.full(left_labels.max() + 1, -1)
+        left_label_ids[left_patches.label] = left_ids
+        right_label_ids = np.full(right_labels.max() + 1, -1)
+        right_label_ids[right_patches.label] = right_ids
+        merge_seam(union_find,
+                   right_label_ids[right_labels[:, 0]], data[:, 3],
+                   left_label_ids[left_labels[:, -1]], data[:, 2],
+                   [2])
+
+        patches, frontier_ids = union_find.release(np.full(6, -1))
+        self.assertListEqual([7, 4, 4, 1, 1, 1], patches.area.tolist())
+        self.assertListEqual([0, 1, 0, 2, 1, 0], patches.value.tolist())
+        self.assertListEqual([[0, 0], [0, 1], [0, 3], [1, 5], [2, 4], [2, 5]],
+                             [[r, c] for r, c in zip(patches.row.tolist(), patches.col.tolist())])
+        self.assertListEqual([False, False, True, False, False, True], patches.touches_neighbour.tolist())
+        self.assertListEqual([-1, -1, -1, -1, -1, -1], frontier_ids.tolist())
+        self.assertEqual(0, union_find.size)
+
     def test_fail(self):
         # Prepare raster dataset with a patch smaller than MMU.
         data = np.zeros((4000, 3000), dtype=int)
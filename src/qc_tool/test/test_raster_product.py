@@ -53,6 +53,27 @@ class Test_Raster(ProductTestCase):
         step_statuses = [step_result["status"] for step_result in job_result["steps"]]
         self.assertListEqual(expected_step_results, step_statuses, self.show_messages(job_result))
 
+    def test_fty_2018_100m_step_workers(self):
+        """Independent steps run concurrently, results keep the order of steps."""
+        from qc_tool.common import CONFIG
+        from qc_tool.common import load_product_definition
+        product_ident = "fty_2018_100m"
+        filepath = self.raster_data_dir.joinpath("fty_100m", "fty_2018_100m_eu_03035_v0_1.zip")
+
+        expected_step_results = ["ok"] * 12
+        expected_step_results[2] = "skipped"
+
+        orig_step_workers = CONFIG["step_workers"]
+        CONFIG["step_workers"] = 3
+        try:
+            job_result = dispatch(self.job_uuid, self.username, filepath, product_ident, (3,))
+        finally:
+            CONFIG["step_workers"] = orig_step_workers
+        step_statuses = [step_result["status"] for step_result in job_result["steps"]]
+        self.assertListEqual(expected_step_results, step_statuses, self.show_messages(job_result))
+        self.assertListEqual([step_def["check_ident"] for step_def in load_product_definition(product_ident)["steps"]],
+                             [step_result["check_ident"] for step_result in job_result["steps"]])
+
     def test_gra_2018_010m(self):
         """High resolution grassland (GRA) - 10m"""
         product_ident = "gra_2018_010m"
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+
+from unittest import TestCase
+
+from qc_tool.test.helper import RasterCheckTestCase
+
+
+class Test_make_step_key(TestCase):
+    def test(self):
+        from qc_tool.worker.step_cache import make_step_key
+        key = make_step_key("", "hash", 1, {"check_ident": "qc_tool.raster.color", "parameters": {"a": 1, "b": 2}})
+        self.assertEqual(key, make_step_key("", "hash", 1, {"parameters": {"b": 2, "a": 1}, "check_ident": "qc_tool.raster.color"}))
+        self.assertNotEqual(key, make_step_key("", "hash", 1, {"check_ident": "qc_tool.raster.color", "parameters": {"a": 1, "b": 3}}))
+        self.assertNotEqual(make_step_key(key, 2), make_step_key(make_step_key("", "hash2"), 2))
+
+
+class Test_make_dir_version(RasterCheckTestCase):
+    def test(self):
+        from qc_tool.worker.step_cache import make_dir_version
+        boundary_dir = self.jobdir_manager.tmp_dir.joinpath("boundaries")
+        boundary_dir.joinpath("vector").mkdir(parents=True)
+        boundary_dir.joinpath("vector", "boundary.gpkg").write_text("boundary")
+        version = make_dir_version(boundary_dir)
+        self.assertEqual(version, make_dir_version(boundary_dir))
+        boundary_dir.joinpath("vector", "boundary.gpkg").write_text("changed boundary")
+        self.assertNotEqual(version, make_dir_version(boundary_dir))
+
+
+class Test_StepCache(RasterCheckTestCase):
+    def test(self):
+        from qc_tool.worker.step_cache import StepCache
+        cache_dir = self.jobdir_manager.tmp_dir.joinpath("step_cache")
+        output_dir = self.jobdir_manager.output_dir
+        output_dir.joinpath("s02_error.gpkg").write_text("error")
+        step_cache = StepCache(cache_dir)
+        self.assertIsNone(step_cache.load("key", output_dir))
+
+        step_result = {"check_ident": "qc_tool.raster.color",
+                       "status": "failed",
+                       "messages": ["Some message."],
+                       "attachment_filenames": ["s02_error.gpkg"]}
+        step_cache.store("key", step_result, {"prop": 1}, output_dir)
+        output_dir.joinpath("s02_error.gpkg").unlink()
+
+        (cached_step_result, status_properties) = step_cache.load("key", output_dir)
+        self.assertDictEqual({"status": "failed",
+                              "messages": ["Some message."],
+                              "attachment_filenames": ["s02_error.gpkg"]},
+                             cached_step_result)
+        self.assertDictEqual({"prop": 1}, status_properties)
+        self.assertEqual("error", output_dir.joinpath("s02_error.gpkg").read_text())
+
+    def test_aborted(self):
+        from qc_tool.worker.step_cache import StepCache
+        step_cache = StepCache(self.jobdir_manager.tmp_dir.joinpath("step_cache"))
+        step_result = {"status": "aborted", "messages": [], "attachment_filenames": []}
+        step_cache.store("key", step_result, {}, self.jobdir_manager.output_dir)
+        self.assertIsNone(step_cache.load("key", self.jobdir_manager.output_dir))
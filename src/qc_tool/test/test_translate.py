@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+
+import numpy
+from osgeo import gdal
+
+from qc_tool.test.helper import RasterCheckTestCase
+
+
+class Test_translate(RasterCheckTestCase):
+    def test(self):
+        from qc_tool.translate import translate
+        src_filepath = self.jobdir_manager.tmp_dir.joinpath("src.tif")
+        dst_filepath = self.jobdir_manager.tmp_dir.joinpath("dst.tif")
+        self.create_raster(src_filepath, numpy.array([[0, 1], [2, 3]]), 10)
+        translate(str(dst_filepath), str(src_filepath), ["-of", "GTiff", "-co", "COMPRESS=LZW"])
+        ds = gdal.Open(str(dst_filepath))
+        self.assertListEqual([[0, 1], [2, 3]], ds.GetRasterBand(1).ReadAsArray().tolist())
+
+    def test_error(self):
+        from qc_tool.translate import translate
+        from qc_tool.translate import TranslateError
+        src_filepath = self.jobdir_manager.tmp_dir.joinpath("missing.tif")
+        dst_filepath = self.jobdir_manager.tmp_dir.joinpath("dst.tif")
+        with self.assertRaises(TranslateError) as cm:
+            translate(str(dst_filepath), str(src_filepath), ["-of", "GTiff"])
+        self.assertEqual("Translate", cm.exception.operation)
+        self.assertFalse(dst_filepath.exists())
+
+
+class Test_config_options(RasterCheckTestCase):
+    def test(self):
+        from qc_tool.translate import config_options
+        self.assertIsNone(gdal.GetConfigOption("QC_TOOL_TEST_OPTION"))
+        with config_options({"QC_TOOL_TEST_OPTION": "YES"}):
+            self.assertEqual("YES", gdal.GetConfigOption("QC_TOOL_TEST_OPTION"))
+        self.assertIsNone(gdal.GetConfigOption("QC_TOOL_TEST_OPTION"))
@@ -52,6 +52,41 @@ class Test_unzip(VectorCheckTestCase):
         unzipped_subdir_names = [path.name for path in unzip_dir.glob("**") if path.is_dir()]
         self.assertIn("EE003L1_NARVA_UA2012.gdb", unzipped_subdir_names)
 
+    def test_file_index(self):
+        from qc_tool.vector.unzip import run_check
+        self.params["filepath"] = TEST_DATA_DIR.joinpath("vector", "ua", "gdb", "EE003L1_NARVA_UA2012.gdb.zip")
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("ok", status.status)
+        unzip_dir = status.params["unzip_dir"]
+        unzipped_filepaths = sorted(path for path in unzip_dir.glob("**/*") if path.is_file())
+        self.assertListEqual(unzipped_filepaths, status.params["unzip_filepaths"])
+
+    def test_extract_formats(self):
+        from qc_tool.vector.unzip import run_check
+        self.params["filepath"] = TEST_DATA_DIR.joinpath("vector", "rpz", "rpz_LCLU2012_DU007T.zip")
+        self.params["extract_formats"] = [".shp"]
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("ok", status.status)
+        unzipped_suffixes = set(path.suffix.lower() for path in status.params["unzip_filepaths"])
+        self.assertIn(".shp", unzipped_suffixes)
+        self.assertIn(".dbf", unzipped_suffixes)
+        self.assertLessEqual(unzipped_suffixes, {".shp", ".shx", ".dbf", ".prj", ".cpg", ".qix", ".sbn", ".sbx", ".xml"})
+
+    def test_member_outside(self):
+        from zipfile import ZipFile
+        from qc_tool.vector.unzip import run_check
+        zip_filepath = self.params["jobdir_manager"].tmp_dir.joinpath("outside.zip")
+        with ZipFile(str(zip_filepath), "w") as zip_file:
+            zip_file.writestr("../outside.txt", "outside")
+        self.params["filepath"] = zip_filepath
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("aborted", status.status)
+        self.assertIn("points outside of the archive", status.messages[0])
+        self.assertFalse(self.params["jobdir_manager"].tmp_dir.joinpath("outside.txt").exists())
+
     def test_invalid_extension(self):
         from qc_tool.vector.unzip import run_check
         self.params["filepath"] = TEST_DATA_DIR.joinpath("vector", "clc", "clc2012_mt.xml")
@@ -68,6 +103,126 @@ class Test_unzip(VectorCheckTestCase):
         self.assertEqual("aborted", status.status, "Unzipping a non-existent v_unzip should be aborted.")
 
 
+class Test_S3Download(VectorCheckTestCase):
+    class FakeBody():
+        def __init__(self, data):
+            self.data = data
+
+        def iter_chunks(self, chunk_size):
+            for i in range(0, len(self.data), chunk_size):
+                yield self.data[i:i + chunk_size]
+
+    class FakeClient():
+        # Stand-in for S3 storage serving ranged requests of one object.
+        def __init__(self, data, fail_part_offset=None):
+            self.data = data
+            self.fail_part_offset = fail_part_offset
+            self.requested_ranges = []
+
+        def get_object(self, Bucket, Key, Range, IfMatch):
+            (first, last) = [int(pos) for pos in Range[len("bytes="):].split("-")]
+            if first == self.fail_part_offset:
+                raise OSError("Connection reset.")
+            self.requested_ranges.append((first, last))
+            return {"Body": Test_S3Download.FakeBody(self.data[first:last + 1])}
+
+    def setUp(self):
+        super().setUp()
+        self.data = bytes(range(256)) * 40
+        self.partial_dir = self.params["jobdir_manager"].tmp_dir.joinpath("s3_partial.d")
+        self.partial_dir.mkdir()
+
+    def test(self):
+        import hashlib
+        from qc_tool.vector.helper import S3Download
+        from qc_tool.vector.helper import download_s3_objects
+        client = self.FakeClient(self.data)
+        s3_download = S3Download(client, "bucket", "delivery.zip", len(self.data), "etag", self.partial_dir, part_size=1000)
+        download_s3_objects([s3_download], workers=4)
+        dst_filepath = self.params["jobdir_manager"].tmp_dir.joinpath("delivery.zip")
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(), s3_download.finish(dst_filepath))
+        self.assertEqual(self.data, dst_filepath.read_bytes())
+        self.assertEqual(11, len(client.requested_ranges))
+        self.assertListEqual([s3_download.lock_filepath], list(self.partial_dir.iterdir()))
+
+    def test_resume(self):
+        import hashlib
+        from qc_tool.vector.helper import S3Download
+        from qc_tool.vector.helper import download_s3_objects
+        client = self.FakeClient(self.data, fail_part_offset=5000)
+        with S3Download(client, "bucket", "delivery.zip", len(self.data), "etag", self.partial_dir, part_size=1000) as s3_download:
+            with self.assertRaises(OSError):
+                download_s3_objects([s3_download], workers=1)
+
+        # The next download requests only the missing parts.
+        client = self.FakeClient(self.data)
+        s3_download = S3Download(client, "bucket", "delivery.zip", len(self.data), "etag", self.partial_dir, part_size=1000)
+        download_s3_objects([s3_download], workers=2)
+        self.assertNotIn((0, 999), client.requested_ranges)
+        self.assertIn((5000, 5999), client.requested_ranges)
+        dst_filepath = self.params["jobdir_manager"].tmp_dir.joinpath("delivery.zip")
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(), s3_download.finish(dst_filepath))
+        self.assertEqual(self.data, dst_filepath.read_bytes())
+
+    def test_concurrent(self):
+        from threading import Thread
+        from qc_tool.vector.helper import S3Download
+        from qc_tool.vector.helper import download_s3_objects
+        tmp_dir = self.params["jobdir_manager"].tmp_dir
+        client_1 = self.FakeClient(self.data)
+        s3_download_1 = S3Download(client_1, "bucket", "delivery.zip", len(self.data), "etag", self.partial_dir, part_size=1000)
+        download_s3_objects([s3_download_1], workers=2)
+
+        # Another job downloading the same object waits until the first download finishes.
+        client_2 = self.FakeClient(self.data)
+        s3_download_2 = S3Download(client_2, "bucket", "delivery.zip", len(self.data), "etag", self.partial_dir, part_size=1000)
+        thread = Thread(target=download_s3_objects, args=([s3_download_2],))
+        thread.start()
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive())
+        s3_download_1.finish(tmp_dir.joinpath("delivery_1.zip"))
+        thread.join()
+        s3_download_2.finish(tmp_dir.joinpath("delivery_2.zip"))
+        self.assertEqual(self.data, tmp_dir.joinpath("delivery_1.zip").read_bytes())
+        self.assertEqual(self.data, tmp_dir.joinpath("delivery_2.zip").read_bytes())
+        self.assertEqual(11, len(client_2.requested_ranges))
+
+    def test_clean(self):
+        from qc_tool.vector.helper import S3Download
+        from qc_tool.vector.helper import clean_s3_partial_dir
+        from qc_tool.vector.helper import download_s3_objects
+        client = self.FakeClient(self.data, fail_part_offset=5000)
+        with S3Download(client, "bucket", "delivery.zip", len(self.data), "etag", self.partial_dir, part_size=1000) as s3_download:
+            with self.assertRaises(OSError):
+                download_s3_objects([s3_download], workers=1)
+            # The locked download is in progress, so it is not removed.
+            clean_s3_partial_dir(self.partial_dir, max_age=-1)
+            self.assertTrue(s3_download.partial_filepath.is_file())
+
+        # The recent download is kept to be resumed.
+        clean_s3_partial_dir(self.partial_dir)
+        self.assertTrue(s3_download.partial_filepath.is_file())
+        self.assertTrue(s3_download.state_filepath.is_file())
+
+        clean_s3_partial_dir(self.partial_dir, max_age=-1)
+        self.assertListEqual([], list(self.partial_dir.iterdir()))
+
+        # The download after the cleanup starts anew.
+        client = self.FakeClient(self.data)
+        s3_download = S3Download(client, "bucket", "delivery.zip", len(self.data), "etag", self.partial_dir, part_size=1000)
+        download_s3_objects([s3_download], workers=2)
+        self.assertEqual(11, len(client.requested_ranges))
+        s3_download.release()
+
+    def test_partial_dir(self):
+        from pathlib import Path
+        from qc_tool.vector.helper import get_s3_partial_dir
+        tmp_dir = self.params["jobdir_manager"].tmp_dir
+        self.assertEqual(tmp_dir.joinpath("s3_partial.d"), get_s3_partial_dir({"tmp_dir": tmp_dir}))
+        self.assertEqual(Path("/mnt/s3_download"),
+                         get_s3_partial_dir({"tmp_dir": tmp_dir, "s3_download_dir": Path("/mnt/s3_download")}))
+
+
 class Test_naming_rpz(VectorCheckTestCase):
     def setUp(self):
         super().setUp()
@@ -449,6 +604,58 @@ class Test_import2pg(VectorCheckTestCase):
         run_check(self.params, status)
         self.assertEqual("aborted", status.status)
 
+    def test_workers(self):
+        from osgeo import ogr
+        from qc_tool.vector.import2pg import run_check
+        gdb_dir = TEST_DATA_DIR.joinpath("vector", "clc", "clc2012_mt.gdb")
+        src_layer_names = ["clc06_MT", "clc12_MT", "cha12_MT"]
+        layer_defs = {}
+        for i, src_layer_name in enumerate(src_layer_names):
+            layer_defs["layer_{:d}".format(i)] = {"src_filepath": gdb_dir,
+                                                  "src_layer_name": src_layer_name,
+                                                  "layer_alias": "layer_{:d}".format(i)}
+        self.params.update({"layer_defs": layer_defs,
+                            "layers": list(layer_defs),
+                            "pg_workers": 2})
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("ok", status.status)
+
+        src_ds = ogr.Open(str(gdb_dir))
+        cursor = self.params["connection_manager"].get_connection().cursor()
+        for layer_alias, layer_def in layer_defs.items():
+            self.assertEqual(layer_alias, layer_def["pg_layer_name"])
+            self.assertEqual("objectid", layer_def["pg_fid_name"])
+            cursor.execute("SELECT count(*) FROM {:s};".format(layer_def["pg_layer_name"]))
+            self.assertEqual(src_ds.GetLayerByName(layer_def["src_layer_name"]).GetFeatureCount(),
+                             cursor.fetchone()[0])
+
+    def test_workers_abort(self):
+        from qc_tool.vector.import2pg import run_check
+        gdb_dir = TEST_DATA_DIR.joinpath("vector", "clc", "clc2012_mt.gdb")
+        bad_filepath = TEST_DATA_DIR.joinpath("raster", "checks", "r11", "test_raster1.tif")
+        self.params.update({"layer_defs": {"layer_0": {"src_filepath": gdb_dir,
+                                                       "src_layer_name": "clc12_mt",
+                                                       "layer_alias": "layer_0"},
+                                           "layer_1": {"src_filepath": bad_filepath,
+                                                       "src_layer_name": "irrelevant_layer",
+                                                       "layer_alias": "layer_1"},
+                                           "layer_2": {"src_filepath": gdb_dir,
+                                                       "src_layer_name": "missing_layer",
+                                                       "layer_alias": "layer_2"}},
+                            "layers": ["layer_0", "layer_1", "layer_2"],
+                            "pg_workers": 2})
+        status = self.status_class()
+        run_check(self.params, status)
+        self.assertEqual("aborted", status.status)
+        self.assertIn("Failed to import layer irrelevant_layer into PostGIS. The source can not be opened.",
+                      status.messages)
+        self.assertEqual(1, len([message for message in status.messages
+                                 if message.startswith("Failed to import layer missing_layer into PostGIS."
+                                                       " VectorTranslate has failed")]))
+        # The layer imported successfully is still set up for the following steps.
+        self.assertEqual("layer_0", self.params["layer_defs"]["layer_0"]["pg_layer_name"])
+
     def test_precision(self):
         """ogr2ogr parameter PRECISION=NO should supress numeric field overflow error."""
         from qc_tool.vector.import2pg import run_check
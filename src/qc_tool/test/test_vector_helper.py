@@ -34,6 +34,66 @@ class Test_extract_srid(VectorCheckTestCase):
         self.assertEqual(4326, srid)
 
 
+class Test_layer_cache(VectorCheckTestCase):
+    def test(self):
+        from uuid import uuid4
+        from qc_tool.vector.helper import attach_layer_cache
+        from qc_tool.vector.helper import evict_layer_cache
+        from qc_tool.vector.helper import publish_cached_tables
+        from qc_tool.vector.helper import restore_cached_tables
+        cursor = self.params["connection_manager"].get_connection().cursor()
+        self.assertFalse(restore_cached_tables(cursor.connection, "mylayer", ["mylayer"]))
+
+        cache_schema = attach_layer_cache(cursor.connection, "mylayer", uuid4().hex)
+        self.assertFalse(restore_cached_tables(cursor.connection, "mylayer", ["mylayer"]))
+        cursor.execute("CREATE TABLE mylayer (fid integer PRIMARY KEY, geom geometry(MultiPolygon, 4326));")
+        cursor.execute("INSERT INTO mylayer VALUES (1, ST_Multi(ST_MakeEnvelope(0, 0, 1, 1, 4326))),"
+                                                 " (2, ST_Multi(ST_MakeEnvelope(1, 0, 2, 1, 4326)));")
+        publish_cached_tables(cursor.connection, "mylayer", ["mylayer"])
+        cursor.execute("DROP TABLE mylayer;")
+
+        self.assertTrue(restore_cached_tables(cursor.connection, "mylayer", ["mylayer"]))
+        cursor.execute("SELECT fid, ST_AsText(geom) FROM mylayer ORDER BY fid;")
+        self.assertListEqual([(1, "MULTIPOLYGON(((0 0,0 1,1 1,1 0,0 0)))"),
+                              (2, "MULTIPOLYGON(((1 0,1 1,2 1,2 0,1 0)))")],
+                             cursor.fetchall())
+
+        # Zero size evicts all cached layers.
+        evict_layer_cache(cursor.connection, 0)
+        cursor.execute("SELECT FROM pg_namespace WHERE nspname = %s;", [cache_schema])
+        self.assertEqual(0, cursor.rowcount)
+
+
+class Test_make_layer_cache_key(VectorCheckTestCase):
+    def test_shapefile_sidecars(self):
+        from qc_tool.vector.helper import make_layer_cache_key
+        src_dir = self.params["jobdir_manager"].tmp_dir.joinpath("shp")
+        src_dir.mkdir()
+        for suffix in (".shp", ".shx", ".dbf", ".prj"):
+            src_dir.joinpath("layer{:s}".format(suffix)).write_bytes(suffix.encode())
+        layer_def = {"src_filepath": src_dir.joinpath("layer.shp"), "src_layer_name": "layer", "layer_alias": "layer_0"}
+        key = make_layer_cache_key(layer_def)
+        self.assertEqual(key, make_layer_cache_key(layer_def))
+
+        # Changed attributes make another key.
+        src_dir.joinpath("layer.dbf").write_bytes(b"changed")
+        self.assertNotEqual(key, make_layer_cache_key(layer_def))
+
+    def test_src_hashes(self):
+        from qc_tool.vector.helper import make_layer_cache_key
+        src_filepath = self.params["jobdir_manager"].tmp_dir.joinpath("layers.gpkg")
+        src_filepath.write_bytes(b"gpkg")
+        src_hashes = {}
+        key_0 = make_layer_cache_key({"src_filepath": src_filepath, "src_layer_name": "a", "layer_alias": "layer_0"},
+                                     src_hashes=src_hashes)
+        src_filepath.write_bytes(b"changed")
+        # The hash of the source is computed only once.
+        key_1 = make_layer_cache_key({"src_filepath": src_filepath, "src_layer_name": "a", "layer_alias": "layer_0"},
+                                     src_hashes=src_hashes)
+        self.assertEqual(key_0, key_1)
+        self.assertListEqual([src_filepath], list(src_hashes))
+
+
 class Test_PartitionedLayer(VectorCheckTestCase):
     def setUp(self):
         super().setUp()
@@ -147,6 +207,32 @@ class Test_PartitionedLayer(VectorCheckTestCase):
                               (3, 5, "POLYGON((5 1,5 2,6 2,6 1,5 1))")],
                              cursor.fetchall())
 
+    def test_fill_subpartitions_workers(self):
+        from qc_tool.vector.helper import PartitionedLayer
+        cursor = self.connection.cursor()
+        cursor.execute("CREATE TABLE partition_mylayer (partition_id integer,"
+                                                      " superpartition_id integer,"
+                                                      " num_vertices integer,"
+                                                      " geom geometry(Polygon, 4326));")
+        cursor.execute("INSERT INTO partition_mylayer VALUES (2, 1, NULL, ST_MakeEnvelope(-10, 0, 0, 3, 4326)),"
+                                                           " (3, 1, NULL, ST_MakeEnvelope(0, 0, 10, 3, 4326)),"
+                                                           " (4, 3, NULL, ST_MakeEnvelope(0, 0, 5, 3, 4326)),"
+                                                           " (5, 3, NULL, ST_MakeEnvelope(5, 0, 10, 3, 4326));")
+        cursor.execute("CREATE TABLE feature_mylayer (fid integer, partition_id integer, geom geometry(Polygon, 4326));")
+        cursor.execute("INSERT INTO feature_mylayer VALUES (1, 2, ST_MakeEnvelope(-5, 1, -3, 2, 4326)),"
+                                                         " (2, 3, ST_MakeEnvelope(4, 1, 7, 2, 4326)),"
+                                                         " (3, 3, ST_MakeEnvelope(5, 1, 6, 2, 4326));")
+        partitioned_layer = PartitionedLayer(self.connection, "mylayer", "xfid", workers=2)
+        partitioned_layer._create_polygon_dump()
+        partitioned_layer._fill_subpartitions()
+        cursor.execute("SELECT fid, partition_id, ST_AsText(geom) FROM feature_mylayer ORDER BY fid, partition_id;")
+        self.assertListEqual([(1, 2, "POLYGON((-5 1,-5 2,-3 2,-3 1,-5 1))"),
+                              (2, 3, "POLYGON((4 1,4 2,7 2,7 1,4 1))"),
+                              (2, 4, "POLYGON((4 1,4 2,5 2,5 1,4 1))"),
+                              (2, 5, "POLYGON((5 2,7 2,7 1,5 1,5 2))"),
+                              (3, 5, "POLYGON((5 1,5 2,6 2,6 1,5 1))")],
+                             cursor.fetchall())
+
     def test_delete_superitems(self):
         from qc_tool.vector.helper import PartitionedLayer
         cursor = self.connection.cursor()
@@ -182,12 +268,15 @@ class Test_NeighbourTable(VectorCheckTestCase):
         super().setUp()
         self.connection = self.params["connection_manager"].get_connection()
         cursor = self.connection.cursor()
-        cursor.execute("CREATE TABLE feature_mylayer (fid integer, geom geometry(Polygon, 4326));")
-        cursor.execute("INSERT INTO feature_mylayer VALUES (1, ST_MakeEnvelope(0, 0, 1.1, 1, 4326)),"
-                                                         " (2, ST_MakeEnvelope(1, 0, 2, 1, 4326)),"
-                                                         " (3, ST_MakeEnvelope(2, 0, 3, 1, 4326)),"
-                                                         " (4, ST_MakeEnvelope(4, 0, 5, 1, 4326)),"
-                                                         " (5, ST_MakeEnvelope(5, 0, 6, 1, 4326));")
+        cursor.execute("CREATE TABLE partition_mylayer (partition_id integer);")
+        cursor.execute("INSERT INTO partition_mylayer VALUES (1), (2);")
+        cursor.execute("CREATE TABLE feature_mylayer (fid integer, partition_id integer, geom geometry(Polygon, 4326));")
+        cursor.execute("INSERT INTO feature_mylayer VALUES (1, 1, ST_MakeEnvelope(0, 0, 1.1, 1, 4326)),"
+                                                         " (2, 1, ST_MakeEnvelope(1, 0, 2, 1, 4326)),"
+                                                         " (3, 1, ST_MakeEnvelope(2, 0, 3, 1, 4326)),"
+                                                         " (4, 1, ST_MakeEnvelope(4, 0, 4.5, 1, 4326)),"
+                                                         " (4, 2, ST_MakeEnvelope(4.5, 0, 5, 1, 4326)),"
+                                                         " (5, 2, ST_MakeEnvelope(5, 0, 6, 1, 4326));")
 
     def test_fill(self):
         from qc_tool.vector.helper import PartitionedLayer
@@ -206,6 +295,37 @@ class Test_NeighbourTable(VectorCheckTestCase):
                               (5, 4, 1)],
                              cursor.fetchall())
 
+    def test_fill_workers(self):
+        from qc_tool.vector.helper import PartitionedLayer
+        from qc_tool.vector.helper import NeighbourTable
+        partitioned_layer = PartitionedLayer(self.connection, "mylayer", "xfid", srid=4326, workers=2)
+        neighbour_table = NeighbourTable(partitioned_layer)
+        neighbour_table._create_neighbour_table()
+        neighbour_table._fill()
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT fida, fidb, dim FROM neighbour_mylayer ORDER BY fida, fidb;")
+        self.assertListEqual([(1, 2, 2),
+                              (2, 1, 2),
+                              (2, 3, 1),
+                              (3, 2, 1),
+                              (4, 5, 1),
+                              (5, 4, 1)],
+                             cursor.fetchall())
+
+    def test_not_cached(self):
+        from uuid import uuid4
+        from qc_tool.vector.helper import PartitionedLayer
+        from qc_tool.vector.helper import NeighbourTable
+        from qc_tool.vector.helper import attach_layer_cache
+        from qc_tool.vector.helper import restore_cached_tables
+        attach_layer_cache(self.connection, "mylayer", uuid4().hex)
+        # The table made from the partitions with non-default parameters is not published into the cache.
+        partitioned_layer = PartitionedLayer(self.connection, "mylayer", "xfid", srid=4326, max_vertices=10)
+        NeighbourTable(partitioned_layer).make()
+        cursor = self.connection.cursor()
+        cursor.execute("DROP TABLE neighbour_mylayer;")
+        self.assertFalse(restore_cached_tables(self.connection, "mylayer", ["neighbour_mylayer"]))
+
 
 class Test_MetaTable(VectorCheckTestCase):
     def setUp(self):
@@ -379,16 +499,48 @@ class Test_ComplexChangeProperty(VectorCheckTestCase):
         complex_change_property._fill_cluster("cc_id_initial", "code1")
         complex_change_property._fill_cluster("cc_id_final", "code2")
         cursor.execute("SELECT fid, cc_id_initial, cc_id_final FROM meta_mylayer ORDER BY fid;")
-        self.assertListEqual([(1, None, None),
-                              (2, 2, None),
-                              (3, 2, None),
-                              (4, 2, 4),
+        # Features 1 to 4 share code1 A and form a chain, so fid 1 is the cluster id,
+        # features 4 to 7 share code2 D, so fid 7 belongs to the cluster of fid 4.
+        self.assertListEqual([(1, 1, None),
+                              (2, 1, None),
+                              (3, 1, None),
+                              (4, 1, 4),
                               (5, None, 4),
                               (6, None, 4),
-                              (7, None, None),
+                              (7, None, 4),
                               (8, None, None)],
                              cursor.fetchall())
 
+    def test_fill_cluster_root(self):
+        from qc_tool.vector.helper import PartitionedLayer
+        from qc_tool.vector.helper import NeighbourTable
+        from qc_tool.vector.helper import _MetaTable
+        from qc_tool.vector.helper import ComplexChangeProperty
+        cursor = self.connection.cursor()
+        partitioned_layer = PartitionedLayer(self.connection, "mylayer", "xfid")
+        neighbour_table = NeighbourTable(partitioned_layer)
+        neighbour_table._create_neighbour_table()
+        # The smallest neighbour of fid 2 is fid 8, which is not the root of their cluster.
+        cursor.execute("INSERT INTO neighbour_mylayer VALUES (1, 8, 1), (8, 1, 1),"
+                                                           " (2, 8, 1), (8, 2, 1),"
+                                                           " (3, 4, 1), (4, 3, 1);")
+        meta_table = _MetaTable(self.connection, "mylayer", "xfid")
+        meta_table._create_meta_table()
+        complex_change_property = ComplexChangeProperty(neighbour_table, "code1", "code2", "area")
+        complex_change_property._prepare_meta_table()
+        complex_change_property._fill_cluster("cc_id_initial", "code1")
+        complex_change_property._fill_cluster("cc_id_final", "code2")
+        cursor.execute("SELECT fid, cc_id_initial, cc_id_final FROM meta_mylayer ORDER BY fid;")
+        self.assertListEqual([(1, 1, None),
+                              (2, 1, None),
+                              (3, 3, None),
+                              (4, 3, None),
+                              (5, None, None),
+                              (6, None, None),
+                              (7, None, None),
+                              (8, 1, None)],
+                             cursor.fetchall())
+
     def test_fill_area(self):
         from qc_tool.vector.helper import PartitionedLayer
         from qc_tool.vector.helper import NeighbourTable
@@ -479,7 +631,7 @@ class Test_GapTable(VectorCheckTestCase):
         from qc_tool.vector.helper import GapTable
         from qc_tool.vector.helper import PartitionedLayer
         cursor = self.params["connection_manager"].get_connection().cursor()
-        cursor.execute("CREATE TABLE gap_mylayer (fid SERIAL PRIMARY KEY, geom geometry(Polygon, 4326));")
+        cursor.execute("CREATE TABLE gap_mylayer (fid SERIAL PRIMARY KEY, source_fid integer, partition_id integer, geom geometry(Polygon, 4326));")
         cursor.execute("INSERT INTO gap_mylayer (geom) VALUES (ST_MakeEnvelope(-6.8, -1.6, -1.2, -1.1, 4326)),"
                                                             " (ST_Union(ST_Union(ST_MakeEnvelope(0.2, 0.2, 8, 1.8, 4326),"
                                                                                " ST_MakeEnvelope(0.2, 3.2, 9.2, 4.2, 4326)),"
@@ -501,10 +653,10 @@ class Test_GapTable(VectorCheckTestCase):
         from qc_tool.vector.helper import GapTable
         from qc_tool.vector.helper import PartitionedLayer
         cursor = self.params["connection_manager"].get_connection().cursor()
-        cursor.execute("CREATE TABLE gap_mylayer (fid SERIAL PRIMARY KEY, geom geometry(Polygon, 4326));")
-        cursor.execute("INSERT INTO gap_mylayer (geom) VALUES (ST_MakeEnvelope(0, 0, 1, 1, 4326)),"
-                                                            " (ST_MakeEnvelope(0, 2, 2, 3, 4326)),"
-                                                            " (ST_MakeEnvelope(0, 3, 2, 4, 4326));")
+        cursor.execute("CREATE TABLE gap_mylayer (fid SERIAL PRIMARY KEY, source_fid integer, partition_id integer, geom geometry(Polygon, 4326));")
+        cursor.execute("INSERT INTO gap_mylayer (partition_id, geom) VALUES (1, ST_MakeEnvelope(0, 0, 1, 1, 4326)),"
+                                                                          " (3, ST_MakeEnvelope(0, 2, 2, 3, 4326)),"
+                                                                          " (3, ST_MakeEnvelope(0, 3, 2, 4, 4326));")
         cursor.execute("CREATE TABLE interior_mylayer (partition_id integer, geom geometry(MultiPolygon, 4326));")
         cursor.execute("INSERT INTO interior_mylayer VALUES (1, ST_Multi(ST_MakeEnvelope(-1, -1, 10, 10, 4326))),"
                                                           " (3, ST_Multi(ST_Union(ST_MakeEnvelope(0, 2, 1, 4, 4326),"
@@ -518,6 +670,30 @@ class Test_GapTable(VectorCheckTestCase):
                               (4, 'POLYGON((1 3,2 3,2 2,1 2,1 3))')],
                              cursor.fetchall())
 
+    def test_has_candidate_gaps(self):
+        from qc_tool.vector.helper import GapTable
+        from qc_tool.vector.helper import PartitionedLayer
+        cursor = self.params["connection_manager"].get_connection().cursor()
+        cursor.execute("CREATE TABLE partition_mylayer (partition_id integer, geom geometry(Polygon, 4326));")
+        cursor.execute("INSERT INTO partition_mylayer VALUES (1, ST_MakeEnvelope(0, 0, 10, 10, 4326)),"
+                                                           " (2, ST_MakeEnvelope(10, 0, 20, 10, 4326)),"
+                                                           " (3, ST_MakeEnvelope(20, 0, 30, 10, 4326));")
+        cursor.execute("CREATE TABLE gap_mylayer (fid SERIAL PRIMARY KEY, source_fid integer, partition_id integer, geom geometry(Polygon, 4326));")
+        cursor.execute("INSERT INTO gap_mylayer (partition_id, geom) VALUES (1, ST_MakeEnvelope(0, 0, 10, 10, 4326)),"
+                                                                          " (2, ST_MakeEnvelope(10, 0, 20, 10, 4326)),"
+                                                                          " (3, ST_MakeEnvelope(20, 0, 30, 10, 4326));")
+        cursor.execute("CREATE TABLE interior_mylayer (partition_id integer, geom geometry(MultiPolygon, 4326));")
+        # The interior of the partition 3 has a sliver gap narrower than the pre-screen pixel, not covering any pixel centre.
+        cursor.execute("INSERT INTO interior_mylayer VALUES (1, ST_Multi(ST_MakeEnvelope(0, 0, 10, 10, 4326))),"
+                                                          " (2, ST_Multi(ST_MakeEnvelope(10, 0, 17, 10, 4326))),"
+                                                          " (3, ST_Multi(ST_Union(ST_MakeEnvelope(20, 0, 25.1, 10, 4326),"
+                                                                                " ST_MakeEnvelope(25.3, 0, 30, 10, 4326))));")
+        partitioned_layer = PartitionedLayer(cursor.connection, "mylayer", "xfid", srid=4326)
+        gap_table = GapTable(partitioned_layer, "myboundary", None, prescreen_resolution=1.0)
+        self.assertFalse(gap_table._has_candidate_gaps(cursor.connection, 1))
+        self.assertTrue(gap_table._has_candidate_gaps(cursor.connection, 2))
+        self.assertTrue(gap_table._has_candidate_gaps(cursor.connection, 3))
+
 
 orig_polygon = ("""POLYGON(
 (4185553.87870000116527080535888671875 2421242.403499999083578586578369140625,
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+
+"""
+Reports import time of qc_tool modules.
+
+Every module is imported in a fresh interpreter run with -X importtime.
+The module is flagged if it imports a heavy dependency at module level,
+if its import takes longer than the budget,
+or if it is considerably slower than in the baseline saved by the previous run.
+
+Usage:
+    python -m qc_tool.tools.importtime [--budget-ms MS] [--baseline FILE] [--save-baseline FILE] [module ...]
+
+Exits with code 1 if any module is flagged.
+"""
+
+
+import json
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+from importlib.util import find_spec
+from pathlib import Path
+from pkgutil import iter_modules
+
+
+# Dependencies which must be imported inside the functions using them, not at module level.
+HEAVY_MODULES = ("boto3",
+                 "checksumdir",
+                 "django",
+                 "numpy",
+                 "osgeo",
+                 "psycopg2",
+                 "PyPDF2",
+                 "reportlab",
+                 "requests",
+                 "scipy",
+                 "skimage")
+
+# Modules left out of the default report, the script taken over from GDAL is imported by the cog check on first use.
+SKIPPED_MODULES = ("qc_tool.raster.validate_cloud_optimized_geotiff",)
+
+# Modules reported by default in addition to all modules of DEFAULT_PACKAGES.
+DEFAULT_MODULES = ("qc_tool.common",
+                   "qc_tool.translate",
+                   "qc_tool.worker.cmd",
+                   "qc_tool.worker.dispatch",
+                   "qc_tool.worker.manager",
+                   "qc_tool.worker.step_cache")
+DEFAULT_PACKAGES = ("qc_tool.vector", "qc_tool.raster")
+
+# Cumulative import time of the module in milliseconds.
+IMPORT_TIME_BUDGET = 200
+
+# The module is flagged if it is slower than the baseline by this ratio and by at least BASELINE_MIN_DIFF milliseconds.
+BASELINE_TOLERANCE = 1.5
+BASELINE_MIN_DIFF = 20
+
+IMPORTTIME_REGEX = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)$")
+
+
+def list_default_modules():
+    module_names = list(DEFAULT_MODULES)
+    for package_name in DEFAULT_PACKAGES:
+        # The package is located but not imported, so its import time is not spoiled.
+        package_dirs = find_spec(package_name).submodule_search_locations
+        for module_info in sorted(iter_modules(package_dirs), key=lambda module_info: module_info.name):
+            module_name = "{:s}.{:s}".format(package_name, module_info.name)
+            if not module_info.ispkg and module_name not in SKIPPED_MODULES:
+                module_names.append(module_name)
+    return module_names
+
+
+def measure_import(module_name):
+    """
+    Imports the module in a fresh interpreter.
+
+    :return: dict {imported module name: cumulative import time in milliseconds}.
+    :raises ImportError: if the module can not be imported.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {:s}".format(module_name)],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        message = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ""
+        raise ImportError("Module {:s} can not be imported: {:s}".format(module_name, message))
+    import_times = {}
+    for line in result.stderr.splitlines():
+        mobj = IMPORTTIME_REGEX.match(line)
+        if mobj is not None:
+            import_times[mobj.group(3)] = int(mobj.group(2)) / 1000
+    return import_times
+
+
+def find_heavy_imports(import_times):
+    """Returns the heavy dependencies found among the imported modules."""
+    heavy_imports = set()
+    for imported_name in import_times:
+        top_name = imported_name.split(".")[0]
+        if top_name in HEAVY_MODULES:
+            heavy_imports.add(top_name)
+    return sorted(heavy_imports)
+
+
+def check_module(module_name, budget=IMPORT_TIME_BUDGET, baseline=None):
+    """
+    Measures the import of the module and compares it with the budget and the baseline.
+
+    :return: tuple (import time in milliseconds or None if the module can not be imported, list of problems).
+    """
+    try:
+        import_times = measure_import(module_name)
+    except ImportError as ex:
+        return (None, [str(ex)])
+    import_time = import_times.get(module_name, 0.)
+    problems = []
+    heavy_imports = find_heavy_imports(import_times)
+    if len(heavy_imports) > 0:
+        problems.append("imports {:s} at module level".format(", ".join(heavy_imports)))
+    if import_time > budget:
+        problems.append("exceeds the budget of {:d} ms".format(budget))
+    if baseline is not None and module_name in baseline:
+        baseline_time = baseline[module_name]
+        if import_time > baseline_time * BASELINE_TOLERANCE and import_time - baseline_time > BASELINE_MIN_DIFF:
+            problems.append("slower than the baseline of {:.1f} ms".format(baseline_time))
+    return (import_time, problems)
+
+
+def main():
+    parser = ArgumentParser(description="Reports import time of qc_tool modules.")
+    parser.add_argument("--budget-ms",
+                        help="Import time budget of every module in milliseconds.",
+                        dest="budget",
+                        type=int,
+                        default=IMPORT_TIME_BUDGET)
+    parser.add_argument("--baseline",
+                        help="JSON file with import times of the previous run.",
+                        dest="baseline",
+                        default=None)
+    parser.add_argument("--save-baseline",
+                        help="JSON file the import times are saved into.",
+                        dest="save_baseline",
+                        default=None)
+    parser.add_argument("module_names",
+                        help="Modules to be reported, all check modules by default.",
+                        metavar="module",
+                        nargs="*")
+    pargs = parser.parse_args()
+
+    module_names = pargs.module_names if len(pargs.module_names) > 0 else list_default_modules()
+    baseline = None
+    if pargs.baseline is not None:
+        baseline = json.loads(Path(pargs.baseline).read_text())
+
+    import_times = {}
+    flagged_count = 0
+    for module_name in module_names:
+        (import_time, problems) = check_module(module_name, pargs.budget, baseline)
+        if import_time is not None:
+            import_times[module_name] = import_time
+            time_text = "{:8.1f} ms".format(import_time)
+        else:
+            time_text = "{:>8s}   ".format("-")
+        if len(problems) > 0:
+            flagged_count += 1
+            print("{:s}  {:s}  FLAGGED: {:s}".format(time_text, module_name, "; ".join(problems)))
+        else:
+            print("{:s}  {:s}".format(time_text, module_name))
+
+    if pargs.save_baseline is not None:
+        Path(pargs.save_baseline).write_text(json.dumps(import_times, indent=4, sort_keys=True))
+    print("{:d} of {:d} modules flagged.".format(flagged_count, len(module_names)))
+    sys.exit(1 if flagged_count > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+
+"""
+In-process counterparts of ogr2ogr, gdal_rasterize, gdal_translate and gdalbuildvrt.
+
+The options are the same as the command line options of the utilities.
+Errors reported by GDAL are collected and raised as TranslateError,
+the result does not depend on exit code which does not always signal failure.
+"""
+
+
+import logging
+import threading
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+# Datasources shared by subsequent calls in the same thread.
+_local = threading.local()
+
+
+class TranslateError(Exception):
+    def __init__(self, operation, messages):
+        self.operation = operation
+        self.messages = messages
+        if len(messages) == 0:
+            msg = "{:s} has failed with no message reported by GDAL.".format(operation)
+        else:
+            msg = "{:s} has failed: {:s}".format(operation, " ".join(messages))
+        super().__init__(msg)
+
+
+@contextmanager
+def config_options(options):
+    """Sets GDAL config options for the current thread only."""
+    from osgeo import gdal
+
+    orig_options = {key: gdal.GetThreadLocalConfigOption(key, None) for key in options}
+    for key, value in options.items():
+        gdal.SetThreadLocalConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in orig_options.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+
+def _run(operation, func, *args, config=None, **kwargs):
+    from osgeo import gdal
+
+    messages = []
+    def error_handler(err_class, err_no, msg):
+        if err_class >= gdal.CE_Failure:
+            messages.append(msg)
+        elif err_class == gdal.CE_Warning:
+            log.debug("{:s}: {:s}".format(operation, msg))
+
+    gdal.PushErrorHandler(error_handler)
+    try:
+        with config_options({} if config is None else config):
+            ds = func(*args, **kwargs)
+    except (RuntimeError, ValueError) as ex:
+        # GDAL raises RuntimeError if gdal.UseExceptions() has been called,
+        # the bindings raise ValueError if the source can not be opened.
+        messages.append(str(ex))
+        ds = None
+    finally:
+        gdal.PopErrorHandler()
+    if ds is None or len(messages) > 0:
+        raise TranslateError(operation, messages)
+    return ds
+
+
+def get_pg_datasource(conn_string):
+    """Returns PostGIS datasource opened for update, the datasource is shared by subsequent calls in the thread."""
+    from osgeo import gdal
+
+    if not hasattr(_local, "pg_datasources"):
+        _local.pg_datasources = {}
+    if conn_string not in _local.pg_datasources:
+        _local.pg_datasources[conn_string] = _run("Opening of {:s}".format(conn_string.split(" ")[-1]),
+                                                  gdal.OpenEx, conn_string, gdal.OF_VECTOR | gdal.OF_UPDATE)
+    return _local.pg_datasources[conn_string]
+
+
+def close_pg_datasources():
+    """Closes PostGIS datasources shared in the thread."""
+    if hasattr(_local, "pg_datasources"):
+        _local.pg_datasources.clear()
+
+
+def vector_translate(dst, src, options, config=None):
+    """
+    Runs ogr2ogr in process.
+
+    :param dst: destination name or opened datasource.
+    :param src: source name or opened datasource.
+    :param options: ogr2ogr command line options, the source layer names may be at the end.
+    :param config: dictionary of GDAL config options.
+    """
+    from osgeo import gdal
+
+    ds = _run("VectorTranslate", gdal.VectorTranslate, dst, src, options=options, config=config)
+    # Newly opened destination is closed here, so the data are flushed.
+    del ds
+
+
+def rasterize(dst, src, options, config=None):
+    """Runs gdal_rasterize in process."""
+    from osgeo import gdal
+
+    ds = _run("Rasterize", gdal.Rasterize, dst, src, options=options, config=config)
+    del ds
+
+
+def translate(dst, src, options, config=None):
+    """Runs gdal_translate in process."""
+    from osgeo import gdal
+
+    ds = _run("Translate", gdal.Translate, dst, src, options=options, config=config)
+    del ds
+
+
+def build_vrt(dst, srcs, options=None, config=None):
+    """Runs gdalbuildvrt in process."""
+    from osgeo import gdal
+
+    ds = _run("BuildVRT", gdal.BuildVRT, dst, srcs, options=[] if options is None else options, config=config)
+    del ds
@@ -13,7 +13,7 @@ def run_check(params, status):
     # Find supplementary documents, e.g. {clc2024_{aoi_code}_wumeta.pdf.
     for document_alias, document_regex in params.get("documents", {}).items():
         document_regex_with_aoi = document_regex.replace("{aoi_code}", params.get("aoi_code", ""))
-        document_filepaths = find_documents(params["unzip_dir"], document_regex_with_aoi)
+        document_filepaths = find_documents(params["unzip_dir"], document_regex_with_aoi, params.get("unzip_filepaths"))
         if not document_filepaths:
             status.failed("The delivery does not contain the working unit metadata document(s) '*wu*.pdf'.")
             return
@@ -4,6 +4,7 @@
 
 DESCRIPTION = "Layers use specific EPSG codes."
 IS_SYSTEM = False
+PROVIDES = ("detected_epsg",)
 
 
 def run_check(params, status):
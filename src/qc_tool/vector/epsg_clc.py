@@ -4,6 +4,7 @@
 
 DESCRIPTION = "EPSG codes of the layers match EPSG code of the boundary layer."
 IS_SYSTEM = False
+PROVIDES = ("layer_srs_epsg",)
 
 
 def run_check(params, status):
@@ -7,6 +7,7 @@ import logging
 
 DESCRIPTION = "There is no gap in the AOI."
 IS_SYSTEM = False
+IS_EXCLUSIVE = True
 DEFAULT_BOUNDARY_TOLERANCE = 0.01 # tolerance at the edge of the AOI in metres
 DEFAULT_GAP_AREA_TOLERANCE = 0.000001 # square metres
 DEFAULT_GAP_WIDTH_TOLERANCE = 0.00001 # square metres
@@ -41,13 +42,18 @@ def run_check(params, status):
     gap_area_tolerance = params.get("gap_area_tolerance", DEFAULT_GAP_AREA_TOLERANCE)
     gap_width_tolerance = params.get("gap_width_tolerance", DEFAULT_GAP_WIDTH_TOLERANCE)
 
+    # gap_prescreen_resolution optional parameter - pixel size in metres of the raster pre-screen.
+    # Only partitions with uncovered pixels are then checked exactly in postgis.
+    gap_prescreen_resolution = params.get("gap_prescreen_resolution", None)
+
     for layer_def in do_layers(params):
         log.debug("Started gap check for the layer {:s}.".format(layer_def["pg_layer_name"]))
 
         # Prepare support data.
         partitioned_layer = PartitionedLayer(params["connection_manager"].get_connection(),
                                              layer_def["pg_layer_name"],
-                                             layer_def["pg_fid_name"])
+                                             layer_def["pg_fid_name"],
+                                             workers=params.get("pg_workers", 1))
 
         # Update boundary with negative tolerance buffer
         boundary_table_name = params["layer_defs"]["boundary"]["pg_layer_name"]
@@ -61,7 +67,8 @@ def run_check(params, status):
 
         gap_table = GapTable(partitioned_layer,
                              params["layer_defs"]["boundary"]["pg_layer_name"],
-                             params["du_column_name"])
+                             params["du_column_name"],
+                             prescreen_resolution=gap_prescreen_resolution)
         gap_table.make()
 
         # Prepare parameters used in sql clauses.
@@ -7,6 +7,7 @@ import logging
 
 DESCRIPTION = "There is no gap in the AOI."
 IS_SYSTEM = False
+IS_EXCLUSIVE = True
 DEFAULT_BOUNDARY_TOLERANCE = 0.01 # tolerance at the edge of the AOI in metres
 DEFAULT_GAP_AREA_TOLERANCE = 0.000001 # square metres
 DEFAULT_GAP_WIDTH_TOLERANCE = 0.00001 # square metres
@@ -74,7 +75,8 @@ def run_check(params, status):
         # Prepare support data.
         partitioned_layer = PartitionedLayer(params["connection_manager"].get_connection(),
                                              layer_def["pg_layer_name"],
-                                             layer_def["pg_fid_name"])
+                                             layer_def["pg_fid_name"],
+                                             workers=params.get("pg_workers", 1))
 
         gap_table = GapTable(partitioned_layer,
                              params["layer_defs"]["boundary"]["pg_layer_name"],
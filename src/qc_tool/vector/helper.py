@@ -1,27 +1,32 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hashlib
+import io
+import json
 import logging
+import os
 import re
+import shutil
 import subprocess
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import ExitStack
+from itertools import count
 from math import ceil
 from math import floor
 from zipfile import ZipFile
-import boto3
 from pathlib import Path
-import PyPDF2
-
-import psycopg2
-import psycopg2.errorcodes
-import requests
-from checksumdir import dirhash
+from pathlib import PurePosixPath
 
 from qc_tool.common import HASH_ALGORITHM
+from qc_tool.common import HASH_BUFFER_SIZE
 from qc_tool.common import FAILED_ITEMS_LIMIT
 
 from qc_tool.common import CONFIG
+from qc_tool.common import get_qc_tool_version
 from qc_tool.worker.dispatch import make_signature
 
 
@@ -34,15 +39,68 @@ INSPIRE_SERVICE_STATUS_MAX_RETRIES = 10
 INSPIRE_SERVICE_STATUS_RETRY_INTERVAL = 60
 INSPIRE_SERVICE_LOCAL_PORT = 8080
 
+UNZIP_MAX_WORKERS = 8
+
+S3_PART_SIZE = 64 * 1024 ** 2
+S3_PARTIAL_MAX_AGE = 7 * 24 * 3600  # partial downloads untouched for a week are removed.
+
+# Files belonging to the main file of the format, they are extracted together with it.
+UNZIP_COMPANION_SUFFIXES = {".shp": (".shx", ".dbf", ".prj", ".cpg", ".qix", ".sbn", ".sbx", ".shp.xml"),
+                            ".tif": (".tfw", ".tif.aux.xml", ".tif.ovr", ".tif.msk")}
+
+# Files of the shapefile whose content changes the imported table.
+SHAPEFILE_SIDECAR_SUFFIXES = (".dbf", ".shx", ".prj", ".cpg")
+
 PARTITION_MAX_VERTICES = 50000
 
+CLUSTER_COPY_BATCH_SIZE = 100000
+
+GAP_PRESCREEN_MAX_PIXELS = 25000000  # partitions having larger window are always checked exactly.
+
 NEIGHBOUR_LENGTH_TOLERANCE = 0.001  # tolerance for neighbour when two points are considered as the same point.
 
+LAYER_CACHE_SCHEMA_TPL = "layer_cache_{:s}"
+LAYER_CACHE_REGISTRY_TABLE = "public.layer_cache"
+LAYER_CACHE_REF_TABLE = "layer_cache_ref"
+
 
 log = logging.getLogger(__name__)
 
 
-def do_unzip(zip_filepath, unzip_dir, status):
+def _match_extract_formats(member_name, extract_formats):
+    # The member matches if its name or any of its parent directories has one of the suffixes,
+    # so whole .gdb directory is extracted by ".gdb" format.
+    path = PurePosixPath(member_name.lower())
+    for part in [path.name] + [parent.name for parent in path.parents]:
+        for extract_format in extract_formats:
+            if part.endswith(extract_format):
+                return True
+            if any(part.endswith(companion_suffix)
+                   for companion_suffix in UNZIP_COMPANION_SUFFIXES.get(extract_format, ())):
+                return True
+    return False
+
+def _extract_members(zip_filepath, member_names, unzip_dir):
+    # Every thread opens its own zip file, so the members are decompressed independently.
+    extracted_filepaths = []
+    with ZipFile(str(zip_filepath)) as zip_file:
+        for member_name in member_names:
+            extracted_filepaths.append(Path(zip_file.extract(member_name, path=str(unzip_dir))))
+    return extracted_filepaths
+
+def do_unzip(zip_filepath, unzip_dir, status, extract_formats=None, extract=True):
+    """
+    Extracts the delivery zip file into unzip_dir.
+
+    The members are decompressed by several threads.
+    The list of extracted files is provided as unzip_filepaths param,
+    so the following checks need not walk through the unzip_dir.
+
+    :param extract_formats: list of suffixes, eg. [".gdb", ".shp"], only matching members are extracted if set.
+    :param extract: if False, the members are only validated and listed, they are not extracted.
+        The listed paths point to where the members would be extracted
+        and the zip file is provided as vsizip_filepath param, so the rasters may be read by GDAL /vsizip/.
+    """
     # The source zip file must have .zip extension.
     if not zip_filepath.name.lower().endswith(".zip"):
         status.aborted("Uploaded delivery {:s} has incorrect file format. Delivery must be a .zip file."
@@ -54,20 +112,290 @@ def do_unzip(zip_filepath, unzip_dir, status):
     # The source zip file must be a zip archive.
     try:
         with ZipFile(str(zip_filepath)) as zip_file:
-            zip_file.extractall(path=str(unzip_dir))
+            members = [member for member in zip_file.infolist() if not member.is_dir()]
+    except Exception as ex:
+        status.aborted("Error unzipping file {:s}, reason: {:s}".format(zip_filepath.name, str(ex)))
+        return
+
+    # Validate the members before anything is extracted.
+    for member in members:
+        member_path = PurePosixPath(member.filename.replace("\\", "/"))
+        if member_path.is_absolute() or ".." in member_path.parts:
+            status.aborted("Error unzipping file {:s}, reason: member {:s} points outside of the archive."
+                           .format(zip_filepath.name, member.filename))
+            return
+        if member.flag_bits & 0x1:
+            status.aborted("Error unzipping file {:s}, reason: member {:s} is encrypted."
+                           .format(zip_filepath.name, member.filename))
+            return
+    if extract_formats is not None:
+        extract_formats = [extract_format.lower() for extract_format in extract_formats]
+        members = [member for member in members if _match_extract_formats(member.filename, extract_formats)]
+    if not extract:
+        unzip_filepaths = [unzip_dir.joinpath(*PurePosixPath(member.filename.replace("\\", "/")).parts)
+                           for member in members]
+        status.add_params({"unzip_dir": unzip_dir,
+                           "unzip_filepaths": sorted(unzip_filepaths),
+                           "vsizip_filepath": zip_filepath})
+        return
+
+    unzipped_size = sum(member.file_size for member in members)
+    free_size = shutil.disk_usage(str(unzip_dir)).free
+    if unzipped_size > free_size:
+        status.aborted("Error unzipping file {:s}, reason: unzipped size {:d} bytes exceeds free disk space {:d} bytes."
+                       .format(zip_filepath.name, unzipped_size, free_size))
+        return
+
+    # Distribute members among threads, the largest members first, so the threads have similar amount of work.
+    members.sort(key=lambda member: member.file_size, reverse=True)
+    workers = max(1, min(UNZIP_MAX_WORKERS, os.cpu_count() or 1, len(members)))
+    member_name_batches = [[member.filename for member in members[i::workers]] for i in range(workers)]
+    unzip_filepaths = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for extracted_filepaths in executor.map(_extract_members,
+                                                    [zip_filepath] * workers,
+                                                    member_name_batches,
+                                                    [unzip_dir] * workers):
+                unzip_filepaths.extend(extracted_filepaths)
     except Exception as ex:
         status.aborted("Error unzipping file {:s}, reason: {:s}".format(zip_filepath.name, str(ex)))
         return
+    log.debug("Extracted {:d} files from {:s} by {:d} threads.".format(len(unzip_filepaths), zip_filepath.name, workers))
+
+    status.add_params({"unzip_dir": unzip_dir,
+                       "unzip_filepaths": sorted(unzip_filepaths)})
 
-    status.add_params({"unzip_dir": unzip_dir})
+def list_unzip_filepaths(unzip_dir, unzip_filepaths=None):
+    """
+    Returns all files under unzip_dir.
 
-def do_s3_download(host, access_key, secret_key, bucketname, pattern, s3_local_dir, status):
+    The file index built by do_unzip is used if available, the directory is walked otherwise.
+    """
+    if unzip_filepaths is not None:
+        return unzip_filepaths
+    return sorted(path for path in unzip_dir.glob("**/*") if path.is_file())
+
+class S3Download():
+    """
+    Downloads one S3 object by ranged requests, the parts may be downloaded concurrently.
+
+    The object is written into a partial file, the finished parts are recorded in a state file,
+    so the download interrupted eg. by worker restart is resumed from the missing parts.
+    The hash of the object is computed while the parts are arriving,
+    so the downloaded file need not be read again.
+    The partial download is shared by the jobs downloading the same object,
+    so the download holds exclusive lock from prepare() until finish() or release(),
+    the other job waits for the lock and then downloads the object anew.
+    """
+    def __init__(self, client, bucketname, key, size, etag, partial_dir, part_size=S3_PART_SIZE):
+        self.client = client
+        self.bucketname = bucketname
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size
+        partial_name = hashlib.new(HASH_ALGORITHM, "{:s}/{:s}".format(bucketname, key).encode()).hexdigest()
+        self.partial_filepath = partial_dir.joinpath("{:s}.part".format(partial_name))
+        self.state_filepath = partial_dir.joinpath("{:s}.part.json".format(partial_name))
+        # The lock file is removed only by clean_s3_partial_dir(), lock() checks the locked file is not removed.
+        self.lock_filepath = partial_dir.joinpath("{:s}.part.lock".format(partial_name))
+        self.lock_file = None
+        self.part_count = ceil(size / part_size)
+        self.done_parts = set()
+        self.hasher = hashlib.new(HASH_ALGORITHM)
+        self.hashed_parts = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def lock(self):
+        """Waits for exclusive lock of the partial download."""
+        import fcntl
+
+        while self.lock_file is None:
+            lock_file = open(str(self.lock_filepath), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            except:
+                lock_file.close()
+                raise
+            if is_locked_file(lock_file, self.lock_filepath):
+                self.lock_file = lock_file
+            else:
+                # The stale download has been removed while waiting for the lock, the new lock file is locked.
+                lock_file.close()
+
+    def release(self):
+        if self.lock_file is not None:
+            # Closing the file releases the lock.
+            self.lock_file.close()
+            self.lock_file = None
+
+    def prepare(self):
+        """Locks and prepares the partial file, the parts of previous interrupted download are reused."""
+        self.lock()
+        if self.state_filepath.is_file() and self.partial_filepath.is_file():
+            state = json.loads(self.state_filepath.read_text())
+            if state["etag"] == self.etag and state["size"] == self.size and state["part_size"] == self.part_size:
+                self.done_parts = set(state["done_parts"])
+                log.info("Resuming download of {:s}, {:d} of {:d} parts are already downloaded."
+                         .format(self.key, len(self.done_parts), self.part_count))
+        if len(self.done_parts) == 0:
+            with open(str(self.partial_filepath), "wb") as f:
+                f.truncate(self.size)
+            self._write_state()
+        self._hash_parts()
+
+    def missing_parts(self):
+        return [part_nr for part_nr in range(self.part_count) if part_nr not in self.done_parts]
+
+    def download_part(self, part_nr):
+        """Downloads one part, it is called from the worker threads."""
+        offset = part_nr * self.part_size
+        last = min(offset + self.part_size, self.size) - 1
+        response = self.client.get_object(Bucket=self.bucketname,
+                                          Key=self.key,
+                                          Range="bytes={:d}-{:d}".format(offset, last),
+                                          IfMatch=self.etag)
+        with open(str(self.partial_filepath), "r+b") as f:
+            f.seek(offset)
+            for buf in response["Body"].iter_chunks(HASH_BUFFER_SIZE):
+                f.write(buf)
+
+    def part_done(self, part_nr):
+        """Records the downloaded part, it must be called from one thread only."""
+        self.done_parts.add(part_nr)
+        self._write_state()
+        self._hash_parts()
+
+    def finish(self, dst_filepath):
+        """Moves the downloaded file to dst_filepath, releases the lock and returns the hash."""
+        if self.hashed_parts < self.part_count:
+            raise ValueError("Download of {:s} is not complete.".format(self.key))
+        shutil.move(str(self.partial_filepath), str(dst_filepath))
+        self.state_filepath.unlink()
+        self.release()
+        return self.hasher.hexdigest()
+
+    def _write_state(self):
+        state = {"etag": self.etag,
+                 "size": self.size,
+                 "part_size": self.part_size,
+                 "done_parts": sorted(self.done_parts)}
+        state_filepath_pre = self.state_filepath.with_name("{:s}.pre".format(self.state_filepath.name))
+        state_filepath_pre.write_text(json.dumps(state))
+        state_filepath_pre.replace(self.state_filepath)
+
+    def _hash_parts(self):
+        # The parts are hashed in their order, as soon as all the preceding parts are downloaded.
+        # The part has been written just now, so it is read from the page cache.
+        with open(str(self.partial_filepath), "rb") as f:
+            while self.hashed_parts in self.done_parts:
+                f.seek(self.hashed_parts * self.part_size)
+                remaining = min(self.part_size, self.size - self.hashed_parts * self.part_size)
+                while remaining > 0:
+                    buf = f.read(min(HASH_BUFFER_SIZE, remaining))
+                    self.hasher.update(buf)
+                    remaining -= len(buf)
+                self.hashed_parts += 1
+
+
+def is_locked_file(lock_file, lock_filepath):
+    """Returns True if lock_filepath still refers to the opened lock_file."""
+    try:
+        return os.stat(str(lock_filepath)).st_ino == os.fstat(lock_file.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def clean_s3_partial_dir(partial_dir, max_age=S3_PARTIAL_MAX_AGE):
+    """
+    Removes the partial downloads not touched for max_age seconds.
+
+    The partial downloads of the jobs which have been cancelled or failed for good are never resumed,
+    so they would be kept in the shared S3_DOWNLOAD_DIR forever.
+    The download is removed while holding its lock, so the download in progress is never removed.
+    """
+    import fcntl
+
+    min_mtime = time.time() - max_age
+    for lock_filepath in partial_dir.glob("*.part.lock"):
+        partial_filepath = lock_filepath.with_suffix("")
+        state_filepath = partial_filepath.with_name("{:s}.json".format(partial_filepath.name))
+        filepaths = [partial_filepath,
+                     state_filepath,
+                     state_filepath.with_name("{:s}.pre".format(state_filepath.name)),
+                     lock_filepath]
+        try:
+            mtime = max(filepath.stat().st_mtime for filepath in filepaths if filepath.exists())
+        except (ValueError, FileNotFoundError):
+            continue
+        if mtime >= min_mtime:
+            continue
+        with open(str(lock_filepath), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if not is_locked_file(lock_file, lock_filepath):
+                continue
+            log.info("Removing stale partial download {:s}.".format(str(partial_filepath)))
+            for filepath in filepaths:
+                if filepath.exists():
+                    filepath.unlink()
+
+
+def get_s3_partial_dir(params):
+    """
+    Returns the directory of partial S3 downloads.
+
+    If S3_DOWNLOAD_DIR is not configured, the directory is in the job tmp_dir, outside of the downloaded files.
+    """
+    if params.get("s3_download_dir") is not None:
+        return params["s3_download_dir"]
+    return params["tmp_dir"].joinpath("s3_partial.d")
+
+
+def download_s3_objects(s3_downloads, workers=1):
+    """Downloads the missing parts of all the objects by the pool of threads."""
+    for s3_download in s3_downloads:
+        s3_download.prepare()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        future_parts = {}
+        for s3_download in s3_downloads:
+            for part_nr in s3_download.missing_parts():
+                future = executor.submit(s3_download.download_part, part_nr)
+                future_parts[future] = (s3_download, part_nr)
+        try:
+            for future in as_completed(future_parts):
+                future.result()
+                (s3_download, part_nr) = future_parts[future]
+                s3_download.part_done(part_nr)
+        except Exception:
+            for future in future_parts:
+                future.cancel()
+            raise
+
+def do_s3_download(host, access_key, secret_key, bucketname, pattern, s3_local_dir, status, partial_dir, workers=1):
+    """
+    Downloads objects matching the pattern into s3_local_dir.
+
+    :param partial_dir: directory of partial downloads, see get_s3_partial_dir(),
+        it must not be inside s3_local_dir, the partial and lock files would be taken for the delivered files.
+    :param workers: number of threads downloading the parts of the objects.
+    """
+    import boto3
 
     if not s3_local_dir.exists():
         s3_local_dir.mkdir()
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    clean_s3_partial_dir(partial_dir)
 
     # Check the S3 storage connection, filter objects by naming pattern, download to s3_local_dir
-    downloaded_filenames = []
     try:
         s3 = boto3.resource('s3', aws_access_key_id=access_key, aws_secret_access_key=secret_key, endpoint_url=host)
         bucket = s3.Bucket(bucketname)
@@ -75,30 +403,49 @@ def do_s3_download(host, access_key, secret_key, bucketname, pattern, s3_local_d
         if len(objects_filtered) == 0:
             status.aborted("Error S3 download, the {:s} pattern doesn't match any object on the S3 storage.".format(pattern)) # jaky typ vyjimky??
             return
-        for obj in objects_filtered:
-            obj_name = Path(obj.key).name
+
+        # Only one zip file is expected, the objects after the first zip file are not downloaded.
+        for i, obj in enumerate(objects_filtered):
+            if Path(obj.key).suffix == ".zip":
+                objects_filtered = objects_filtered[:i + 1]
+                break
+
+        s3_downloads = [S3Download(s3.meta.client, bucketname, obj.key, obj.size, obj.e_tag, partial_dir)
+                        for obj in objects_filtered]
+        downloaded_filenames = []
+        downloaded_hashes = []
+        with ExitStack() as exit_stack:
+            # The locks of the downloads are released even if the download fails.
+            for s3_download in s3_downloads:
+                exit_stack.enter_context(s3_download)
+            download_s3_objects(s3_downloads, workers)
+            for s3_download in s3_downloads:
+                obj_name = Path(s3_download.key).name
+                downloaded_hashes.append(s3_download.finish(s3_local_dir.joinpath(obj_name)))
+                downloaded_filenames.append(obj_name)
+        for obj_name, downloaded_hash in zip(downloaded_filenames, downloaded_hashes):
             local_filepath = s3_local_dir.joinpath(obj_name)
-            s3.Bucket(bucketname).download_file(obj.key, local_filepath)
-            downloaded_filenames.append(obj_name)
 
             # Unzip if needed
             if local_filepath.suffix == ".zip":
                 with ZipFile(str(local_filepath)) as zip_file:
                     zip_file.extractall(path=str(s3_local_dir))
-                zip_hash = make_signature(str(local_filepath))
                 # Add the zip file hash to status properties
-                status.set_status_property("hash", zip_hash)
+                status.set_status_property("hash", downloaded_hash)
                 status.set_status_property("hash_files", [local_filepath.name])
                 local_filepath.unlink()
                 if not status.params.get("unzip_dir"):
                     status.add_params({"unzip_dir": s3_local_dir})
                 return # only one zip file is expected and hash is already set
 
-        # in the case of a non-zip s3 delivery, hash is made from all downloaded files
+        # in the case of a non-zip s3 delivery, hash is made from all downloaded files,
+        # the hashes of the files are combined in the same way as dirhash() does.
         if downloaded_filenames:
             if not status.params.get("hash"):
-                downloaded_files_hash = dirhash(s3_local_dir, HASH_ALGORITHM)
-                status.set_status_property("hash", downloaded_files_hash)
+                downloaded_files_hash = hashlib.new(HASH_ALGORITHM)
+                for downloaded_hash in sorted(downloaded_hashes):
+                    downloaded_files_hash.update(downloaded_hash.encode("utf-8"))
+                status.set_status_property("hash", downloaded_files_hash.hexdigest())
                 status.set_status_property("hash_files", downloaded_filenames)
     except Exception as ex:
         status.aborted("Error S3 download, reason: {:s}".format(str(ex)))
@@ -130,14 +477,14 @@ def get_failed_items_message(cursor, error_table_name, pg_fid_name, limit=FAILED
     return message
 
 
-def find_shp_layers(unzip_dir, status):
+def find_shp_layers(unzip_dir, status, unzip_filepaths=None):
     """
     Finds all .shp layers anywhere in the directory hierarchy under unzip_dir.
     """
     from osgeo import ogr
 
-    shp_filepaths = [path for path in unzip_dir.glob("**/*")
-                     if path.is_file() and path.suffix.lower() == ".shp"]
+    shp_filepaths = [path for path in list_unzip_filepaths(unzip_dir, unzip_filepaths)
+                     if path.suffix.lower() == ".shp"]
 
     shp_layer_infos = []
     for shp_filepath in shp_filepaths:
@@ -156,15 +503,15 @@ def find_shp_layers(unzip_dir, status):
         shp_layer_infos.append({"src_filepath": shp_filepath, "src_layer_name": shp_layer.GetName()})
     return shp_layer_infos
 
-def find_csv_layers(unzip_dir, status):
+def find_csv_layers(unzip_dir, status, unzip_filepaths=None):
     """
     Finds all .shp layers anywhere in the directory hierarchy under unzip_dir.
     """
     # from osgeo import ogr
     from osgeo.gdal import OpenEx
 
-    csv_filepaths = [path for path in unzip_dir.glob("**/*")
-                     if path.is_file() and path.suffix.lower() == ".csv"]
+    csv_filepaths = [path for path in list_unzip_filepaths(unzip_dir, unzip_filepaths)
+                     if path.suffix.lower() == ".csv"]
 
     csv_layer_infos = []
     for csv_filepath in csv_filepaths:
@@ -185,11 +532,14 @@ def find_csv_layers(unzip_dir, status):
     return csv_layer_infos
 
 
-def find_gdb_layers(unzip_dir, status):
+def find_gdb_layers(unzip_dir, status, unzip_filepaths=None):
     from osgeo import ogr
 
     # Find all gdb directories.
-    gdb_dirs = [path for path in unzip_dir.glob("**") if path.suffix.lower() == ".gdb"]
+    if unzip_filepaths is None:
+        gdb_dirs = [path for path in unzip_dir.glob("**") if path.suffix.lower() == ".gdb"]
+    else:
+        gdb_dirs = sorted(set(path.parent for path in unzip_filepaths if path.parent.suffix.lower() == ".gdb"))
     gdb_layer_infos = []
 
     for gdb_dir in gdb_dirs:
@@ -206,12 +556,12 @@ def find_gdb_layers(unzip_dir, status):
     return gdb_layer_infos
 
 
-def find_gpkg_layers(unzip_dir, status):
+def find_gpkg_layers(unzip_dir, status, unzip_filepaths=None):
     from osgeo import ogr
 
     # Find .gpkg files.
-    gpkg_filepaths = [path for path in unzip_dir.glob("**/*")
-                     if path.is_file() and path.suffix.lower() == ".gpkg"]
+    gpkg_filepaths = [path for path in list_unzip_filepaths(unzip_dir, unzip_filepaths)
+                     if path.suffix.lower() == ".gpkg"]
     gpkg_layer_infos = []
 
     for gpkg_filepath in gpkg_filepaths:
@@ -228,12 +578,12 @@ def find_gpkg_layers(unzip_dir, status):
         ds = None
     return gpkg_layer_infos
 
-def find_fgb_layers(unzip_dir, status):
+def find_fgb_layers(unzip_dir, status, unzip_filepaths=None):
     from osgeo import ogr
 
     # Find .gpkg files.
-    fgb_filepaths = [path for path in unzip_dir.glob("**/*")
-                     if path.is_file() and path.suffix.lower() == ".fgb"]
+    fgb_filepaths = [path for path in list_unzip_filepaths(unzip_dir, unzip_filepaths)
+                     if path.suffix.lower() == ".fgb"]
     fgb_layer_infos = []
 
     for fgb_filepath in fgb_filepaths:
@@ -250,12 +600,12 @@ def find_fgb_layers(unzip_dir, status):
         ds = None
     return fgb_layer_infos
 
-def find_geoparquet_layers(unzip_dir, status):
+def find_geoparquet_layers(unzip_dir, status, unzip_filepaths=None):
     from osgeo import ogr
 
     # Find .gpkg files.
-    geoparquet_filepaths = [path for path in unzip_dir.glob("**/*")
-                     if path.is_file() and path.suffix.lower() == ".parquet"]
+    geoparquet_filepaths = [path for path in list_unzip_filepaths(unzip_dir, unzip_filepaths)
+                     if path.suffix.lower() == ".parquet"]
     geoparquet_layer_infos = []
 
     for geoparquet_filepath in geoparquet_filepaths:
@@ -272,11 +622,12 @@ def find_geoparquet_layers(unzip_dir, status):
         ds = None
     return geoparquet_layer_infos
 
-def find_pdfs(unzip_dir, status):
+def find_pdfs(unzip_dir, status, unzip_filepaths=None):
+    import PyPDF2
 
     # Find .gpkg files.
-    pdf_filepaths = [path for path in unzip_dir.glob("**/*")
-                     if path.is_file() and path.suffix.lower() == ".pdf"]
+    pdf_filepaths = [path for path in list_unzip_filepaths(unzip_dir, unzip_filepaths)
+                     if path.suffix.lower() == ".pdf"]
     pdf_file_infos = []
 
     for pdf_filepath in pdf_filepaths:
@@ -295,8 +646,8 @@ def find_pdfs(unzip_dir, status):
     return pdf_file_infos
 
 
-def find_documents(unzip_dir, regex):
-    document_filepaths = [path for path in unzip_dir.glob("**/*") if path.is_file()]
+def find_documents(unzip_dir, regex, unzip_filepaths=None):
+    document_filepaths = list_unzip_filepaths(unzip_dir, unzip_filepaths)
     regex = re.compile(regex, re.IGNORECASE)
     matched_document_filepaths = [doc for doc in document_filepaths if regex.search(doc.name)]
     if len(matched_document_filepaths) == 0:
@@ -482,6 +833,8 @@ class InspireServiceClient():
 
     @staticmethod
     def get_github_validator_version():
+        import requests
+
         github_url = "https://api.github.com/repos/INSPIRE-MIF/helpdesk-validator/releases/latest"
         try:
             resp_json = requests.get(github_url).json()
@@ -508,6 +861,8 @@ class InspireServiceClient():
         Verifies that the INSPIRE service API is up and running by calling /validator/v2/status endpoint.
         :return: 200 (ok) if OK and up, 502 (service unavailable) if not up.
         """
+        import requests
+
         try:
             r = requests.get(CONFIG["inspire_service_url"] + "status", timeout=1)
             r.raise_for_status()
@@ -521,6 +876,8 @@ class InspireServiceClient():
         Retrieves the INSPIRE executable test suite ID from the INSPIRE service
         :return: (suite ID, "ok") if the suite ID is correctly returned or (None, ERROR_MESSAGE) in case of failure.
         """
+        import requests
+
         try:
             r = requests.get(CONFIG["inspire_service_url"] + "ExecutableTestSuites.json", timeout=INSPIRE_SERVER_TIMEOUT)
             r.raise_for_status()
@@ -556,6 +913,8 @@ class InspireServiceClient():
         Uploads a xml file to INSPIRE service and receives a temporary test object ID.
         :return: (status_code, test object ID, "ok") if the xml file was correctly uploaded or (None, ERROR_MESSAGE) if upload failed.
         """
+        import requests
+
         xml_upload_url = CONFIG["inspire_service_url"] + "TestObjects?action=upload"
 
         try:
@@ -602,6 +961,8 @@ class InspireServiceClient():
         :param test_object_id: The test object ID, obtained with create_test_object() function.
         :return: The ID of the started test run.
         """
+        import requests
+
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         test_run_label = "INSPIRE test run on {:s} with Conformance class {:s}".format(timestamp,
                                                                                        INSPIRE_TEST_SUITE_NAME)
@@ -644,6 +1005,7 @@ class InspireServiceClient():
         :param test_object_id: The test object ID, obtained with create_test_object() function.
         :return: A tuple with test result status [PASSED, PASSED_MANUAL, FAILED or None] and message ["ok" or "error"]
         """
+        import requests
 
         run_url = CONFIG["inspire_service_url"] + "TestRuns/" + test_run_id
         progress_url = run_url + "/progress"
@@ -693,6 +1055,8 @@ class InspireServiceClient():
         :param test_object_id: The test object ID, obtained with create_test_object() function.
         :return: message ["ok" or "error"]
         """
+        import requests
+
         result_url = CONFIG["inspire_service_url"] + "TestRuns/" + test_run_id
 
         if attachment_filepath.name.endswith(".html"):
@@ -880,6 +1244,22 @@ def column_exists(connection, table_name, column_name):
             raise Exception("Found {:d} columns named {:s} in table {:s}.".format(cursor.rowcount, column_name, table_name))
 
 
+def get_primary_key_name(connection, table):
+    """Returns the name of the primary key column of the table, None if the table has no single column primary key."""
+    sql = ("SELECT a.attname\n"
+           "FROM\n"
+           " pg_index AS i\n"
+           " INNER JOIN pg_attribute AS a ON i.indrelid = a.attrelid AND a.attnum = ANY(i.indkey)\n"
+           "WHERE\n"
+           " i.indrelid = %s::regclass\n"
+           " AND i.indisprimary;")
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        if cursor.rowcount != 1:
+            return None
+        return cursor.fetchone()[0]
+
+
 def extract_srid(connection, table):
     GEOM_COLUMN = "geom"
     with connection.cursor() as cursor:
@@ -889,6 +1269,196 @@ def extract_srid(connection, table):
     return srid
 
 
+def make_source_hash(src_filepath):
+    """
+    Returns the hash of the content of the layer source.
+
+    File geodatabase is hashed as a whole directory,
+    shapefile is hashed together with its sidecar files.
+    """
+    from checksumdir import dirhash
+
+    if src_filepath.is_dir():
+        return dirhash(str(src_filepath), HASH_ALGORITHM)
+    h = hashlib.new(HASH_ALGORITHM)
+    h.update(make_signature(src_filepath).encode())
+    if src_filepath.suffix.lower() == ".shp":
+        sidecar_filepaths = {path.suffix.lower(): path
+                             for path in src_filepath.parent.iterdir()
+                             if path.stem == src_filepath.stem and path.is_file()}
+        for suffix in SHAPEFILE_SIDECAR_SUFFIXES:
+            sidecar_filepath = sidecar_filepaths.get(suffix)
+            sidecar_hash = None if sidecar_filepath is None else make_signature(sidecar_filepath)
+            h.update(repr((suffix, sidecar_hash)).encode())
+    return h.hexdigest()
+
+
+def make_layer_cache_key(layer_def, epsg=None, src_hashes=None):
+    """
+    Composes the key of the layer cache from the content of the source file and the import options.
+
+    :param src_hashes: dictionary of source hashes by source filepath,
+                       so the source with several layers, eg. file geodatabase, is hashed only once.
+    """
+    src_filepath = Path(layer_def["src_filepath"])
+    if src_hashes is None:
+        src_hashes = {}
+    if src_filepath not in src_hashes:
+        src_hashes[src_filepath] = make_source_hash(src_filepath)
+    src_hash = src_hashes[src_filepath]
+    h = hashlib.new(HASH_ALGORITHM)
+    for item in (src_hash, layer_def["src_layer_name"], layer_def["layer_alias"], epsg, get_qc_tool_version()):
+        h.update(repr(item).encode())
+    return h.hexdigest()[:32]
+
+
+def attach_layer_cache(connection, pg_layer_name, cache_key):
+    """
+    Attaches the layer of the job to the cache schema of the layer content.
+
+    The tables of the layer cached in the schema are then restored by restore_cached_tables()
+    and the tables made by the job are stored by publish_cached_tables().
+    """
+    cache_schema = LAYER_CACHE_SCHEMA_TPL.format(cache_key)
+    sql_params = {"registry_table": LAYER_CACHE_REGISTRY_TABLE,
+                  "ref_table": LAYER_CACHE_REF_TABLE}
+    with connection.cursor() as cursor:
+        sql = ("CREATE TABLE IF NOT EXISTS {ref_table}\n"
+               " (pg_layer_name varchar PRIMARY KEY,\n"
+               "  cache_schema varchar NOT NULL);")
+        sql = sql.format(**sql_params)
+        cursor.execute(sql)
+        sql = ("INSERT INTO {ref_table} VALUES (%s, %s)\n"
+               "ON CONFLICT (pg_layer_name) DO UPDATE SET cache_schema = EXCLUDED.cache_schema;")
+        sql = sql.format(**sql_params)
+        cursor.execute(sql, [pg_layer_name, cache_schema])
+        sql = ("CREATE TABLE IF NOT EXISTS {registry_table}\n"
+               " (cache_schema varchar PRIMARY KEY,\n"
+               "  last_used timestamp NOT NULL);")
+        sql = sql.format(**sql_params)
+        cursor.execute(sql)
+        sql = ("INSERT INTO {registry_table} VALUES (%s, now())\n"
+               "ON CONFLICT (cache_schema) DO UPDATE SET last_used = now();")
+        sql = sql.format(**sql_params)
+        cursor.execute(sql, [cache_schema])
+    return cache_schema
+
+
+def get_layer_cache_schema(connection, pg_layer_name):
+    """Returns the cache schema attached to the layer, None if the layer has no cache."""
+    if not table_exists(connection, LAYER_CACHE_REF_TABLE):
+        return None
+    sql_params = {"ref_table": LAYER_CACHE_REF_TABLE}
+    with connection.cursor() as cursor:
+        sql = "SELECT cache_schema FROM {ref_table} WHERE pg_layer_name = %s;"
+        sql = sql.format(**sql_params)
+        cursor.execute(sql, [pg_layer_name])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def _count_cached_tables(cursor, cache_schema, table_names):
+    sql = ("SELECT count(*)\n"
+           "FROM information_schema.tables\n"
+           "WHERE\n"
+           " table_schema = %s\n"
+           " AND table_name = ANY(%s);")
+    cursor.execute(sql, [cache_schema, list(table_names)])
+    return cursor.fetchone()[0]
+
+
+def restore_cached_tables(connection, pg_layer_name, table_names):
+    """
+    Copies the tables from the cache schema of the layer into the job schema.
+
+    The tables are restored all or none.
+    :return: True if the tables have been restored.
+    """
+    import psycopg2
+
+    cache_schema = get_layer_cache_schema(connection, pg_layer_name)
+    if cache_schema is None:
+        return False
+    with connection.cursor() as cursor:
+        if _count_cached_tables(cursor, cache_schema, table_names) < len(table_names):
+            return False
+        try:
+            cursor.execute("BEGIN;")
+            for table_name in table_names:
+                sql_params = {"table": table_name,
+                              "cache_schema": cache_schema}
+                sql = ("CREATE TABLE {table} (LIKE {cache_schema}.{table} INCLUDING CONSTRAINTS INCLUDING INDEXES);\n"
+                       "INSERT INTO {table} SELECT * FROM {cache_schema}.{table};")
+                sql = sql.format(**sql_params)
+                cursor.execute(sql)
+            cursor.execute("COMMIT;")
+        except psycopg2.Error:
+            # The cache schema may have been evicted meanwhile.
+            cursor.execute("ROLLBACK;")
+            log.exception("Tables {:s} can not be restored from layer cache {:s}.".format(repr(table_names), cache_schema))
+            return False
+        for table_name in table_names:
+            cursor.execute("ANALYZE {:s};".format(table_name))
+    log.info("Tables {:s} have been restored from layer cache {:s}.".format(repr(table_names), cache_schema))
+    return True
+
+
+def publish_cached_tables(connection, pg_layer_name, table_names):
+    """Copies the tables from the job schema into the cache schema of the layer."""
+    import psycopg2
+
+    cache_schema = get_layer_cache_schema(connection, pg_layer_name)
+    if cache_schema is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS {:s};".format(cache_schema))
+        if _count_cached_tables(cursor, cache_schema, table_names) > 0:
+            # The tables have already been published by other job.
+            return
+        try:
+            cursor.execute("BEGIN;")
+            for table_name in table_names:
+                sql_params = {"table": table_name,
+                              "cache_schema": cache_schema}
+                sql = ("CREATE TABLE {cache_schema}.{table} (LIKE {table} INCLUDING CONSTRAINTS INCLUDING INDEXES);\n"
+                       "INSERT INTO {cache_schema}.{table} SELECT * FROM {table};")
+                sql = sql.format(**sql_params)
+                cursor.execute(sql)
+            cursor.execute("COMMIT;")
+        except psycopg2.Error:
+            # Other job may publish the same tables concurrently.
+            cursor.execute("ROLLBACK;")
+            log.exception("Tables {:s} can not be published into layer cache {:s}.".format(repr(table_names), cache_schema))
+            return
+    log.info("Tables {:s} have been published into layer cache {:s}.".format(repr(table_names), cache_schema))
+
+
+def evict_layer_cache(connection, max_size):
+    """Drops least recently used cache schemas so that the total size of the layer cache does not exceed max_size bytes."""
+    sql_params = {"registry_table": LAYER_CACHE_REGISTRY_TABLE}
+    with connection.cursor() as cursor:
+        sql = ("SELECT lc.cache_schema, coalesce(sum(pg_total_relation_size(c.oid)), 0)\n"
+               "FROM\n"
+               " {registry_table} AS lc\n"
+               " LEFT JOIN pg_namespace AS n ON lc.cache_schema = n.nspname\n"
+               " LEFT JOIN pg_class AS c ON n.oid = c.relnamespace AND c.relkind = 'r'\n"
+               "GROUP BY lc.cache_schema, lc.last_used\n"
+               "ORDER BY lc.last_used DESC;")
+        sql = sql.format(**sql_params)
+        cursor.execute(sql)
+        total_size = 0
+        for cache_schema, size in cursor.fetchall():
+            total_size += size
+            if total_size > max_size:
+                cursor.execute("DROP SCHEMA IF EXISTS {:s} CASCADE;".format(cache_schema))
+                sql = "DELETE FROM {registry_table} WHERE cache_schema = %s;"
+                sql = sql.format(**sql_params)
+                cursor.execute(sql, [cache_schema])
+                log.info("Layer cache {:s} has been evicted.".format(cache_schema))
+
+
 def create_pg_neighbours(connection, neighbour_table_name, pg_layer_name, pg_fid_name):
     sql_params = {"neighbour_table_name": neighbour_table_name,
                   "pg_layer_name": pg_layer_name,
@@ -931,12 +1501,82 @@ def create_pg_has_comment(connection):
         cursor.execute(sql)
 
 
+class ConnectionPool():
+    """Pool of extra connections to the job schema.
+
+    The connections are made with the same dsn and search path as the given connection,
+    so statements issued through the pool see the tables of the job.
+    The connections are in autocommit mode, every statement must be complete by itself."""
+    def __init__(self, connection, size):
+        self.dsn = connection.dsn
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW search_path;")
+            self.search_path, = cursor.fetchone()
+        self.size = size
+        self.connections = []
+        self.free_connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _acquire(self):
+        import psycopg2
+
+        # list.pop() and list.append() are atomic, so no lock is needed.
+        try:
+            return self.free_connections.pop()
+        except IndexError:
+            pass
+        connection = psycopg2.connect(self.dsn)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("SET search_path TO {:s};".format(self.search_path))
+        self.connections.append(connection)
+        return connection
+
+    def map(self, func, items):
+        """
+        Calls func(connection, item) for every item, at most size calls run in parallel.
+        :return: list of results in the order of items.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def run_item(item):
+            connection = self._acquire()
+            try:
+                return func(connection, item)
+            finally:
+                self.free_connections.append(connection)
+
+        # psycopg2 releases GIL while waiting for the database, so threads are enough here.
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(run_item, items))
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.free_connections = []
+
+
+def split_batches(items, batch_count):
+    """Splits items into at most batch_count batches of similar size, keeping order of items."""
+    batch_size = max(1, ceil(len(items) / batch_count))
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+
 class PartitionedLayer():
     """The class generates partitioned layer.
 
     The whole area of the layer is partitioned into tiles where every tile has no more than maximum allowed vertices.
-    If some feature crosses partition boundary, it gets splitted."""
-    def __init__(self, connection, pg_layer_name, pg_fid_name, srid=None, max_vertices=PARTITION_MAX_VERTICES, grid_size=1.):
+    If some feature crosses partition boundary, it gets splitted.
+
+    The partitions are split level by level. If workers > 1, the features of independent superpartitions
+    are moved into subpartitions in parallel using a pool of connections."""
+    def __init__(self, connection, pg_layer_name, pg_fid_name, srid=None, max_vertices=PARTITION_MAX_VERTICES, grid_size=1., workers=1):
         self.connection = connection
         self.pg_layer_name = pg_layer_name
         self.pg_fid_name = pg_fid_name
@@ -944,6 +1584,9 @@ class PartitionedLayer():
         self.feature_table_name = "feature_{:s}".format(pg_layer_name)
         self.max_vertices = max_vertices
         self.grid_size = grid_size
+        # Number of database connections used in parallel, value <= 1 uses only the given connection.
+        self.workers = workers
+        self.connection_pool = None
         if srid is None:
             self.srid = extract_srid(connection, pg_layer_name)
         else:
@@ -1069,6 +1712,8 @@ class PartitionedLayer():
 
     def _split_partitions(self):
         """Split partitions into subpartitions."""
+        import psycopg2.extras
+
         sql_params = {"partition_table_name": self.partition_table_name}
         with self.connection.cursor() as superpartition_cursor:
             # Select all partitions having high num_vertices.
@@ -1083,51 +1728,89 @@ class PartitionedLayer():
                 return 0
 
             split_count = 0
-            with self.connection.cursor() as subpartition_cursor:
-                for superpartition_id, xmin, ymin, xmax, ymax in superpartition_cursor.fetchall():
-                    # Prepare query template for creating subpartition.
-                    sql = ("INSERT INTO {partition_table_name} (superpartition_id, geom)\n"
-                           "VALUES (%s, ST_MakeEnvelope(%s, %s, %s, %s, %s));")
-                    sql = sql.format(**sql_params)
-
-                    # Compute centerlines for splitting superpartition.
-                    xcenter = (xmin + xmax) / 2 // self.grid_size * self.grid_size
-                    ycenter = (ymin + ymax) / 2 // self.grid_size * self.grid_size
-
-                    # Split the superpartition by dividing the longer side.
-                    if xcenter - xmin > ycenter - ymin:
-                        # Reject splitting superpartition if the xsize gets smaller then grid size.
-                        # Due to current splitting calculation, the xsize becomes zero in such case.
-                        # Due to rounding, the left part of the split is always smaller then right part.
-                        xsize = xcenter - xmin
-                        if xsize < self.grid_size:
-                            log.debug("Partitioning superpartition {:d} has been rejected, while the xsize {:f} of subpartition gets smaller then grid size {:f}.".format(superpartition_id, xsize, self.grid_size))
-                            continue
-
-                        # Split superpartition by vertical line.
-                        subpartition_cursor.execute(sql, [superpartition_id, xmin, ymin, xcenter, ymax, self.srid])
-                        subpartition_cursor.execute(sql, [superpartition_id, xcenter, ymin, xmax, ymax, self.srid])
-                    else:
-                        # Reject splitting superpartition if the ysize gets smaller then grid size.
-                        # Due to current splitting calculation, the ysize becomes zero in such case.
-                        # Due to rounding, the lower part of the split is always smaller then upper part.
-                        ysize = ycenter - ymin
-                        if ysize < self.grid_size:
-                            log.debug("Partitioning superpartition {:d} has been rejected, while the ysize {:f} of subpartition gets smaller then grid size {:f}.".format(superpartition_id, ysize, self.grid_size))
-                            continue
-
-                        # Split superpartition by horizontal line.
-                        subpartition_cursor.execute(sql, [superpartition_id, xmin, ymin, xmax, ycenter, self.srid])
-                        subpartition_cursor.execute(sql, [superpartition_id, xmin, ycenter, xmax, ymax, self.srid])
-                    split_count += 1
+            subpartitions = []
+            for superpartition_id, xmin, ymin, xmax, ymax in superpartition_cursor.fetchall():
+                # Compute centerlines for splitting superpartition.
+                xcenter = (xmin + xmax) / 2 // self.grid_size * self.grid_size
+                ycenter = (ymin + ymax) / 2 // self.grid_size * self.grid_size
+
+                # Split the superpartition by dividing the longer side.
+                if xcenter - xmin > ycenter - ymin:
+                    # Reject splitting superpartition if the xsize gets smaller then grid size.
+                    # Due to current splitting calculation, the xsize becomes zero in such case.
+                    # Due to rounding, the left part of the split is always smaller then right part.
+                    xsize = xcenter - xmin
+                    if xsize < self.grid_size:
+                        log.debug("Partitioning superpartition {:d} has been rejected, while the xsize {:f} of subpartition gets smaller then grid size {:f}.".format(superpartition_id, xsize, self.grid_size))
+                        continue
+
+                    # Split superpartition by vertical line.
+                    subpartitions.append((superpartition_id, xmin, ymin, xcenter, ymax, self.srid))
+                    subpartitions.append((superpartition_id, xcenter, ymin, xmax, ymax, self.srid))
+                else:
+                    # Reject splitting superpartition if the ysize gets smaller then grid size.
+                    # Due to current splitting calculation, the ysize becomes zero in such case.
+                    # Due to rounding, the lower part of the split is always smaller then upper part.
+                    ysize = ycenter - ymin
+                    if ysize < self.grid_size:
+                        log.debug("Partitioning superpartition {:d} has been rejected, while the ysize {:f} of subpartition gets smaller then grid size {:f}.".format(superpartition_id, ysize, self.grid_size))
+                        continue
+
+                    # Split superpartition by horizontal line.
+                    subpartitions.append((superpartition_id, xmin, ymin, xmax, ycenter, self.srid))
+                    subpartitions.append((superpartition_id, xmin, ycenter, xmax, ymax, self.srid))
+                split_count += 1
+
+            # Insert all subpartitions of the level at once.
+            if len(subpartitions) > 0:
+                sql = ("INSERT INTO {partition_table_name} (superpartition_id, geom)\n"
+                       "VALUES %s;")
+                sql = sql.format(**sql_params)
+                psycopg2.extras.execute_values(superpartition_cursor, sql, subpartitions,
+                                               template="(%s, ST_MakeEnvelope(%s, %s, %s, %s, %s))",
+                                               page_size=1000)
             log.debug("{:d} superpartitions have been splitted into subpartitions.".format(split_count))
             return split_count
 
     def _fill_subpartitions(self):
         """Insert features into subpartitions."""
+        if self.workers <= 1:
+            self._fill_subpartition_batch(self.connection, None)
+            return
+
+        # Features of different superpartitions are independent of each other,
+        # so the superpartitions are processed in batches in parallel.
+        sql_params = {"partition_table_name": self.partition_table_name}
         with self.connection.cursor() as cursor:
-            sql_params = {"feature_table_name": self.feature_table_name,
-                          "partition_table_name": self.partition_table_name}
+            sql = ("SELECT DISTINCT superpartition_id\n"
+                   "FROM {partition_table_name}\n"
+                   "WHERE num_vertices IS NULL\n"
+                   "ORDER BY superpartition_id;")
+            sql = sql.format(**sql_params)
+            cursor.execute(sql)
+            superpartition_ids = [row[0] for row in cursor.fetchall()]
+        # More batches than workers balance the uneven cost of the batches.
+        batches = split_batches(superpartition_ids, 4 * self.workers)
+        if self.connection_pool is None:
+            self.connection_pool = ConnectionPool(self.connection, self.workers)
+        self.connection_pool.map(self._fill_subpartition_batch, batches)
+        log.debug("Features of {:d} superpartitions have been filled into subpartitions in {:d} batches."
+                  .format(len(superpartition_ids), len(batches)))
+
+    def _fill_subpartition_batch(self, connection, superpartition_ids):
+        """
+        Insert features of some superpartitions into subpartitions.
+        :param superpartition_ids: list of superpartition ids, None means all superpartitions.
+        """
+        sql_params = {"feature_table_name": self.feature_table_name,
+                      "partition_table_name": self.partition_table_name}
+        if superpartition_ids is None:
+            sql_params["superpartition_filter"] = ""
+            sql_args = None
+        else:
+            sql_params["superpartition_filter"] = " AND p.superpartition_id = ANY(%s)"
+            sql_args = [superpartition_ids]
+        with connection.cursor() as cursor:
             # Move features from superpartition into covering subpartition.
             sql = ("UPDATE {feature_table_name} AS f\n"
                    "SET partition_id = p.partition_id\n"
@@ -1135,9 +1818,9 @@ class PartitionedLayer():
                    "WHERE\n"
                    " p.num_vertices IS NULL\n"
                    " AND f.partition_id = p.superpartition_id\n"
-                   " AND f.geom @ p.geom;")
+                   " AND f.geom @ p.geom{superpartition_filter};")
             sql = sql.format(**sql_params)
-            cursor.execute(sql)
+            cursor.execute(sql, sql_args)
             log.debug("{:d} features have been moved into subpartitions.".format(cursor.rowcount))
 
             # Split remaining features into both subpartitions.
@@ -1149,9 +1832,9 @@ class PartitionedLayer():
                    "FROM\n"
                    " {feature_table_name} AS f\n"
                    " INNER JOIN {partition_table_name} AS p ON f.partition_id = p.superpartition_id\n"
-                   "WHERE p.num_vertices IS NULL;")
+                   "WHERE p.num_vertices IS NULL{superpartition_filter};")
             sql = sql.format(**sql_params)
-            cursor.execute(sql)
+            cursor.execute(sql, sql_args)
             log.debug("{:d} features have been splitted into subpartitions.".format(cursor.rowcount))
 
     def _delete_superitems(self):
@@ -1202,6 +1885,9 @@ class PartitionedLayer():
         else:
             log.debug("Started partitioning layer {:s}.".format(self.pg_layer_name))
             self._create_polygon_dump()
+            cached_table_names = [self.partition_table_name, self.feature_table_name]
+            if self.is_cached and restore_cached_tables(self.connection, self.pg_layer_name, cached_table_names):
+                return
             xmin, ymin, xmax, ymax = self.extract_extent()
             xmin, ymin, xmax, ymax = self.expand_box(xmin, ymin, xmax, ymax)
             self._create_partition_table()
@@ -1209,15 +1895,28 @@ class PartitionedLayer():
             self._create_feature_table()
             self._fill_initial_features(initial_partition_id)
             self._update_npoints()
-            while True:
-                split_count = self._split_partitions()
-                if split_count == 0:
-                    break
-                self._fill_subpartitions()
-                self._delete_superitems()
-                self._update_npoints()
+            try:
+                while True:
+                    split_count = self._split_partitions()
+                    if split_count == 0:
+                        break
+                    self._fill_subpartitions()
+                    self._delete_superitems()
+                    self._update_npoints()
+            finally:
+                # The connections of the pool are closed even if the partitioning fails.
+                if self.connection_pool is not None:
+                    self.connection_pool.close()
+                    self.connection_pool = None
+            if self.is_cached:
+                publish_cached_tables(self.connection, self.pg_layer_name, cached_table_names)
             log.info("Layer {:s} has just been partitioned.".format(self.pg_layer_name))
 
+    @property
+    def is_cached(self):
+        """Only the partitions made with default parameters and the tables derived from them are cached."""
+        return self.max_vertices == PARTITION_MAX_VERTICES and self.grid_size == 1.
+
     def is_made(self):
         return table_exists(self.connection, self.partition_table_name)
 
@@ -1227,6 +1926,8 @@ class NeighbourTable():
         self.partitioned_layer = partitioned_layer
         self.neighbour_table_name = "neighbour_{:s}".format(partitioned_layer.pg_layer_name)
         self.neighbour_length_tolerance = NEIGHBOUR_LENGTH_TOLERANCE
+        self.partition_count = 0
+        self.done_counter = None
 
     @property
     def connection(self):
@@ -1250,37 +1951,94 @@ class NeighbourTable():
             cursor.execute(sql)
 
     def _fill(self):
+        """Fill the table with neighbouring pairs, the partitions are processed independently.
+
+        Every feature is processed in its home partition, that is the partition with the lowest id
+        holding any part of the feature. All parts of the home features are compared with all parts
+        of other features, so every pair is found complete by exactly one partition."""
+        sql_params = {"partition_table_name": self.partitioned_layer.partition_table_name}
+        with self.connection.cursor() as cursor:
+            sql = "SELECT partition_id FROM {partition_table_name} ORDER BY partition_id;"
+            sql = sql.format(**sql_params)
+            cursor.execute(sql)
+            partition_ids = [row[0] for row in cursor.fetchall()]
+
+        self.partition_count = len(partition_ids)
+        self.done_counter = count(1)
+        if self.partitioned_layer.workers <= 1:
+            for partition_id in partition_ids:
+                self._fill_partition(self.connection, partition_id)
+        else:
+            with ConnectionPool(self.connection, self.partitioned_layer.workers) as connection_pool:
+                connection_pool.map(self._fill_partition, partition_ids)
+
+    def _fill_partition(self, connection, partition_id):
         sql_params = {"feature_table_name": self.partitioned_layer.feature_table_name,
                       "neighbour_table_name": self.neighbour_table_name,
                       "neighbour_length_tolerance": self.neighbour_length_tolerance}
-        with self.connection.cursor() as cursor:
-            # Insert neighbouring pairs.
+        with connection.cursor() as cursor:
+            # Find neighbouring pairs of the home features of the partition.
+            #
+            # ST_Intersects() and ST_Relate() are evaluated before the costly intersection.
+            # The dimension of the intersection is the highest dimension of the intersection matrix
+            # items involving interiors and boundaries.
+            # The intersection of two polygons may have some length only if their boundaries share a line
+            # or if their interiors overlap, so the intersection is computed only in such cases.
             sql = ("WITH\n"
-                   " intersections AS\n"
+                   " home AS\n"
+                   "  (SELECT DISTINCT f.fid\n"
+                   "   FROM {feature_table_name} AS f\n"
+                   "   WHERE\n"
+                   "    f.partition_id = %(partition_id)s\n"
+                   "    AND NOT EXISTS (SELECT FROM {feature_table_name} AS g\n"
+                   "                    WHERE g.fid = f.fid AND g.partition_id < %(partition_id)s)),\n"
+                   " relations AS\n"
                    "  (SELECT\n"
                    "    ta.fid AS fida,\n"
                    "    tb.fid AS fidb,\n"
-                   "    ST_Intersection(ta.geom, tb.geom) AS geom\n"
-                   "   FROM {feature_table_name} AS ta\n"
-                   "   INNER JOIN {feature_table_name} AS tb ON ta.geom && tb.geom\n"
+                   "    ta.geom AS geoma,\n"
+                   "    tb.geom AS geomb,\n"
+                   "    ST_Relate(ta.geom, tb.geom) AS im\n"
+                   "   FROM\n"
+                   "    home\n"
+                   "    INNER JOIN {feature_table_name} AS ta ON ta.fid = home.fid\n"
+                   "    INNER JOIN {feature_table_name} AS tb ON ta.geom && tb.geom\n"
                    "   WHERE\n"
-                   "    ta.fid < tb.fid)\n"
-                   "INSERT INTO {neighbour_table_name} (fida, fidb, dim)\n"
-                   "SELECT fida, fidb, max(ST_Dimension(geom)) AS dim\n"
+                   "    ta.fid < tb.fid\n"
+                   "    AND ST_Intersects(ta.geom, tb.geom)),\n"
+                   " intersections AS\n"
+                   "  (SELECT\n"
+                   "    fida,\n"
+                   "    fidb,\n"
+                   "    (SELECT max(d)\n"
+                   "     FROM unnest(ARRAY[substr(im, 1, 1), substr(im, 2, 1), substr(im, 4, 1), substr(im, 5, 1)]) AS d\n"
+                   "     WHERE d <> 'F')::smallint AS dim,\n"
+                   "    CASE\n"
+                   "     WHEN substr(im, 5, 1) = '1' OR substr(im, 1, 1) = '2' THEN ST_Length(ST_Intersection(geoma, geomb))\n"
+                   "     ELSE 0\n"
+                   "    END AS length\n"
+                   "   FROM relations)\n"
+                   "SELECT fida, fidb, max(dim) AS dim\n"
                    "FROM intersections\n"
-                   "WHERE NOT ST_IsEmpty(geom)\n"
                    "GROUP BY fida, fidb\n"
-                   "HAVING max(ST_Dimension(geom)) >= 1 AND max(ST_Length(geom)) > {neighbour_length_tolerance};")
-            
+                   "HAVING max(dim) >= 1 AND max(length) > {neighbour_length_tolerance};")
             sql = sql.format(**sql_params)
-            cursor.execute(sql)
+            cursor.execute(sql, {"partition_id": partition_id})
+            pairs = cursor.fetchall()
+
+            # Copy both directions of the pairs at once.
+            if len(pairs) > 0:
+                buf = io.StringIO()
+                for fida, fidb, dim in pairs:
+                    buf.write("{:d}\t{:d}\t{:d}\n{:d}\t{:d}\t{:d}\n".format(fida, fidb, dim, fidb, fida, dim))
+                buf.seek(0)
+                sql = "COPY {neighbour_table_name} (fida, fidb, dim) FROM STDIN;"
+                sql = sql.format(**sql_params)
+                cursor.copy_expert(sql, buf)
 
-            # Insert inverted pairs.
-            sql = ("INSERT INTO {neighbour_table_name} (fida, fidb, dim)\n"
-                   "SELECT fidb, fida, dim\n"
-                   "FROM {neighbour_table_name};")
-            sql = sql.format(**sql_params)
-            cursor.execute(sql)
+        # next() of itertools.count is atomic, so the counter is safe in parallel threads.
+        log.info("Neighbours of partition {:d} ({:d}/{:d}) have been found, {:d} pairs."
+                 .format(partition_id, next(self.done_counter), self.partition_count, len(pairs)))
 
     def make(self):
         if self.is_made():
@@ -1288,8 +2046,13 @@ class NeighbourTable():
         else:
             log.debug("Starting creating support table of neighbours {:s}.".format(self.neighbour_table_name))
             self.partitioned_layer.make()
+            is_cached = self.partitioned_layer.is_cached
+            if is_cached and restore_cached_tables(self.connection, self.partitioned_layer.pg_layer_name, [self.neighbour_table_name]):
+                return
             self._create_neighbour_table()
             self._fill()
+            if is_cached:
+                publish_cached_tables(self.connection, self.partitioned_layer.pg_layer_name, [self.neighbour_table_name])
             log.info("Support table of neighbours {:s} has just been created.".format(self.neighbour_table_name))
 
     def is_made(self):
@@ -1374,8 +2137,13 @@ class _InteriorTable():
         else:
             log.info("Started creating interior table for the layer {:s}.".format(self.partitioned_layer.pg_layer_name))
             self.partitioned_layer.make()
+            is_cached = self.partitioned_layer.is_cached
+            if is_cached and restore_cached_tables(self.connection, self.partitioned_layer.pg_layer_name, [self.interior_table_name]):
+                return
             self._create_interior_table()
             self._fill()
+            if is_cached:
+                publish_cached_tables(self.connection, self.partitioned_layer.pg_layer_name, [self.interior_table_name])
             log.info("Interior table for the layer {:s} has just been created.".format(self.partitioned_layer.pg_layer_name))
 
     def is_made(self):
@@ -1535,123 +2303,99 @@ class ComplexChangeProperty():
             cursor.execute(sql)
 
 
-    def _fill_cluster_new(self, cc_id_column_name, code_column_name):
-        sql_params = {
-            "neighbour_table_name": self.neighbour_table.neighbour_table_name,
-            "meta_table_name": self.meta_table.meta_table_name,
-            "pg_layer_name": self.partitioned_layer.pg_layer_name,
-            "pg_fid_name": self.partitioned_layer.pg_fid_name,
-            "cc_id_column_name": cc_id_column_name,
-            "code_column_name": code_column_name
-        }
-
-        # We only need fida < fidb because your table is symmetrical.
-        # This prevents processing the same pair twice.
-        sql = ("SELECT nb.fida, nb.fidb\n"
-               " FROM {neighbour_table_name} AS nb\n"
-               " INNER JOIN {pg_layer_name} AS la ON nb.fida = la.{pg_fid_name}\n"
-               " INNER JOIN {pg_layer_name} AS lb ON nb.fidb = lb.{pg_fid_name}\n"
-               " WHERE nb.fida < nb.fidb\n"
-               " AND la.{code_column_name} = lb.{code_column_name};").format(**sql_params)
-
-        parent = {}
-
-        def find(i):
-            if parent[i] == i:
-                return i
-            # Path compression: makes future lookups nearly O(1)
-            parent[i] = find(parent[i])
-            return parent[i]
-
-        def union(i, j):
-            if i not in parent: parent[i] = i
-            if j not in parent: parent[j] = j
-            root_i = find(i)
-            root_j = find(j)
-            if root_i != root_j:
-                # Use smaller ID as root to satisfy your requirement
-                if root_i < root_j:
-                    parent[root_j] = root_i
-                else:
-                    parent[root_i] = root_j
-
-        with self.connection.cursor() as cursor:
-            cursor.execute(sql)
-            for fida, fidb in cursor.fetchall():
-                union(fida, fidb)
-
-            if not parent:
-                return
-
-            # Flatten the structure so everyone points to the absolute root
-            fid_cc_idx = {fid: find(fid) for fid in parent}
-
-            # Bulk update to meta table
-            # Using a single UPDATE with a VALUES list is much faster than a loop
-            values_str = ",".join(cursor.mogrify("(%s,%s)", (f, c)).decode('utf-8') 
-                                 for f, c in fid_cc_idx.items())
-            
-            update_sql = (
-                "UPDATE {meta_table_name} AS m \n"
-                "SET {cc_id_column_name} = v.cc_id \n"
-                "FROM (VALUES {values}) AS v(fid, cc_id) \n"
-                "WHERE m.fid = v.fid;"
-            ).format(values=values_str, **sql_params)
-            
-            cursor.execute(update_sql)
-
-
     def _fill_cluster(self, cc_id_column_name, code_column_name):
         # Complex change is a cluster consisting of neighbouring features having the same code.
         # For the purpose of related algorithms every cluster is identified by the smallest fid
         # of its member feature.
+        import numpy
 
         # Prepare sql params.
         sql_params = {"neighbour_table_name": self.neighbour_table.neighbour_table_name,
                       "meta_table_name": self.meta_table.meta_table_name,
                       "pg_layer_name": self.partitioned_layer.pg_layer_name,
                       "pg_fid_name": self.partitioned_layer.pg_fid_name,
-                      "initial_code_column_name": self.initial_code_column_name,
-                      "final_code_column_name": self.final_code_column_name,
                       "cc_id_column_name": cc_id_column_name,
-                      "code_column_name": code_column_name}
+                      "code_column_name": code_column_name,
+                      "cluster_table_name": "cluster_{:s}".format(self.partitioned_layer.pg_layer_name)}
 
-        # Pair every feature with the smallest fid of its neighbours.
-        # Apply filter to members of complex change.
-        # Order the result by fid which is important for the next step.
-        sql = ("SELECT layer.{pg_fid_name}, min(other.{pg_fid_name}) AS nfid\n"
+        # Select pairs of neighbours having the same code.
+        # The neighbour table is symmetrical, so every pair is taken only once.
+        sql = ("SELECT nb.fida, nb.fidb\n"
                " FROM\n"
-               "  {pg_layer_name} AS layer\n"
-               "  INNER JOIN {neighbour_table_name} AS nb ON layer.{pg_fid_name} = nb.fida\n"
-               "  INNER JOIN {pg_layer_name} AS other ON nb.fidb = other.{pg_fid_name}\n"
+               "  {neighbour_table_name} AS nb\n"
+               "  INNER JOIN {pg_layer_name} AS la ON nb.fida = la.{pg_fid_name}\n"
+               "  INNER JOIN {pg_layer_name} AS lb ON nb.fidb = lb.{pg_fid_name}\n"
                " WHERE\n"
-               "  layer.{code_column_name} = other.{code_column_name}\n"
-               " GROUP BY layer.{pg_fid_name}\n"
-               " ORDER BY layer.{pg_fid_name};")
+               "  nb.fida < nb.fidb\n"
+               "  AND la.{code_column_name} = lb.{code_column_name};")
         sql = sql.format(**sql_params)
         with self.connection.cursor() as cursor:
             cursor.execute(sql)
+            pairs = numpy.array(cursor.fetchall(), dtype=numpy.int64).reshape(-1, 2)
+        if len(pairs) == 0:
+            return
 
-            # Assign cluster ids to features.
-            # For every feature find the root feature.
-            # Root feature is cluster member with the smallest fid.
-            # As the features are sorted by fid,
-            # and the features are registered sequentially,
-            # it is enough for every feature being just registered
-            # to take cluster fid from its already registered neighbour.
-            fid_cc_idx = {}
-            for (fid, nfid) in cursor.fetchall():
-                if fid <= nfid:
-                    fid_cc_idx[fid] = fid
-                else:
-                    fid_cc_idx[fid] = fid_cc_idx[nfid]
+        # Number the member features by the order of their fids.
+        fids, pair_idxs = numpy.unique(pairs, return_inverse=True)
+        pair_idxs = pair_idxs.reshape(-1, 2)
+        del pairs
+
+        # Union-find with parents stored in array indexed by the feature number.
+        # The smaller root always becomes the parent, so the root of every cluster
+        # is the member with the smallest fid.
+        parent = list(range(len(fids)))
+
+        def find(i):
+            while parent[i] != i:
+                # Path halving.
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for idx_a, idx_b in pair_idxs.tolist():
+            root_a = find(idx_a)
+            root_b = find(idx_b)
+            if root_a < root_b:
+                parent[root_b] = root_a
+            elif root_b < root_a:
+                parent[root_a] = root_b
+        del pair_idxs
+
+        # Parents always have smaller number than children,
+        # so a single pass in ascending order points every feature to the root.
+        for i in range(len(parent)):
+            parent[i] = parent[parent[i]]
+        cc_ids = fids[parent]
 
-        # Dump clusters.
         with self.connection.cursor() as cursor:
-            for fid, cc_id in fid_cc_idx.items():
-                sql = "UPDATE {meta_table_name} SET {cc_id_column_name} = %s WHERE fid = %s;"
+            # Copy the clusters into temporary table and update the meta table by single join.
+            sql = "CREATE TEMPORARY TABLE {cluster_table_name} (fid integer PRIMARY KEY, cc_id integer NOT NULL);"
+            sql = sql.format(**sql_params)
+            cursor.execute(sql)
+            try:
+                sql = "COPY {cluster_table_name} (fid, cc_id) FROM STDIN;"
+                sql = sql.format(**sql_params)
+                for start in range(0, len(fids), CLUSTER_COPY_BATCH_SIZE):
+                    buf = io.StringIO()
+                    for fid, cc_id in zip(fids[start:start + CLUSTER_COPY_BATCH_SIZE].tolist(),
+                                          cc_ids[start:start + CLUSTER_COPY_BATCH_SIZE].tolist()):
+                        buf.write("{:d}\t{:d}\n".format(fid, cc_id))
+                    buf.seek(0)
+                    cursor.copy_expert(sql, buf)
+
+                sql = ("UPDATE {meta_table_name} AS meta\n"
+                       " SET {cc_id_column_name} = cl.cc_id\n"
+                       " FROM {cluster_table_name} AS cl\n"
+                       " WHERE meta.fid = cl.fid;")
                 sql = sql.format(**sql_params)
-                cursor.execute(sql, [cc_id, fid])
+                cursor.execute(sql)
+                log.debug("{:d} features have been assigned to clusters in {:s}.".format(cursor.rowcount, cc_id_column_name))
+            finally:
+                # The table is dropped even on failure, so the next call in the same session may create it again.
+                # The connection is in autocommit mode, so the failed statement does not block the drop.
+                sql = "DROP TABLE IF EXISTS {cluster_table_name};"
+                sql = sql.format(**sql_params)
+                cursor.execute(sql)
 
     def _fill_area(self, cc_id_column_name):
         sql_params = {"meta_table_name": self.meta_table.meta_table_name,
@@ -1684,8 +2428,8 @@ class ComplexChangeProperty():
             self._prepare_meta_table()
 
             # Fill clusters for initial year and for final year.
-            self._fill_cluster_new("cc_id_initial", self.initial_code_column_name)
-            self._fill_cluster_new("cc_id_final", self.final_code_column_name)
+            self._fill_cluster("cc_id_initial", self.initial_code_column_name)
+            self._fill_cluster("cc_id_final", self.final_code_column_name)
 
             # Fill complex change area by greater of initial year and final year.
             self._fill_area("cc_id_initial")
@@ -1697,13 +2441,19 @@ class ComplexChangeProperty():
 
 
 class GapTable():
-    def __init__(self, partitioned_layer, boundary_layer_name, du_column_name, use_snapping=True):
+    def __init__(self, partitioned_layer, boundary_layer_name, du_column_name, use_snapping=True, prescreen_resolution=None):
+        """
+        :param prescreen_resolution: pixel size of the raster pre-screen, None means no pre-screen.
+            Partitions whose gap features touch only pixels lying fully inside the interior
+            are fully covered and no exact differencing is done for them.
+        """
         self.partitioned_layer = partitioned_layer
         self.interior_table = _InteriorTable(partitioned_layer)
         self.boundary_layer_name = boundary_layer_name
         self.du_column_name = du_column_name
         self.gap_table_name = "gap_{:s}".format(partitioned_layer.pg_layer_name)
         self.use_snapping = use_snapping
+        self.prescreen_resolution = prescreen_resolution
 
     @property
     def connection(self):
@@ -1762,9 +2512,14 @@ class GapTable():
         with self.connection.cursor() as cursor:
             sql = ("CREATE TABLE {gap_table}\n"
                    " (fid SERIAL PRIMARY KEY,\n"
+                   "  source_fid integer NULL DEFAULT NULL,\n"
+                   "  partition_id integer NULL DEFAULT NULL,\n"
                    "  geom geometry(Polygon, {srid}));")
             sql = sql.format(**sql_params)
             cursor.execute(sql)
+            sql = ("CREATE INDEX {gap_table}_partition_id_idx ON {gap_table} (partition_id);")
+            sql = sql.format(**sql_params)
+            cursor.execute(sql)
 
     def _fill_initial_features(self):
         sql_params = {"gap_table": self.gap_table_name,
@@ -1784,18 +2539,74 @@ class GapTable():
             sql = sql.format(**sql_params)
             cursor.execute(sql)
 
-    def _split_features(self):
-        """Splits gap features having too many vertices."""
+    def _snap_features(self):
+        """Snaps gap features to fine grid and makes them valid.
+
+        Snapping is used to prevent false gaps.
+        The gap features are snapped once here and every subtraction keeps them snapped and valid."""
         sql_params = {"gap_table": self.gap_table_name}
-        sql_execute_params = {"grid_size": self.partitioned_layer.grid_size,
-                              "max_vertices": self.partitioned_layer.max_vertices}
         with self.connection.cursor() as cursor:
             sql = ("WITH\n"
-                   " sel AS (SELECT fid AS orig_fid, split_geom(geom, %(grid_size)s) AS new_geom\n"
+                   " sel AS (SELECT\n"
+                   "          fid AS orig_fid,\n"
+                   "          ST_CollectionExtract(ST_MakeValid(ST_SnapToGrid(geom, 0.000001)), 3) AS new_geom\n"
                    "         FROM {gap_table}\n"
-                   "         WHERE ST_NPoints(geom) > %(max_vertices)s),\n"
+                   "         WHERE geom IS NOT NULL),\n"
                    " ins AS (INSERT INTO {gap_table} (geom)\n"
-                   "         SELECT new_geom\n"
+                   "         SELECT polygon_dump(new_geom)\n"
+                   "         FROM sel\n"
+                   "         WHERE NOT ST_IsEmpty(new_geom))\n"
+                   "DELETE FROM {gap_table}\n"
+                   "WHERE fid IN (SELECT orig_fid FROM sel);")
+            sql = sql.format(**sql_params)
+            cursor.execute(sql)
+            log.debug("{:d} gap features have been snapped.".format(cursor.rowcount))
+
+    def _assign_partitions(self):
+        """Cuts gap features by partitions.
+
+        Every partition gets its own pieces of gap features, so the partitions can be processed independently.
+        Parts of gap features outside of all partitions get no partition.
+        Every piece remembers the gap feature it was cut from in source_fid."""
+        sql_params = {"gap_table": self.gap_table_name,
+                      "partition_table": self.partitioned_layer.partition_table_name}
+        with self.connection.cursor() as cursor:
+            sql = ("WITH\n"
+                   " sel AS (SELECT fid AS orig_fid, geom\n"
+                   "         FROM {gap_table}),\n"
+                   " ext AS (SELECT ST_SetSRID(ST_Extent(geom)::geometry, %(srid)s) AS geom\n"
+                   "         FROM {partition_table}),\n"
+                   " ins_inside AS (INSERT INTO {gap_table} (source_fid, partition_id, geom)\n"
+                   "                SELECT sel.orig_fid, pt.partition_id, polygon_dump(ST_Intersection(sel.geom, pt.geom))\n"
+                   "                FROM sel INNER JOIN {partition_table} AS pt ON sel.geom && pt.geom),\n"
+                   " ins_outside AS (INSERT INTO {gap_table} (source_fid, geom)\n"
+                   "                 SELECT sel.orig_fid, polygon_dump(ST_Difference(sel.geom, ext.geom))\n"
+                   "                 FROM sel CROSS JOIN ext)\n"
+                   "DELETE FROM {gap_table}\n"
+                   "WHERE fid IN (SELECT orig_fid FROM sel);")
+            sql = sql.format(**sql_params)
+            cursor.execute(sql, {"srid": self.partitioned_layer.srid})
+            log.debug("{:d} gap features have been cut by partitions.".format(cursor.rowcount))
+
+    def _split_features(self, connection=None, partition_id=None):
+        """
+        Splits gap features having too many vertices.
+        :param partition_id: only gap features of the partition are split, None means all gap features.
+        """
+        if connection is None:
+            connection = self.connection
+        sql_params = {"gap_table": self.gap_table_name,
+                      "partition_filter": "" if partition_id is None else " AND partition_id = %(partition_id)s"}
+        sql_execute_params = {"grid_size": self.partitioned_layer.grid_size,
+                              "max_vertices": self.partitioned_layer.max_vertices,
+                              "partition_id": partition_id}
+        with connection.cursor() as cursor:
+            sql = ("WITH\n"
+                   " sel AS (SELECT fid AS orig_fid, source_fid, partition_id, split_geom(geom, %(grid_size)s) AS new_geom\n"
+                   "         FROM {gap_table}\n"
+                   "         WHERE ST_NPoints(geom) > %(max_vertices)s{partition_filter}),\n"
+                   " ins AS (INSERT INTO {gap_table} (source_fid, partition_id, geom)\n"
+                   "         SELECT source_fid, partition_id, new_geom\n"
                    "         FROM sel)\n"
                    "DELETE FROM {gap_table}\n"
                    "WHERE fid IN (SELECT orig_fid FROM sel);")
@@ -1803,12 +2614,14 @@ class GapTable():
             cursor.execute(sql, sql_execute_params)
             return cursor.rowcount
 
-    def _subtract_partition(self, partition_id, use_snapping=True):
-        """Subtracts interior of the partition from the gap table."""
+    def _subtract_partition(self, partition_id, use_snapping=True, connection=None):
+        """Subtracts interior of the partition from the gap features of the partition."""
+        if connection is None:
+            connection = self.connection
         sql_params = {"gap_table": self.gap_table_name,
                       "interior_table": self.interior_table.interior_table_name}
         sql_execute_params = {"partition_id": partition_id}
-        with self.connection.cursor() as cursor:
+        with connection.cursor() as cursor:
 
             if not use_snapping:
                 # simpler (and potentially faster) sql, but might detect false gaps.
@@ -1818,17 +2631,20 @@ class GapTable():
                     "         WHERE partition_id = %(partition_id)s),\n"
                     " sub AS (SELECT\n"
                     "          gt.fid AS orig_fid,\n"
+                    "          gt.source_fid,\n"
                     "          ST_Difference(ST_Buffer(gt.geom, 0), ST_Buffer(par.geom, 0)) AS sgeom\n"
                     "         FROM\n"
                     "          {gap_table} AS gt\n"
-                    "          INNER JOIN par ON gt.geom && par.geom),\n"
-                    " ins AS (INSERT INTO {gap_table} (geom)\n"
-                    "         SELECT polygon_dump(sgeom)\n"
+                    "          INNER JOIN par ON gt.geom && par.geom\n"
+                    "         WHERE gt.partition_id = %(partition_id)s),\n"
+                    " ins AS (INSERT INTO {gap_table} (source_fid, partition_id, geom)\n"
+                    "         SELECT source_fid, %(partition_id)s, polygon_dump(sgeom)\n"
                     "         FROM sub)\n"
                     "DELETE FROM {gap_table}\n"
                     "WHERE fid IN (SELECT orig_fid FROM sub);")
             else:
-                # Snapping is used to prevent false gaps. note, this may be very slow on complex geometries.
+                # Snapping is used to prevent false gaps.
+                # The gap features have already been snapped, so only the interior and the result are snapped here.
                 sql = """
 WITH
  par AS (
@@ -1836,38 +2652,127 @@ WITH
    FROM {interior_table}
    WHERE partition_id = %(partition_id)s
  ),
- gt_valid AS (
-   SELECT fid, ST_MakeValid(ST_SnapToGrid(geom, 0.000001)) AS geom
-   FROM {gap_table}
-   WHERE ST_IsValid(geom) OR geom IS NOT NULL
- ),
  sub AS (
    SELECT
-     gt_valid.fid AS orig_fid,
+     gt.fid AS orig_fid,
+     gt.source_fid,
      ST_CollectionExtract(
        ST_MakeValid(
-         ST_Difference(gt_valid.geom, par.geom)
+         ST_SnapToGrid(ST_Difference(gt.geom, par.geom), 0.000001)
        ),
        3
      ) AS sgeom
-   FROM gt_valid
-   INNER JOIN par ON gt_valid.geom && par.geom
-   WHERE NOT ST_IsEmpty(gt_valid.geom)
+   FROM {gap_table} AS gt
+   INNER JOIN par ON gt.geom && par.geom
+   WHERE gt.partition_id = %(partition_id)s AND NOT ST_IsEmpty(gt.geom)
  ),
  ins AS (
-   INSERT INTO {gap_table} (geom)
-   SELECT polygon_dump(sgeom)
+   INSERT INTO {gap_table} (source_fid, partition_id, geom)
+   SELECT source_fid, %(partition_id)s, polygon_dump(sgeom)
    FROM sub
    WHERE NOT ST_IsEmpty(sgeom)
  )
 DELETE FROM {gap_table}
 WHERE fid IN (SELECT orig_fid FROM sub);
 """
-            
+
             sql = sql.format(**sql_params)
             cursor.execute(sql, sql_execute_params)
             return cursor.rowcount
 
+    def _rasterize(self, connection, sql, sql_execute_params, window):
+        """Rasterizes geometries selected by sql into the window, burning 1 into every pixel touched by them."""
+        import numpy
+        from osgeo import gdal
+        from osgeo import ogr
+
+        xmin, ymax, ncols, nrows = window
+        ds = gdal.GetDriverByName("MEM").Create("", ncols, nrows, 1, gdal.GDT_Byte)
+        ds.SetGeoTransform([xmin, self.prescreen_resolution, 0, ymax, 0, -self.prescreen_resolution])
+        vector_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+        vector_layer = vector_ds.CreateLayer("prescreen", None, ogr.wkbUnknown)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, sql_execute_params)
+            for row in cursor:
+                feature = ogr.Feature(vector_layer.GetLayerDefn())
+                feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(row[0])))
+                vector_layer.CreateFeature(feature)
+        gdal.RasterizeLayer(ds, [1], vector_layer, burn_values=[1], options=["ALL_TOUCHED=TRUE"])
+        arr = ds.GetRasterBand(1).ReadAsArray()
+        return arr.astype(numpy.bool_)
+
+    def _has_candidate_gaps(self, connection, partition_id):
+        """
+        Pre-screens the partition on raster.
+
+        The partition may be skipped only if it provably contains no gap,
+        so every pixel touched by the gap features must lie fully inside the interior.
+        The part of the pixel inside the partition lies fully inside the interior
+        if the pixel is touched by the interior and it is not crossed by the boundary of the interior,
+        the boundary along the partition edge does not count, the interior is clipped by the partition there.
+        :return: True if some pixel touched by the gap features of the partition is not fully covered by the partition interior.
+        """
+        sql_params = {"partition_table": self.partitioned_layer.partition_table_name,
+                      "gap_table": self.gap_table_name,
+                      "interior_table": self.interior_table.interior_table_name}
+        sql_execute_params = {"partition_id": partition_id}
+        with connection.cursor() as cursor:
+            sql = ("SELECT ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)\n"
+                   "FROM {partition_table}\n"
+                   "WHERE partition_id = %(partition_id)s;")
+            sql = sql.format(**sql_params)
+            cursor.execute(sql, sql_execute_params)
+            xmin, ymin, xmax, ymax = cursor.fetchone()
+        xmin = floor(xmin / self.prescreen_resolution) * self.prescreen_resolution
+        ymax = ceil(ymax / self.prescreen_resolution) * self.prescreen_resolution
+        ncols = max(1, ceil((xmax - xmin) / self.prescreen_resolution))
+        nrows = max(1, ceil((ymax - ymin) / self.prescreen_resolution))
+        if ncols * nrows > GAP_PRESCREEN_MAX_PIXELS:
+            return True
+        window = (xmin, ymax, ncols, nrows)
+
+        sql = ("SELECT ST_AsBinary(geom)\n"
+               "FROM {gap_table}\n"
+               "WHERE partition_id = %(partition_id)s;")
+        gap_arr = self._rasterize(connection, sql.format(**sql_params), sql_execute_params, window)
+        if not gap_arr.any():
+            return False
+        sql = ("SELECT ST_AsBinary(geom)\n"
+               "FROM {interior_table}\n"
+               "WHERE partition_id = %(partition_id)s;")
+        interior_arr = self._rasterize(connection, sql.format(**sql_params), sql_execute_params, window)
+        # The boundary is buffered a bit, so the pixels on both sides of the boundary lying on pixel edge are touched.
+        sql = ("SELECT ST_AsBinary(ST_Buffer(ST_Difference(ST_Boundary(it.geom), ST_Boundary(pt.geom)), %(buffer)s))\n"
+               "FROM\n"
+               " {interior_table} AS it\n"
+               " INNER JOIN {partition_table} AS pt ON it.partition_id = pt.partition_id\n"
+               "WHERE it.partition_id = %(partition_id)s;")
+        boundary_arr = self._rasterize(connection, sql.format(**sql_params),
+                                       {"partition_id": partition_id, "buffer": self.prescreen_resolution / 100},
+                                       window)
+        covered_arr = interior_arr & ~boundary_arr
+        return bool((gap_arr & ~covered_arr).any())
+
+    def _delete_partition(self, connection, partition_id):
+        """Deletes gap features of the partition."""
+        sql_params = {"gap_table": self.gap_table_name}
+        with connection.cursor() as cursor:
+            sql = "DELETE FROM {gap_table} WHERE partition_id = %(partition_id)s;"
+            sql = sql.format(**sql_params)
+            cursor.execute(sql, {"partition_id": partition_id})
+
+    def _subtract_partition_batch(self, connection, partition_ids):
+        for partition_id in partition_ids:
+            if self.prescreen_resolution is not None and not self._has_candidate_gaps(connection, partition_id):
+                # The partition is fully covered at pre-screen resolution, exact differencing is skipped.
+                self._delete_partition(connection, partition_id)
+                continue
+            # Only gap features of the partition being processed are split.
+            while self._split_features(connection, partition_id) > 0:
+                pass
+            self._subtract_partition(partition_id, self.use_snapping, connection)
+        log.debug("Interiors of {:d} partitions have been subtracted from gap table.".format(len(partition_ids)))
+
     def _subtract_all_partitions(self):
         sql_params = {"partition_table": self.partitioned_layer.partition_table_name,
                       "gap_table": self.gap_table_name}
@@ -1875,13 +2780,49 @@ WHERE fid IN (SELECT orig_fid FROM sub);
             sql = "SELECT partition_id FROM {partition_table} ORDER BY partition_id;"
             sql = sql.format(**sql_params)
             cursor.execute(sql)
-            for partition_id in cursor.fetchall():
-                while True:
-                    split_count = self._split_features()
-                    print("splitcount", split_count)
-                    if split_count <= 0:
-                        break
-                self._subtract_partition(partition_id, self.use_snapping)
+            partition_ids = [row[0] for row in cursor.fetchall()]
+
+        # Every partition has its own gap features, so the batches of partitions do not interfere.
+        workers = self.partitioned_layer.workers
+        if workers <= 1:
+            self._subtract_partition_batch(self.connection, partition_ids)
+        else:
+            with ConnectionPool(self.connection, workers) as connection_pool:
+                connection_pool.map(self._subtract_partition_batch, split_batches(partition_ids, 4 * workers))
+
+        with self.connection.cursor() as cursor:
+            sql = "VACUUM ANALYZE {gap_table};"
+            sql = sql.format(**sql_params)
+            cursor.execute(sql)
+
+    def _merge_pieces(self):
+        """Merges touching pieces of the same gap feature cut by partition boundaries."""
+        sql_params = {"gap_table": self.gap_table_name}
+        with self.connection.cursor() as cursor:
+            sql = ("WITH\n"
+                   " cl AS (SELECT\n"
+                   "         fid,\n"
+                   "         source_fid,\n"
+                   "         ST_ClusterDBSCAN(geom, 0, 1) OVER (PARTITION BY source_fid) AS cluster_id,\n"
+                   "         geom\n"
+                   "        FROM {gap_table}\n"
+                   "        WHERE source_fid IS NOT NULL),\n"
+                   " multi AS (SELECT source_fid, cluster_id\n"
+                   "           FROM cl\n"
+                   "           GROUP BY source_fid, cluster_id\n"
+                   "           HAVING count(*) > 1),\n"
+                   " sel AS (SELECT cl.fid AS orig_fid, cl.source_fid, cl.cluster_id, cl.geom\n"
+                   "         FROM cl INNER JOIN multi ON cl.source_fid = multi.source_fid AND cl.cluster_id = multi.cluster_id),\n"
+                   " ins AS (INSERT INTO {gap_table} (source_fid, geom)\n"
+                   "         SELECT source_fid, polygon_dump(ST_Union(geom))\n"
+                   "         FROM sel\n"
+                   "         GROUP BY source_fid, cluster_id)\n"
+                   "DELETE FROM {gap_table}\n"
+                   "WHERE fid IN (SELECT orig_fid FROM sel);")
+            sql = sql.format(**sql_params)
+            cursor.execute(sql)
+            log.debug("{:d} gap pieces have been merged.".format(cursor.rowcount))
+
             sql = "VACUUM ANALYZE {gap_table};"
             sql = sql.format(**sql_params)
             cursor.execute(sql)
@@ -1896,7 +2837,11 @@ WHERE fid IN (SELECT orig_fid FROM sub);
             self._create_split_geom()
             self._create_gap_table()
             self._fill_initial_features()
+            if self.use_snapping:
+                self._snap_features()
+            self._assign_partitions()
             self._subtract_all_partitions()
+            self._merge_pieces()
             log.info("Gap table for the layer {:s} has just been created.".format(self.partitioned_layer.pg_layer_name))
 
     def is_made(self):
@@ -2,18 +2,34 @@
 # -*- coding: utf-8 -*-
 
 
-from subprocess import run
+from concurrent.futures import ThreadPoolExecutor
 
 
 DESCRIPTION = "The layers can be imported into PostGIS database."
 IS_SYSTEM = True
+PROVIDES = ("layer_defs",)
+
+# Number of features imported in one transaction.
+IMPORT_TRANSACTION_SIZE = 100000
+IMPORT_CONFIG_OPTIONS = {"PG_USE_COPY": "YES"}
 
 
 def run_check(params, status):
+    from osgeo import gdal
     from osgeo import ogr
     from osgeo.gdalconst import OF_READONLY
 
+    from qc_tool.translate import TranslateError
+    from qc_tool.translate import vector_translate
+
+    from qc_tool.vector.helper import attach_layer_cache
     from qc_tool.vector.helper import do_layers
+    from qc_tool.vector.helper import evict_layer_cache
+    from qc_tool.vector.helper import get_primary_key_name
+    from qc_tool.vector.helper import make_layer_cache_key
+    from qc_tool.vector.helper import publish_cached_tables
+    from qc_tool.vector.helper import restore_cached_tables
+    from qc_tool.vector.helper import table_exists
 
     # Check if the current delivery is excluded from vector checks
     if "skip_vector_checks" in params:
@@ -22,63 +38,73 @@ def run_check(params, status):
             return
 
     dsn, schema = params["connection_manager"].get_dsn_schema()
+    connection = params["connection_manager"].get_connection()
+    pg_cache_max_size = params.get("pg_cache_max_size", 0)
 
-    # Import all layers found in layer_defs.
+    # Prepare import of all layers found in layer_defs.
+    layer_imports = []
+    src_hashes = {}
     for layer_def in params["layer_defs"].values():
         src_layer_name = layer_def["src_layer_name"]
         pg_layer_name = layer_def["layer_alias"]
 
+        ogr2ogr_options = ["-gt", str(IMPORT_TRANSACTION_SIZE),
+                           "-overwrite",
+                           "-f", "PostgreSQL",
+                           "-lco", "GEOMETRY_NAME=geom",
+                           "-lco", "SCHEMA={:s}".format(schema),
+                           "-lco", "PRECISION=NO",
+                           "-nlt", "MULTIPOLYGON",
+                           "-nln", pg_layer_name]
         if "detected_epsg" in params:
-            ogr2ogr_params = ["ogr2ogr",
-                      "-overwrite",
-                      "-f", "PostgreSQL",
-                      "-lco", "GEOMETRY_NAME=geom",
-                      "-lco", "SCHEMA={:s}".format(schema),
-                      "-lco", "PRECISION=NO",
-                      "-nlt", "MULTIPOLYGON",
-                      "-nln", pg_layer_name,
-                      "-a_srs", "EPSG:{:d}".format(params["detected_epsg"]),
-                      "PG:{:s}".format(dsn),
-                      str(layer_def["src_filepath"]),
-                      src_layer_name]
-        else:
-            ogr2ogr_params = ["ogr2ogr",
-                      "-overwrite",
-                      "-f", "PostgreSQL",
-                      "-lco", "GEOMETRY_NAME=geom",
-                      "-lco", "SCHEMA={:s}".format(schema),
-                      "-lco", "PRECISION=NO",
-                      "-nlt", "MULTIPOLYGON",
-                      "-nln", pg_layer_name,
-                      "PG:{:s}".format(dsn),
-                      str(layer_def["src_filepath"]),
-                      src_layer_name]
-            
-        # Special import options for CSV layers.
+            ogr2ogr_options += ["-a_srs", "EPSG:{:d}".format(params["detected_epsg"])]
+        ogr2ogr_options += [src_layer_name]
+
+        # Special open options for CSV layers.
+        open_options = []
         if str(layer_def["src_filepath"]).lower().endswith(".csv"):
-            ogr2ogr_params += ["-oo", "SEPARATOR=SEMICOLON"]
-            ogr2ogr_params += ["-oo", "AUTODETECT_TYPE=YES"]
-            ogr2ogr_params += ["-oo", "EMPTY_STRING_AS_NULL=YES"]
-        
-        # Run ogr2ogr command with the arguments defined above.
-        pc = run(ogr2ogr_params)
-        
-        if pc.returncode != 0:
-            status.aborted("Failed to import layer {:s} into PostGIS.".format(src_layer_name))
-        else:
-            # ogr2ogr not always returns non-zero exit code in case of error.
-            # Therefore we try some checking whether the layer has been imported correctly.
+            open_options = ["SEPARATOR=SEMICOLON",
+                            "AUTODETECT_TYPE=YES",
+                            "EMPTY_STRING_AS_NULL=YES"]
+
+        # Attach the layer to the layer cache, the layer imported by previous job is copied from there.
+        is_restored = False
+        if pg_cache_max_size > 0:
+            cache_key = make_layer_cache_key(layer_def, params.get("detected_epsg"), src_hashes)
+            attach_layer_cache(connection, pg_layer_name, cache_key)
+            is_restored = restore_cached_tables(connection, pg_layer_name, [pg_layer_name])
+
+        layer_imports.append((layer_def, ogr2ogr_options, open_options, is_restored))
 
-            ## Open datasource from filesystem.
-            src_datasource = ogr.Open(str(layer_def["src_filepath"]), OF_READONLY)
-            src_layer = src_datasource.GetLayerByName(src_layer_name)
+    # Run imports concurrently, every import has its own database connection.
+    def import_layer(layer_import):
+        """Returns None on success, otherwise the error reported by GDAL."""
+        layer_def, ogr2ogr_options, open_options, is_restored = layer_import
+        if is_restored:
+            return None
+        src_ds = gdal.OpenEx(str(layer_def["src_filepath"]), gdal.OF_VECTOR, open_options=open_options)
+        if src_ds is None:
+            return "The source can not be opened."
+        try:
+            vector_translate("PG:{:s}".format(dsn), src_ds, ogr2ogr_options, config=IMPORT_CONFIG_OPTIONS)
+        except TranslateError as ex:
+            return str(ex)
+        return None
 
-            ## Open datasource from postgis.
-            conn_string = "PG:{:s} active_schema={:s}".format(dsn, schema)
-            dst_datasource = ogr.Open(conn_string, OF_READONLY)
-            # NOTE: GetLayerByName() works case insensitive in this case.
-            dst_layer = dst_datasource.GetLayerByName(pg_layer_name)
-            if dst_layer is None:
+    workers = max(1, params.get("pg_workers", 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        import_errors = list(executor.map(import_layer, layer_imports))
+
+    for (layer_def, ogr2ogr_options, open_options, is_restored), import_error in zip(layer_imports, import_errors):
+        src_layer_name = layer_def["src_layer_name"]
+        pg_layer_name = layer_def["layer_alias"]
+
+        if import_error is not None:
+            status.aborted("Failed to import layer {:s} into PostGIS. {:s}".format(src_layer_name, import_error))
+        else:
+            # Not every failure is reported by GDAL.
+            # Therefore we try some checking whether the layer has been imported correctly.
+            if not table_exists(connection, pg_layer_name):
                 status.aborted("Just imported layer {:s} can not be found in postgis.".format(src_layer_name))
             else:
                 ## Set pg info back to layer_defs.
@@ -86,15 +112,24 @@ def run_check(params, status):
                 ## FIXME: such construct is not really clear while it exploits mutable dictionaries
                 ## and bypasses currently standard use of status.add_params().
                 layer_def["pg_layer_name"] = pg_layer_name
-                layer_def["pg_fid_name"] = dst_layer.GetFIDColumn().lower()
+                layer_def["pg_fid_name"] = get_primary_key_name(connection, pg_layer_name)
                 if layer_def["pg_fid_name"] == "objectid":
                     layer_def["fid_display_name"] = "objectid"
                 else:
                     layer_def["fid_display_name"] = "row number"
 
                 ## Ensure all features has been imported.
+                src_datasource = ogr.Open(str(layer_def["src_filepath"]), OF_READONLY)
+                src_layer = src_datasource.GetLayerByName(src_layer_name)
                 src_count = src_layer.GetFeatureCount()
-                dst_count = dst_layer.GetFeatureCount()
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT count(*) FROM {:s};".format(pg_layer_name))
+                    dst_count = cursor.fetchone()[0]
                 if src_count != dst_count:
                     status.aborted("Imported layer {:s} has only {:d} out of {:d} features loaded."
                                    .format(src_layer_name, dst_count, src_count))
+                elif pg_cache_max_size > 0 and not is_restored:
+                    publish_cached_tables(connection, pg_layer_name, [pg_layer_name])
+
+    if pg_cache_max_size > 0:
+        evict_layer_cache(connection, pg_cache_max_size)
@@ -8,6 +8,7 @@ IS_SYSTEM = False
 
 def run_check(params, status):
     import osgeo.gdal as gdal
+    from qc_tool.raster.helper import get_code_histogram
 
     # Check if the current delivery is excluded from vector checks
     if "skip_vector_checks" in params:
@@ -20,10 +21,10 @@ def run_check(params, status):
 
     raster_layer = params["raster_layer_defs"][raster_layer_alias]
     raster_ds = gdal.Open(str(raster_layer["src_filepath"]))
-    histogram = raster_ds.GetRasterBand(1).GetHistogram(approx_ok=False)
+    histogram = get_code_histogram(raster_layer["src_filepath"], params.get("tmp_dir"))
     raster_area_pixel_count = 0
     for raster_area_code in params["raster_codes"]:
-        raster_area_pixel_count += histogram[raster_area_code]
+        raster_area_pixel_count += histogram.get(raster_area_code, 0)
 
     raster_geotransform = raster_ds.GetGeoTransform()
     raster_cell_area = abs(raster_geotransform[1] * raster_geotransform[5])
@@ -7,6 +7,7 @@ import logging
 
 DESCRIPTION = "Minimum mapping unit"
 IS_SYSTEM = False
+IS_EXCLUSIVE = True
 
 
 log = logging.getLogger(__name__)
@@ -38,7 +39,8 @@ def run_check(params, status):
             continue
         
         # Prepare support data.
-        partitioned_layer = PartitionedLayer(cursor.connection, layer_def["pg_layer_name"], layer_def["pg_fid_name"])
+        partitioned_layer = PartitionedLayer(cursor.connection, layer_def["pg_layer_name"], layer_def["pg_fid_name"],
+                                             workers=params.get("pg_workers", 1))
         neighbour_table = NeighbourTable(partitioned_layer)
         neighbour_table.make()
         marginal_property = MarginalProperty(partitioned_layer)
@@ -4,6 +4,7 @@
 
 DESCRIPTION = "Naming is in accord with specification."
 IS_SYSTEM = False
+PROVIDES = ("layer_defs", "aoi_code", "skip_vector_checks", "name_epsg", "name_info")
 
 
 def run_check(params, status):
@@ -29,32 +30,32 @@ def run_check(params, status):
     # Find Shapefile (.shp) layers.
     shp_layer_infos = []
     if ".shp" in params["formats"]:
-        shp_layer_infos = find_shp_layers(params["unzip_dir"], status)
+        shp_layer_infos = find_shp_layers(params["unzip_dir"], status, params.get("unzip_filepaths"))
 
     # Find Geodatabase (.gdb) layers.
     gdb_layer_infos = []
     if ".gdb" in params["formats"]:
-        gdb_layer_infos = find_gdb_layers(params["unzip_dir"], status)
+        gdb_layer_infos = find_gdb_layers(params["unzip_dir"], status, params.get("unzip_filepaths"))
 
     # Find GeoPackage (.gpkg) layers.
     gpkg_layer_infos = []
     if ".gpkg" in params["formats"]:
-        gpkg_layer_infos = find_gpkg_layers(params["unzip_dir"], status)
+        gpkg_layer_infos = find_gpkg_layers(params["unzip_dir"], status, params.get("unzip_filepaths"))
 
     # Find FlatGeobuf (.fgb) layers.
     fgb_layer_infos = []
     if ".fgb" in params["formats"]:
-        fgb_layer_infos = find_fgb_layers(params["unzip_dir"], status)
+        fgb_layer_infos = find_fgb_layers(params["unzip_dir"], status, params.get("unzip_filepaths"))
 
     # Find Geoparquet (.parquet) layers.
     geoparquet_layer_infos = []
     if ".parquet" in params["formats"]:
-        geoparquet_layer_infos = find_geoparquet_layers(params["unzip_dir"], status)
+        geoparquet_layer_infos = find_geoparquet_layers(params["unzip_dir"], status, params.get("unzip_filepaths"))
 
     # Find CSV (.csv) layers.
     csv_layer_infos = []
     if ".csv" in params["formats"]:
-        csv_layer_infos = find_csv_layers(params["unzip_dir"], status)
+        csv_layer_infos = find_csv_layers(params["unzip_dir"], status, params.get("unzip_filepaths"))
 
     # Check if delivery contains any vector layers.
     if len(shp_layer_infos) + len(gdb_layer_infos) + len(gpkg_layer_infos) + len(fgb_layer_infos) + len(geoparquet_layer_infos) + len(csv_layer_infos) == 0:
@@ -174,7 +175,7 @@ def run_check(params, status):
 
     # Find supplementary documents.
     for document_alias, document_regex in params.get("documents", {}).items():
-        document_filepaths = find_documents(params["unzip_dir"], document_regex)
+        document_filepaths = find_documents(params["unzip_dir"], document_regex, params.get("unzip_filepaths"))
         if not document_filepaths:
             status.info("Warning: the delivery does not contain expected document '{:s}'.".format(document_alias))
 
@@ -15,7 +15,7 @@ def run_check(params, status):
 
 
     # Find PDF (.pdf) layers.
-    pdf_file_infos = find_pdfs(params["unzip_dir"], status)
+    pdf_file_infos = find_pdfs(params["unzip_dir"], status, params.get("unzip_filepaths"))
 
 
     # Check if delivery contains any PDF files.
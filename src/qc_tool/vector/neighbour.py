@@ -7,6 +7,7 @@ import logging
 
 DESCRIPTION = "There is no couple of neighbouring polygons having the same code."
 IS_SYSTEM = False
+IS_EXCLUSIVE = True
 
 
 log = logging.getLogger(__name__)
@@ -41,7 +42,8 @@ def run_check(params, status):
             return
 
         # Prepare support data.
-        partitioned_layer = PartitionedLayer(cursor.connection, layer_def["pg_layer_name"], layer_def["pg_fid_name"])
+        partitioned_layer = PartitionedLayer(cursor.connection, layer_def["pg_layer_name"], layer_def["pg_fid_name"],
+                                             workers=params.get("pg_workers", 1))
         neighbour_table = NeighbourTable(partitioned_layer)
         neighbour_table.make()
         create_pg_has_comment(cursor.connection)
@@ -4,6 +4,7 @@
 
 DESCRIPTION = "Detects non-probable changes."
 IS_SYSTEM = False
+IS_EXCLUSIVE = True
 
 
 NON_PROBABLE_CHANGES_TABLE_NAME = "non_probable"
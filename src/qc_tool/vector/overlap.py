@@ -6,6 +6,7 @@ import logging
 
 DESCRIPTION = "There is no couple of overlapping polygons."
 IS_SYSTEM = False
+IS_EXCLUSIVE = True
 
 DEFAULT_OVERLAP_AREA_TOLERANCE = 1e-6 # square metres
 
@@ -44,7 +45,8 @@ def run_check(params, status):
             return
 
         # Prepare support data.
-        partitioned_layer = PartitionedLayer(cursor.connection, layer_def["pg_layer_name"], layer_def["pg_fid_name"])
+        partitioned_layer = PartitionedLayer(cursor.connection, layer_def["pg_layer_name"], layer_def["pg_fid_name"],
+                                             workers=params.get("pg_workers", 1))
         neighbour_table = NeighbourTable(partitioned_layer)
         neighbour_table.make()
 
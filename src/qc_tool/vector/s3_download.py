@@ -4,10 +4,12 @@
 
 DESCRIPTION = "Delivery can be downloaded from S3 storage."
 IS_SYSTEM = True
+PROVIDES = ("unzip_dir",)
 
 def run_check(params, status):
     # Vector layers are downloaded to the temporary directory.
     from qc_tool.vector.helper import do_s3_download
+    from qc_tool.vector.helper import get_s3_partial_dir
     s3_local_dir = params["tmp_dir"].joinpath("r_unzip.d") #TODO find better name
     do_s3_download(params["s3"]["host"],
                    params["s3"]["access_key"],
@@ -15,4 +17,6 @@ def run_check(params, status):
                    params["s3"]["bucketname"],
                    params["s3"]["key_prefix"],
                    s3_local_dir,
-                   status)
\ No newline at end of file
+                   status,
+                   get_s3_partial_dir(params),
+                   workers=params.get("s3_workers", 1))
\ No newline at end of file
@@ -29,7 +29,7 @@ def init_logging(job_dir, log_filename=LOG_FILENAME):
     handler.setFormatter(formatter)
 
 
-def main():
+def main(args=None):
     # Parse command line arguments.
     parser = ArgumentParser()
     parser.add_argument("--job-uuid",
@@ -86,6 +86,27 @@ def main():
                         action="store",
                         nargs=1,
                         required=False)
+    parser.add_argument("--delivery-hash",
+                        help="Hash of the delivery file computed when it was uploaded.",
+                        dest="delivery_hash",
+                        default=None,
+                        action="store",
+                        nargs=1,
+                        required=False)
+    parser.add_argument("--delivery-size",
+                        help="Size of the delivery file when the hash was computed.",
+                        dest="delivery_size",
+                        default=None,
+                        action="store",
+                        nargs=1,
+                        required=False)
+    parser.add_argument("--delivery-mtime-ns",
+                        help="Modification time of the delivery file in nanoseconds when the hash was computed.",
+                        dest="delivery_mtime_ns",
+                        default=None,
+                        action="store",
+                        nargs=1,
+                        required=False)
     parser.add_argument("username",
                         help="The name of the user managing the delivery.",
                         action="store",
@@ -94,7 +115,7 @@ def main():
                         help="Path to delivery file relative to INCOMING_DIR.",
                         action="store",
                         nargs=1)
-    pargs = parser.parse_args()
+    pargs = parser.parse_args(args)
     job_uuid = pargs.job_uuid[0]
     username = pargs.username[0]
     filename = pargs.filename[0]
@@ -110,6 +131,15 @@ def main():
     else:
         s3_params = None
 
+    if pargs.delivery_hash is not None:
+        delivery_signature = {
+            "hash": pargs.delivery_hash[0],
+            "size": int(pargs.delivery_size[0]),
+            "mtime_ns": int(pargs.delivery_mtime_ns[0])
+        }
+    else:
+        delivery_signature = None
+
     filepath = CONFIG["incoming_dir"].joinpath(username, filename)
     if pargs.skip_steps is None:
         skip_steps = tuple()
@@ -124,7 +154,7 @@ def main():
     log.info("Logging of the job {:s} has been started.".format(job_uuid))
 
     # Run the checks.
-    dispatch(job_uuid, username, filepath, pargs.product_ident[0], skip_steps, s3_params)
+    dispatch(job_uuid, username, filepath, pargs.product_ident[0], skip_steps, s3_params, delivery_signature)
 
 
 if __name__ == "__main__":
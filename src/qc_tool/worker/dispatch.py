@@ -3,11 +3,12 @@
 
 import hashlib
 import logging
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import ExitStack
 from datetime import datetime
 from functools import partial
 from importlib import import_module
-from subprocess import run
 from sys import exc_info
 from traceback import format_exc
 from signal import signal, alarm, SIGALRM
@@ -29,9 +30,22 @@ from qc_tool.common import QCException
 from qc_tool.common import TIME_FORMAT
 from qc_tool.common import store_job_result
 from qc_tool.common import get_timeout
-from qc_tool.worker.report import generate_pdf_report
+from qc_tool.translate import close_pg_datasources
+from qc_tool.translate import get_pg_datasource
+from qc_tool.translate import vector_translate
 from qc_tool.worker.manager import create_connection_manager
 from qc_tool.worker.manager import create_jobdir_manager
+from qc_tool.worker.step_cache import make_dir_version
+from qc_tool.worker.step_cache import make_step_key
+from qc_tool.worker.step_cache import StepCache
+
+
+# Error tables are read from postgis in pages of this size.
+EXPORT_CONFIG_OPTIONS = {"OGR_PG_CURSOR_PAGE": "10000",
+                         "OGR_SQLITE_SYNCHRONOUS": "OFF"}
+
+# Config options changing the results of the checks, they are part of the step cache key.
+STEP_KEY_CONFIG_OPTIONS = ("skip_inspire_check", "inspire_service_url", "use_lightweight_validator")
 
 
 log = logging.getLogger(__name__)
@@ -50,13 +64,29 @@ def make_signature(filepath):
             h.update(buf)
     return h.hexdigest()
 
-def dump_error_table(connection_manager, error_table_name, src_table_name, pg_fid_name, output_dir, src_filename_stem=None):
-    (dsn, schema) = connection_manager.get_dsn_schema()
-    conn_string = "PG:{:s} active_schema={:s}".format(dsn, schema)
-    gpkg_filepath = output_dir.joinpath("{:s}.gpkg".format(error_table_name))
-    if src_filename_stem is not None:
-        gpkg_filepath = output_dir.joinpath("{:s}_{:s}.gpkg".format(src_filename_stem, error_table_name))
-
+def verify_signature(filepath, signature=None):
+    """
+    Returns the hash of the file.
+
+    The hash computed when the delivery was uploaded is reused
+    if the size and modification time of the file have not changed since then,
+    otherwise the file is hashed again.
+    :param signature: dictionary with hash, size and mtime_ns items or None.
+    """
+    if signature is not None:
+        file_stat = filepath.stat()
+        if file_stat.st_size == signature["size"] and file_stat.st_mtime_ns == signature["mtime_ns"]:
+            return signature["hash"]
+        log.info("Delivery {:s} has changed since upload, the hash is computed again.".format(filepath.name))
+    return make_signature(filepath)
+
+def _open_export_gpkg(gpkg_filepath):
+    from osgeo import gdal
+
+    driver = gdal.GetDriverByName("GPKG")
+    return driver.Create(str(gpkg_filepath), 0, 0, 0, gdal.GDT_Unknown)
+
+def _export_error_table(dst_ds, src_ds, error_table_name, src_table_name, pg_fid_name):
     # Export error features into geopackage.
     sql_params = {"fid_name": pg_fid_name,
                   "src_table": src_table_name,
@@ -67,35 +97,108 @@ def dump_error_table(connection_manager, error_table_name, src_table_name, pg_fi
            " INNER JOIN {src_table} AS st ON et.{fid_name} = st.{fid_name}\n"
            "ORDER BY st.{fid_name};")
     sql = sql.format(**sql_params)
-    args = ["ogr2ogr",
-            "-f", "GPKG",
-            "-sql", sql,
-            "-nln", error_table_name,
-            str(gpkg_filepath),
-            conn_string]
-    run(args)
-    return gpkg_filepath.name
-
-def dump_full_table(connection_manager, table_name, output_dir, src_filename_stem=None):
-    connection = connection_manager.get_connection()
+    options = ["-sql", sql,
+               "-nln", error_table_name,
+               "-lco", "SPATIAL_INDEX=NO"]
+    vector_translate(dst_ds, src_ds, options, config=EXPORT_CONFIG_OPTIONS)
+
+def _export_full_table(dst_ds, src_ds, table_name):
+    options = ["-nln", table_name,
+               "-lco", "SPATIAL_INDEX=NO",
+               table_name]
+    vector_translate(dst_ds, src_ds, options, config=EXPORT_CONFIG_OPTIONS)
+
+def _close_export_gpkg(dst_ds):
+    # Spatial indexes are built once all the features are written,
+    # it is faster than updating the index by every inserted feature.
+    layers = [dst_ds.GetLayerByIndex(i) for i in range(dst_ds.GetLayerCount())]
+    for layer in layers:
+        if layer.GetGeometryColumn() != "":
+            sql = "SELECT CreateSpatialIndex('{:s}', '{:s}')".format(layer.GetName(), layer.GetGeometryColumn())
+            dst_ds.ReleaseResultSet(dst_ds.ExecuteSQL(sql))
+    dst_ds.FlushCache()
+
+def dump_step_tables(connection_manager, step_nr, check_ident, error_table_infos, full_table_names, output_dir, src_filename_stem=None):
+    """
+    Exports all error tables and full tables of the step into one geopackage.
+
+    Every table becomes one layer of the geopackage.
+    :return: file name of the geopackage, None if the step has no table.
+    """
+    if len(error_table_infos) == 0 and len(full_table_names) == 0:
+        return None
     (dsn, schema) = connection_manager.get_dsn_schema()
     conn_string = "PG:{:s} active_schema={:s}".format(dsn, schema)
-    gpkg_filepath = output_dir.joinpath("{:s}.gpkg".format(table_name))
+    gpkg_filename = "s{:02d}_{:s}.gpkg".format(step_nr, check_ident.split(".")[-1])
     if src_filename_stem is not None:
-        gpkg_filepath = output_dir.joinpath("{:s}_{:s}.gpkg".format(src_filename_stem, table_name))
-
-    # Export features into geopackage.
-    args = ["ogr2ogr",
-            "-f", "GPKG",
-            "-nln", table_name,
-            str(gpkg_filepath),
-            conn_string,
-            table_name]
-    run(args)
+        gpkg_filename = "{:s}_{:s}".format(src_filename_stem, gpkg_filename)
+    gpkg_filepath = output_dir.joinpath(gpkg_filename)
+
+    src_ds = get_pg_datasource(conn_string)
+    dst_ds = _open_export_gpkg(gpkg_filepath)
+    for (error_table_name, src_table_name, pg_fid_name) in error_table_infos:
+        _export_error_table(dst_ds, src_ds, error_table_name, src_table_name, pg_fid_name)
+    for table_name in full_table_names:
+        _export_full_table(dst_ds, src_ds, table_name)
+    _close_export_gpkg(dst_ds)
     return gpkg_filepath.name
 
 
-def dispatch(job_uuid, user_name, filepath, product_ident, skip_steps=tuple(), s3_params=None):
+def is_concurrent_check(check_module):
+    """
+    Tells whether the check may run concurrently with other steps of the job.
+
+    The check must not be a system check, must not provide params for following steps
+    and must not change data shared by other steps (IS_EXCLUSIVE).
+    """
+    return (not check_module.IS_SYSTEM
+            and len(getattr(check_module, "PROVIDES", ())) == 0
+            and not getattr(check_module, "IS_EXCLUSIVE", False))
+
+def is_cacheable_check(check_module):
+    """
+    Tells whether the result of the check may be restored from step cache.
+
+    System checks, checks providing params and checks changing data shared by other steps (IS_EXCLUSIVE)
+    always run, the following steps depend on their outcome.
+    """
+    return is_concurrent_check(check_module)
+
+def run_step(check_ident, step_params, task_timeout):
+    """Runs the check of one step within time limit, returns the status of the check."""
+    check_status = CheckStatus()
+    check_module = import_module(check_ident)
+
+    # time limit implementation
+    signal(SIGALRM, signal_handler)
+    alarm(task_timeout["seconds"])
+
+    # Set the check result into the job status.
+    try:
+        start = time()
+        check_module.run_check(step_params, check_status)
+        stop = time()
+        task_runtime = stop - start
+        if check_status.status == "aborted" and task_runtime > task_timeout["seconds"]:
+            check_status.aborted("The check has failed due to a timeout "
+                                 "(the implemented timeout is {to} seconds).".format(
+                to=str(task_timeout["seconds"])))
+    except TimedOutExc as e:
+        if step_params["check_is_required"]:
+            check_status.aborted("The check has failed due to a timeout "
+                                   "(the implemented timeout is {to} seconds).".format(to=str(task_timeout["seconds"])))
+
+        else:
+            check_status.failed("The check has failed due to a timeout "
+                                 "(the implemented timeout is {to} seconds).".format(to=str(task_timeout["seconds"])))
+    finally:
+        # The time limit must not hit the process after the check,
+        # it may be a worker process waiting for the next step.
+        alarm(0)
+    return check_status
+
+
+def dispatch(job_uuid, user_name, filepath, product_ident, skip_steps=tuple(), s3_params=None, delivery_signature=None):
 
     task_timeout = get_timeout()
     with ExitStack() as exit_stack:
@@ -123,7 +226,7 @@ def dispatch(job_uuid, user_name, filepath, product_ident, skip_steps=tuple(), s
                 # FIXME make correct signature also in case of S3 files.
                 pass
             else:
-                job_result["hash"] = make_signature(filepath)
+                job_result["hash"] = verify_signature(filepath, delivery_signature)
 
             # Store initial job result.
             # This way we announce that the job has started.
@@ -137,12 +240,112 @@ def dispatch(job_uuid, user_name, filepath, product_ident, skip_steps=tuple(), s
             job_params["filepath"] = filepath
             job_params["boundary_dir"] = CONFIG["boundary_dir"]
             job_params["skip_inspire_check"] = CONFIG["skip_inspire_check"]
+            job_params["raster_workers"] = CONFIG["raster_workers"]
+            job_params["pg_workers"] = CONFIG["pg_workers"]
+            job_params["step_workers"] = CONFIG["step_workers"]
+            job_params["pg_cache_max_size"] = CONFIG["pg_cache_max_size"]
+            job_params["vsizip_cache_size"] = CONFIG["vsizip_cache_size"]
+            job_params["s3_workers"] = CONFIG["s3_workers"]
+            job_params["s3_download_dir"] = CONFIG["s3_download_dir"]
             job_params["s3"] = {}
 
             # Add S3 job params if specified.
             if s3_params:
                 job_params["s3"] = s3_params
 
+            def record_step(step_nr, step_def, step_result, step_key, check_status):
+                """Stores the result of the step and updates job params, returns False if the job is aborted."""
+                step_result["status"] = check_status.status
+                step_result["messages"] = check_status.messages
+                step_result["attachment_filenames"] = check_status.attachment_filenames.copy()
+
+                # Export error tables and full tables.
+                attachment_filename = dump_step_tables(job_params["connection_manager"],
+                                                       step_nr,
+                                                       step_def["check_ident"],
+                                                       check_status.error_table_infos,
+                                                       check_status.full_table_names,
+                                                       jobdir_manager.output_dir,
+                                                       filepath.stem)
+                if attachment_filename is not None:
+                    step_result["attachment_filenames"].append(attachment_filename)
+
+                # Update job status properties.
+                job_result.update(check_status.status_properties)
+
+                # Update job params.
+                job_params.update(check_status.status_properties)
+                job_params.update(check_status.params)
+
+                # Update stored job result.
+                job_result["steps"].append(step_result)
+                store_job_result(job_result)
+                log.info("Result of the job step {:d}:{:s} has been stored.".format(step_nr, step_def["check_ident"]))
+
+                # Cache the step result.
+                if step_key is not None:
+                    step_cache.store(step_key, step_result, check_status.status_properties, jobdir_manager.output_dir)
+
+                # Abort validation job.
+                return not check_status.is_aborted()
+
+            def record_cached_step(step_nr, step_def, step_result, cached_step):
+                """Stores the result of the step restored from step cache."""
+                (cached_step_result, status_properties) = cached_step
+                step_result.update(cached_step_result)
+                job_result.update(status_properties)
+                job_params.update(status_properties)
+                job_result["steps"].append(step_result)
+                store_job_result(job_result)
+                log.info("Result of the job step {:d}:{:s} has been restored from cache.".format(step_nr, step_def["check_ident"]))
+
+            # Steps running concurrently in other processes, the results are recorded in the order of steps.
+            # Every item is [step_nr, step_def, step_result, step_key, outcome],
+            # the outcome is a future, a cached step or None for a skipped step.
+            running_steps = []
+
+            def record_running_steps(wait_all):
+                """Records finished steps from the head of running steps, returns False if the job is aborted."""
+                while len(running_steps) > 0:
+                    step_nr, step_def, step_result, step_key, outcome = running_steps[0]
+                    if isinstance(outcome, Future):
+                        if not wait_all and not outcome.done():
+                            return True
+                        outcome = outcome.result()
+                    del running_steps[0]
+                    if outcome is None:
+                        job_result["steps"].append(step_result)
+                        store_job_result(job_result)
+                    elif isinstance(outcome, tuple):
+                        record_cached_step(step_nr, step_def, step_result, outcome)
+                    elif not record_step(step_nr, step_def, step_result, step_key, outcome):
+                        # Results of the following steps are dropped as if they were never run.
+                        for running_step in running_steps:
+                            if isinstance(running_step[4], Future):
+                                running_step[4].cancel()
+                        running_steps.clear()
+                        return False
+                return True
+
+            step_executor = None
+            if job_params["step_workers"] > 1:
+                step_executor = exit_stack.enter_context(ProcessPoolExecutor(job_params["step_workers"]))
+
+            # The key of the step result chains the delivery, the inputs of the checks
+            # and the previous steps the step depends on, ie. the steps which are not cacheable.
+            # So changing or skipping an independent step does not invalidate the results of the following steps.
+            step_cache = None
+            chain_key = None
+            if CONFIG["step_cache_dir"] is not None and "hash" in job_result:
+                step_cache = StepCache(CONFIG["step_cache_dir"])
+                chain_key = make_step_key("",
+                                          job_result["hash"],
+                                          filepath.name,
+                                          product_ident,
+                                          job_result["qc_tool_version"],
+                                          make_dir_version(CONFIG["boundary_dir"]),
+                                          {key: CONFIG[key] for key in STEP_KEY_CONFIG_OPTIONS})
+
             for step_nr, step_def in enumerate(product_definition["steps"], start=1):
 
                 step_result = {"check_ident": step_def["check_ident"]}
@@ -155,11 +358,19 @@ def dispatch(job_uuid, user_name, filepath, product_ident, skip_steps=tuple(), s
                     step_result = {"check_ident": step_def["check_ident"],
                                    "description": replaced_check_description}
 
+                check_module = import_module(step_def["check_ident"])
+                step_key = None
+                if step_cache is not None:
+                    step_key = make_step_key(chain_key, step_nr, step_def, step_nr in skip_steps)
+                    if not is_cacheable_check(check_module):
+                        chain_key = step_key
+
                 # Skip this step.
                 if step_nr in skip_steps:
                     step_result["status"] = JOB_STEP_SKIPPED
-                    job_result["steps"].append(step_result)
-                    store_job_result(job_result)
+                    running_steps.append([step_nr, step_def, step_result, None, None])
+                    if not record_running_steps(False):
+                        break
                     continue
 
                 # Prepare parameters for this step.
@@ -170,73 +381,38 @@ def dispatch(job_uuid, user_name, filepath, product_ident, skip_steps=tuple(), s
                 step_params["check_is_required"] = step_def.get("required", {})
 
                 # Run the step.
-                check_status = CheckStatus()
-                check_module = import_module(step_def["check_ident"])
-
-                # time limit implementation
-                signal(SIGALRM, signal_handler)
-                alarm(task_timeout["seconds"])
-
-                # Set the check result into the job status.
-                try:
-                    start = time()
-                    check_module.run_check(step_params, check_status)
-                    stop = time()
-                    task_runtime = stop - start
-                    if check_status.status == "aborted" and task_runtime > task_timeout["seconds"]:
-                        check_status.aborted("The check has failed due to a timeout "
-                                             "(the implemented timeout is {to} seconds).".format(
-                            to=str(task_timeout["seconds"])))
-                except TimedOutExc as e:
-                    if step_params["check_is_required"]:
-                        check_status.aborted("The check has failed due to a timeout "
-                                               "(the implemented timeout is {to} seconds).".format(to=str(task_timeout["seconds"])))
-
-                    else:
-                        check_status.failed("The check has failed due to a timeout "
-                                             "(the implemented timeout is {to} seconds).".format(to=str(task_timeout["seconds"])))
-
-                step_result["status"] = check_status.status
-                step_result["messages"] = check_status.messages
-                step_result["attachment_filenames"] = check_status.attachment_filenames.copy()
-
-                # Export error tables.
-                for (error_table_name, src_table_name, pg_fid_name) in check_status.error_table_infos:
-                    attachment_filename = dump_error_table(job_params["connection_manager"],
-                                                           error_table_name,
-                                                           src_table_name,
-                                                           pg_fid_name,
-                                                           jobdir_manager.output_dir,
-                                                           filepath.stem)
-                    step_result["attachment_filenames"].append(attachment_filename)
-
-                # Export full tables.
-                for table_name in check_status.full_table_names:
-                    attachment_filename = dump_full_table(job_params["connection_manager"],
-                                                          table_name,
-                                                          jobdir_manager.output_dir,
-                                                          filepath.stem)
-                    step_result["attachment_filenames"].append(attachment_filename)
-
-                # Update job status properties.
-                job_result.update(check_status.status_properties)
-
-                # Update job params.
-                job_params.update(check_status.status_properties)
-                job_params.update(check_status.params)
-
-                # Update stored job result.
-                job_result["steps"].append(step_result)
-                store_job_result(job_result)
-                log.info("Result of the job step {:d}:{:s} has been stored.".format(step_nr, step_def["check_ident"]))
-
-                # Abort validation job.
-                if check_status.is_aborted():
-                    break
+                cached_step_key = step_key if step_cache is not None and is_cacheable_check(check_module) else None
+                cached_step = None
+                if cached_step_key is not None:
+                    cached_step = step_cache.load(cached_step_key, jobdir_manager.output_dir)
+                if cached_step is not None:
+                    # The step provides no params, so it does not wait for previous steps.
+                    running_steps.append([step_nr, step_def, step_result, cached_step_key, cached_step])
+                    if not record_running_steps(False):
+                        break
+                elif step_executor is None or not is_concurrent_check(check_module):
+                    # The step runs alone in this process after all previous steps have finished,
+                    # so it sees their params and the following steps see its params.
+                    if not record_running_steps(True):
+                        break
+                    check_status = run_step(step_def["check_ident"], step_params, task_timeout)
+                    if not record_step(step_nr, step_def, step_result, cached_step_key, check_status):
+                        break
+                else:
+                    # The step neither provides params nor changes shared job data,
+                    # so it may run concurrently with other such steps.
+                    future = step_executor.submit(run_step, step_def["check_ident"], step_params, task_timeout)
+                    running_steps.append([step_nr, step_def, step_result, cached_step_key, future])
+                    if not record_running_steps(False):
+                        break
+            else:
+                record_running_steps(True)
 
         finally:
             # Finalize the job.
             (ex_type, ex_obj, tb_obj) = exc_info()
+            # The shared datasource must be closed before the job schema is dropped.
+            close_pg_datasources()
             if tb_obj is not None:
                 log.exception("Job has been interrupted by an exception.")
                 job_result["error_message"] = format_exc()
@@ -256,6 +432,8 @@ def dispatch(job_uuid, user_name, filepath, product_ident, skip_steps=tuple(), s
                 job_result["status"] = JOB_OK
             store_job_result(job_result)
             log.info("Job result has been completed.")
+            # reportlab is imported only when the report is generated, it takes long to import.
+            from qc_tool.worker.report import generate_pdf_report
             generate_pdf_report(job_report_filepath, job_uuid)
             log.info("Job report has been generated.")
 
@@ -5,7 +5,6 @@ from contextlib import closing
 from shutil import rmtree
 
 from pathlib import Path, PurePath
-from psycopg2 import connect
 
 from qc_tool.common import CONFIG
 from qc_tool.common import JOB_OUTPUT_DIRNAME
@@ -44,10 +43,19 @@ class ConnectionManager():
         self.leave_schema = leave_schema
         self.connection = None
         self.job_schema_name = None
+        self.is_owner = True
 
     def __enter__(self):
         return self
 
+    def __getstate__(self):
+        # The copy sent to another process shares the job schema of the owner,
+        # it neither creates nor drops the schema.
+        state = self.__dict__.copy()
+        state["connection"] = None
+        state["is_owner"] = False
+        return state
+
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
@@ -55,6 +63,8 @@ class ConnectionManager():
         return self.connection is not None and self.connection.closed == 0
 
     def _create_connection(self):
+        from psycopg2 import connect
+
         try:
             connection = connect(host=self.host, port=self.port, user=self.user, dbname=self.db_name)
         except Exception as ex:
@@ -69,7 +79,11 @@ class ConnectionManager():
         with closing(self.connection.cursor()) as cursor:
             cursor.execute("CREATE SCHEMA {:s};".format(job_schema_name))
             self.job_schema_name = job_schema_name
-            cursor.execute("SET search_path TO {:s}, public;".format(job_schema_name))
+        self._set_search_path()
+
+    def _set_search_path(self):
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute("SET search_path TO {:s}, public;".format(self.job_schema_name))
 
     def _drop_job_schema(self):
         with closing(self.connection.cursor()) as cursor:
@@ -85,12 +99,17 @@ class ConnectionManager():
         if self._is_connected():
             return self.connection
         self._create_connection()
-        if self.job_schema_name is None:
+        if self.job_schema_name is not None:
+            self._set_search_path()
+        elif self.is_owner:
             self._create_job_schema()
+        else:
+            msg = "Job schema for the job:{:s} has not been created yet.".format(self.job_uuid)
+            raise ConnectionException(msg)
         return self.connection
 
     def close(self):
-        if not self.leave_schema and self.job_schema_name is not None:
+        if self.is_owner and not self.leave_schema and self.job_schema_name is not None:
             if not self._is_connected():
                 conn = self._create_connection()
             self._drop_job_schema()
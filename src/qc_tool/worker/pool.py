@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+
+"""
+Pool of warm job executors.
+
+The executor is a process which has imported the modules used by the jobs in advance,
+so the job does not pay for starting the interpreter and importing GDAL, numpy etc.
+The executor receives the command line arguments of qc_tool.worker.cmd over a pipe and runs one job at a time,
+so the crash of the job takes down only its own executor.
+The executor is replaced by a fresh one after it has run the given number of jobs,
+so the memory leaked by the jobs does not pile up.
+"""
+
+
+import atexit
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+from importlib import import_module
+from threading import Lock
+from time import monotonic
+from traceback import print_exc
+
+
+# Modules imported by the executor before it receives the first job.
+PRELOAD_MODULES = ("numpy",
+                   "osgeo.gdal",
+                   "osgeo.ogr",
+                   "osgeo.osr",
+                   "psycopg2",
+                   "scipy.ndimage",
+                   "skimage.measure",
+                   "reportlab.platypus",
+                   "boto3",
+                   "qc_tool.worker.cmd",
+                   "qc_tool.worker.dispatch")
+
+# Time in seconds the stopped executor is given to exit before it is terminated.
+EXECUTOR_STOP_TIMEOUT = 10
+
+# Process-wide GDAL config options set by the checks, they are restored after every job.
+GDAL_CONFIG_OPTIONS = ("VSI_CACHE", "VSI_CACHE_SIZE")
+
+
+log = logging.getLogger(__name__)
+
+
+def preload_modules():
+    for module_name in PRELOAD_MODULES:
+        try:
+            import_module(module_name)
+        except ImportError:
+            print("Module {:s} can not be preloaded.".format(module_name), file=sys.stderr)
+
+
+def save_gdal_state():
+    """Returns the GDAL state changed by the checks, None if GDAL is not available."""
+    try:
+        import osgeo.gdal as gdal
+    except ImportError:
+        return None
+    return (gdal.GetUseExceptions(), {key: gdal.GetConfigOption(key) for key in GDAL_CONFIG_OPTIONS})
+
+
+def restore_gdal_state(gdal_state):
+    if gdal_state is None:
+        return
+    import osgeo.gdal as gdal
+
+    (use_exceptions, config_options) = gdal_state
+    if use_exceptions:
+        gdal.UseExceptions()
+    elif gdal.GetUseExceptions():
+        gdal.DontUseExceptions()
+    for key, value in config_options.items():
+        gdal.SetConfigOption(key, value)
+
+
+def run_job(args, stdout_filepath, job_func=None):
+    """
+    Runs qc_tool.worker.cmd in the executor process.
+
+    The stdout and stderr of the job are redirected to stdout_filepath.
+    The GDAL state is restored after the job, so the next job in the executor starts with the same state.
+    :param job_func: function run with args, qc_tool.worker.cmd.main by default.
+    :return: exit code of the job.
+    """
+    if job_func is None:
+        from qc_tool.worker.cmd import main as job_func
+
+    gdal_state = save_gdal_state()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    start_time = monotonic()
+    start_usage = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    with open(stdout_filepath, "a") as stdout_f:
+        os.dup2(stdout_f.fileno(), 1)
+        os.dup2(stdout_f.fileno(), 2)
+        try:
+            job_func(args)
+            exitcode = 0
+        except SystemExit as ex:
+            if ex.code is None:
+                exitcode = 0
+            elif isinstance(ex.code, int):
+                exitcode = ex.code
+            else:
+                print(ex.code, file=sys.stderr)
+                exitcode = 1
+        except:
+            print_exc()
+            exitcode = 1
+        finally:
+            # The resource usage is reported the same way as /usr/bin/time does for the job launched by the scheduler.
+            end_usage = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+            user_time = sum(end.ru_utime - start.ru_utime for start, end in zip(start_usage, end_usage))
+            system_time = sum(end.ru_stime - start.ru_stime for start, end in zip(start_usage, end_usage))
+            print("{:.2f}user {:.2f}system {:.2f}elapsed {:d}maxresident(executor)k"
+                  .format(user_time, system_time, monotonic() - start_time, end_usage[0].ru_maxrss),
+                  file=sys.stderr)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            restore_gdal_state(gdal_state)
+    return exitcode
+
+
+def run_executor(conn, job_func=None):
+    """Main loop of the executor process, the executor exits when the pipe is closed or None is received."""
+    preload_modules()
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+        (args, stdout_filepath) = item
+        exitcode = run_job(args, stdout_filepath, job_func)
+        conn.send(exitcode)
+    conn.close()
+
+
+class JobExecutor():
+    """
+    :param job_func: function run with the job args, qc_tool.worker.cmd.main by default,
+                     it must be importable by the spawned executor.
+    """
+    def __init__(self, context, job_func=None):
+        (self.conn, child_conn) = context.Pipe()
+        # The executor is not daemonic, daemonic process is not allowed to start the process pools used by the jobs.
+        self.process = context.Process(target=run_executor, name="qc_job_executor", args=(child_conn, job_func))
+        self.process.start()
+        child_conn.close()
+        self.job_count = 0
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def run(self, args, stdout_filepath):
+        """
+        Runs the job and waits until it finishes.
+
+        :return: exit code of the job, or exit code of the executor if it has crashed while running the job.
+        """
+        self.job_count += 1
+        try:
+            self.conn.send((args, str(stdout_filepath)))
+            return self.conn.recv()
+        except (EOFError, OSError):
+            self.process.join()
+            return self.process.exitcode
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+        self.process.join(EXECUTOR_STOP_TIMEOUT)
+        if self.process.is_alive():
+            log.warning("Executor pid={:d} has not exited in time, terminating.".format(self.pid))
+            self.process.terminate()
+            self.process.join()
+
+
+class ExecutorPool():
+    """
+    Keeps warm job executors.
+
+    :param size: number of idle executors kept ready for the next jobs.
+    :param recycle_after: number of jobs the executor runs before it is replaced by a fresh one.
+    """
+    def __init__(self, size, recycle_after):
+        self.size = size
+        self.recycle_after = recycle_after
+        # The scheduler runs threads, so the executors are spawned instead of forked.
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._lock = Lock()
+        # Executors waiting for a job must be stopped before multiprocessing joins them at exit.
+        atexit.register(self.close)
+
+    def fill(self):
+        """Starts new executors until there are enough idle executors."""
+        with self._lock:
+            while len(self._idle) < self.size:
+                executor = JobExecutor(self._context)
+                log.info("Started executor pid={:d}.".format(executor.pid))
+                self._idle.append(executor)
+
+    def acquire(self):
+        """Returns idle executor, new executor is started if there is no idle one."""
+        executor = None
+        with self._lock:
+            while executor is None and len(self._idle) > 0:
+                executor = self._idle.pop(0)
+                if not executor.is_alive():
+                    executor.stop()
+                    executor = None
+        if executor is None:
+            executor = JobExecutor(self._context)
+            log.info("Started executor pid={:d}.".format(executor.pid))
+        return executor
+
+    def release(self, executor):
+        """Returns the executor into the pool, the crashed or worn out executor is replaced by a fresh one."""
+        with self._lock:
+            if (executor.is_alive()
+                and executor.job_count < self.recycle_after
+                and len(self._idle) < self.size):
+                self._idle.append(executor)
+                return
+        log.info("Stopping executor pid={:d} after {:d} jobs.".format(executor.pid, executor.job_count))
+        executor.stop()
+        self.fill()
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for executor in idle:
+            executor.stop()
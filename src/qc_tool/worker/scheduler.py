@@ -7,6 +7,7 @@ from datetime import datetime
 from logging.handlers import TimedRotatingFileHandler
 from socket import gethostname
 from subprocess import Popen
+from time import monotonic
 from time import sleep
 from threading import Event
 from threading import Thread
@@ -21,11 +22,16 @@ from uuid import uuid4
 import bottle
 
 from qc_tool.common import CONFIG
+from qc_tool.common import get_job_cpus
 from qc_tool.common import get_worker_token
+from qc_tool.worker.pool import ExecutorPool
 
 
 QUERY_INTERVAL = 10
 
+# Time in seconds the frontend holds the pull request until a job is available.
+PULL_JOB_WAIT = 30
+
 
 log = logging.getLogger(__name__)
 
@@ -46,8 +52,9 @@ def get_job(job_uuid):
 
 @bottle.get("/max_slots.json")
 def get_max_slots():
+    """Gets the slots and the memory and cpu budget of the worker."""
     bottle.response.content_type = "application/json"
-    return json.dumps(job_table.max_slots)
+    return json.dumps(job_table.get_capacity_json())
 
 @bottle.put("/max_slots")
 def set_max_slots():
@@ -59,41 +66,76 @@ def set_max_slots():
 
 
 class JobTable():
-    def __init__(self, max_slots=1):
+    """
+    Keeps the jobs running on the worker.
+
+    Every job takes one slot and its estimated memory and cpus are counted against the budget of the worker.
+    """
+    def __init__(self, max_slots=1, max_memory=None, max_cpus=None):
         self._job_table = {}
         self.max_slots = max_slots
+        self.max_memory = max_memory
+        self.max_cpus = max_cpus
+        # Set when a job finishes, so the scheduler may pull the next job immediately.
+        self.slot_freed = Event()
 
     @property
     def free_slots(self):
         return self.max_slots - len(self._job_table)
 
+    @property
+    def free_memory(self):
+        return self.max_memory - sum(cost["memory"] for created, cost in list(self._job_table.values()))
+
+    @property
+    def free_cpus(self):
+        return self.max_cpus - sum(cost["cpus"] for created, cost in list(self._job_table.values()))
+
+    @property
+    def is_idle(self):
+        return len(self._job_table) == 0
+
     def get_table_json(self):
         info = []
-        for job_uuid, created in self._job_table.items():
-            info.append({"uuid": job_uuid, "created": created.isoformat()})
+        for job_uuid, (created, cost) in self._job_table.items():
+            info.append({"uuid": job_uuid, "created": created.isoformat(), "cost": cost})
         return info
 
     def get_job_json(self, job_uuid):
-        created = self._job_table.get(job_uuid, None)
-        if created is None:
+        item = self._job_table.get(job_uuid, None)
+        if item is None:
             info = None
         else:
-            info = {"uuid": job_uuid, "created": created.isoformat()}
+            (created, cost) = item
+            info = {"uuid": job_uuid, "created": created.isoformat(), "cost": cost}
         return info
 
-    def put(self, job_uuid):
-        self._job_table[job_uuid] = datetime.utcnow()
+    def get_capacity_json(self):
+        return {"max_slots": self.max_slots,
+                "free_slots": self.free_slots,
+                "max_memory": self.max_memory,
+                "free_memory": self.free_memory,
+                "max_cpus": self.max_cpus,
+                "free_cpus": self.free_cpus}
+
+    def put(self, job_uuid, cost=None):
+        if cost is None:
+            cost = {"memory": 0, "cpus": 0}
+        self._job_table[job_uuid] = (datetime.utcnow(), cost)
 
     def rm(self, job_uuid):
         del self._job_table[job_uuid]
+        self.slot_freed.set()
 
-job_table = JobTable()
+job_table = JobTable(max_memory=CONFIG["worker_max_memory"], max_cpus=CONFIG["worker_max_cpus"])
 
 
 class Scheduler():
-    def __init__(self, query_url):
+    def __init__(self, query_url, executor_pool=None):
         self.query_url = query_url
+        self.executor_pool = executor_pool
         self.query_interval = QUERY_INTERVAL
+        self.pull_job_wait = PULL_JOB_WAIT
 
     def pull_job(self):
         job_args = None
@@ -101,11 +143,22 @@ class Scheduler():
             # Get worker token and inject it into url.
             token = get_worker_token()
             url = list(urlsplit(self.query_url))
-            url[3] = urlencode({"token": token})
+            query = {"token": token, "wait": self.pull_job_wait}
+            # The frontend estimates the cpus of the job by the parallelism configured on this worker.
+            job_cpus = get_job_cpus()
+            query["raster_cpus"] = job_cpus["raster"]
+            query["vector_cpus"] = job_cpus["vector"]
+            # Idle worker takes any job, even the one exceeding the whole budget,
+            # otherwise only the job fitting into the free budget is pulled.
+            if not job_table.is_idle:
+                query["free_memory"] = max(0, job_table.free_memory)
+                query["free_cpus"] = max(0, job_table.free_cpus)
+            url[3] = urlencode(query)
             url = urlunsplit(url)
 
             # Pull job from frontend.
-            data = urlopen(Request(url)).read().strip()
+            # The frontend holds the request until a job is available or the wait time elapses.
+            data = urlopen(Request(url), timeout=self.pull_job_wait + self.query_interval).read().strip()
             log.debug("Pulled job data: {:s}".format(repr(data)))
             job_args = json.loads(data)
         except:
@@ -119,25 +172,33 @@ class Scheduler():
 
     def run(self):
         while True:
-            while job_table.free_slots > 0:
-                # Query a new job.
-                log.debug("Querying a new job...")
-                query_time = datetime.utcnow()
-                job_args = self.pull_job()
-                if job_args is None:
-                    log.debug("Got no new job.")
-                    break
-                log.info("Got a new job: {:s}.".format(repr(job_args)))
-
-                # Run the new job.
-                job_controller = JobController(job_args)
-                job_controller.start()
-            sleep(self.query_interval)
+            if job_table.free_slots <= 0:
+                # Wait until a running job finishes.
+                job_table.slot_freed.wait(self.query_interval)
+                job_table.slot_freed.clear()
+                continue
+
+            # Query a new job.
+            log.debug("Querying a new job...")
+            query_time = monotonic()
+            job_args = self.pull_job()
+            if job_args is None:
+                log.debug("Got no new job.")
+                # The pull returned early, eg. the frontend is not available or it does not support waiting,
+                # so the next query is delayed as if the frontend were polled.
+                sleep(max(0, self.query_interval - (monotonic() - query_time)))
+                continue
+            log.info("Got a new job: {:s}.".format(repr(job_args)))
+
+            # Run the new job.
+            job_controller = JobController(job_args, self.executor_pool)
+            job_controller.start()
 
 
 class JobController():
-    def __init__(self, job_args):
+    def __init__(self, job_args, executor_pool=None):
         self.job_args = job_args
+        self.executor_pool = executor_pool
 
     def start(self):
         put_event = Event()
@@ -152,15 +213,16 @@ class JobController():
     def run(self, put_event):
         log.info("Controller for the job {:s} has been started.".format(self.job_args["job_uuid"]))
         try:
-            job_table.put(self.job_args["job_uuid"])
+            job_table.put(self.job_args["job_uuid"], self.job_args.get("cost"))
             put_event.set()
-            args = ["/usr/bin/time",
-                    "python3",
-                    "-m", "qc_tool.worker.cmd",
-                    "--job-uuid", self.job_args["job_uuid"],
+            args = ["--job-uuid", self.job_args["job_uuid"],
                     "--product", self.job_args["product_ident"]]
             if self.job_args["skip_steps"] is not None:
                 args += ["--skip-steps", self.job_args["skip_steps"]]
+            if self.job_args.get("delivery_hash") is not None:
+                args += ["--delivery-hash", self.job_args["delivery_hash"]]
+                args += ["--delivery-size", str(self.job_args["delivery_size"])]
+                args += ["--delivery-mtime-ns", str(self.job_args["delivery_mtime_ns"])]
             args += [self.job_args["username"],
                      self.job_args["filename"]]
             if self.job_args.get("s3_host") is not None:
@@ -178,12 +240,22 @@ class JobController():
                 stdout_f.write("stdout and stderr of the job is redirected to this file.\n".format(self.job_args["job_uuid"]))
                 stdout_f.write("\n")
                 stdout_f.flush()
-                process = Popen(args=args, stdout=stdout_f, stderr=stdout_f)
-                log.info("Started job with pid={:d}.".format(process.pid))
-                process.wait()
-                log.info("Job has exited with code={:d}.".format(process.returncode))
+                if self.executor_pool is None:
+                    process = Popen(args=["/usr/bin/time", "python3", "-m", "qc_tool.worker.cmd"] + args,
+                                    stdout=stdout_f,
+                                    stderr=stdout_f)
+                    log.info("Started job with pid={:d}.".format(process.pid))
+                    returncode = process.wait()
+                else:
+                    executor = self.executor_pool.acquire()
+                    log.info("Started job in executor with pid={:d}.".format(executor.pid))
+                    try:
+                        returncode = executor.run(args, stdout_filepath)
+                    finally:
+                        self.executor_pool.release(executor)
+                log.info("Job has exited with code={:d}.".format(returncode))
                 stdout_f.write("\n\n")
-                stdout_f.write("The job {:s} has exited with code {:d}.\n".format(self.job_args["job_uuid"], process.returncode))
+                stdout_f.write("The job {:s} has exited with code {:d}.\n".format(self.job_args["job_uuid"], returncode))
         except:
             log.error(format_exc())
         finally:
@@ -209,8 +281,15 @@ def init_logging():
 def main():
     init_logging()
 
+    # Start warm job executors.
+    if CONFIG["worker_pool_size"] > 0:
+        executor_pool = ExecutorPool(CONFIG["worker_pool_size"], CONFIG["worker_pool_recycle"])
+        executor_pool.fill()
+    else:
+        executor_pool = None
+
     # Run the scheduler.
-    scheduler = Scheduler(CONFIG["pull_job_url"])
+    scheduler = Scheduler(CONFIG["pull_job_url"], executor_pool)
     bottle.default_app().scheduler = scheduler
     log.debug("Starting scheduler...")
     scheduler.start()
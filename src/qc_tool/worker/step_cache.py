@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from qc_tool.common import HASH_ALGORITHM
+
+
+STEP_CACHE_FILENAME = "step_result.json"
+
+# Only steps with these statuses are cached, aborted step may be caused by transient failure, eg. timeout.
+CACHED_STATUSES = ("ok", "failed", "cancelled")
+
+
+log = logging.getLogger(__name__)
+
+
+def make_step_key(prev_key, *items):
+    """
+    Composes the key of the step result.
+
+    The key of the previous step is part of the key,
+    so the change of any previous step invalidates the results of all following steps.
+    """
+    h = hashlib.new(HASH_ALGORITHM)
+    h.update(prev_key.encode())
+    for item in items:
+        h.update(json.dumps(item, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def make_dir_version(dir_path):
+    """
+    Returns the version of the directory content, eg. boundary package.
+
+    The version is composed of the names, sizes and modification times of the files,
+    so the files need not be read.
+    """
+    h = hashlib.new(HASH_ALGORITHM)
+    if dir_path is not None and dir_path.is_dir():
+        for filepath in sorted(path for path in dir_path.rglob("*") if path.is_file()):
+            file_stat = filepath.stat()
+            h.update(repr((filepath.relative_to(dir_path).as_posix(), file_stat.st_size, file_stat.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+class StepCache():
+    """
+    Stores results of job steps together with their attachments.
+
+    Every step result is stored in its own directory named by the key of the step.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def load(self, step_key, output_dir):
+        """
+        Restores the step result, the attachments are copied into output_dir.
+
+        :return: tuple (step_result items, status properties) or None if the step result is not cached.
+        """
+        step_dir = self.cache_dir.joinpath(step_key)
+        step_filepath = step_dir.joinpath(STEP_CACHE_FILENAME)
+        if not step_filepath.is_file():
+            return None
+        cached = json.loads(step_filepath.read_text())
+        for attachment_filename in cached["step_result"]["attachment_filenames"]:
+            shutil.copy2(str(step_dir.joinpath(attachment_filename)), str(output_dir.joinpath(attachment_filename)))
+        return (cached["step_result"], cached["status_properties"])
+
+    def store(self, step_key, step_result, status_properties, output_dir):
+        """Stores the step result, the attachments are copied from output_dir."""
+        if step_result["status"] not in CACHED_STATUSES:
+            return
+        step_dir = self.cache_dir.joinpath(step_key)
+        if step_dir.is_dir():
+            return
+        # The step result is written into adjacent directory which we then rename,
+        # so the other jobs never see incomplete step result.
+        step_dir_pre = self.cache_dir.joinpath("{:s}.{:d}.pre".format(step_key, os.getpid()))
+        step_dir_pre.mkdir(parents=True)
+        try:
+            for attachment_filename in step_result["attachment_filenames"]:
+                shutil.copy2(str(output_dir.joinpath(attachment_filename)), str(step_dir_pre.joinpath(attachment_filename)))
+            cached = {"step_result": {"status": step_result["status"],
+                                      "messages": step_result["messages"],
+                                      "attachment_filenames": step_result["attachment_filenames"]},
+                      "status_properties": status_properties}
+            step_dir_pre.joinpath(STEP_CACHE_FILENAME).write_text(json.dumps(cached, default=str))
+            step_dir_pre.rename(step_dir)
+        except OSError:
+            log.exception("Step result {:s} can not be cached.".format(step_key))
+            shutil.rmtree(str(step_dir_pre), ignore_errors=True)